@@ -7,11 +7,13 @@ from discord.ext.commands import Context
 from bot_secrets import TOKEN, YOUTUBE_API_KEY, YOUTUBE_CHANNEL_NAME, CHANNELS
 from datetime import datetime, timezone, timedelta
 
-from simpleQoC.qoc import performQoC, msgContainsBitrateFix, msgContainsClippingFix, msgContainsSigninErr, ffmpegExists, getFileMetadataMutagen, getFileMetadataFfprobe
+from simpleQoC.qoc import performQoCAsync, DEFAULT_QOC_CHECKS, msgContainsBitrateFix, msgContainsClippingFix, msgContainsSigninErr, msgContainsTranscodeFix, msgIsSampled, ffmpegExists, getFileMetadataMutagen, getFileMetadataFfprobe, setAnalysisThreads, findAudioDupes, clearScratchDirs, setCacheDir, QoCException
 from simpleQoC.metadata import checkMetadata, countDupe, isDupe
 import re
 import functools
 import typing
+import traceback
+import asyncio
 import math
 import json
 import os
@@ -35,9 +37,11 @@ DEFAULT_THUMBNAIL = '🖼️'
 QOC_DEFAULT_LINKERR = '🔗'
 QOC_DEFAULT_BITRATE = '🔢'
 QOC_DEFAULT_CLIPPING = '📢'
+QOC_DEFAULT_SAMPLED = '⏳'
 
 latest_pin_time = None # Keeps track of the last pinned message's time to distinguish between pins and unpins. To be updated on ready.
 latest_scan_time = None
+background_tasks = set() # Tasks started by commands that outlive them, see start_background_task
 
 bot = commands.Bot(
     command_prefix='!',
@@ -63,6 +67,10 @@ async def on_ready():
     global latest_pin_time
     latest_pin_time = datetime.now(timezone.utc)
 
+    # Threads used to analyze the channels of a rip in parallel
+    if get_config('analysis_threads'):
+        setAnalysisThreads(get_config('analysis_threads'))
+
 
 @bot.event
 async def on_guild_channel_pins_update(channel: typing.Union[GuildChannel, Thread], last_pin: datetime):
@@ -557,9 +565,11 @@ async def vet(ctx: Context, optional_arg = None):
 
 
 @bot.command(name='vet_all', brief='vet all pinned messages and show summary')
-async def vet_all(ctx: Context, optional_time = None):
+async def vet_all(ctx: Context, *args: str):
     """
     Retrieve all pinned messages (except the first one) and perform basic QoC, giving emoji labels.
+    Accepts an optional embed time, and the `refresh` flag (in any position) to check all rips again
+    instead of reusing the verdicts of those that did not change since they were last vetted.
     """
     if not channel_is_types(ctx.channel, ['ROUNDUP', 'PROXY_ROUNDUP']): return
     heard_command("vet_all", ctx.message.author.name)
@@ -567,27 +577,70 @@ async def vet_all(ctx: Context, optional_time = None):
     channel = await get_roundup_channel(ctx)
     if channel is None: return
 
-    time, msg = parse_optional_time(ctx.channel, optional_time)
+    refresh = 'refresh' in [arg.lower() for arg in args]
+    other_args = [arg for arg in args if arg.lower() != 'refresh']
+    time, msg = parse_optional_time(ctx.channel, other_args[0] if len(other_args) > 0 else None)
     if msg is not None: await ctx.channel.send(msg)
 
     if not ffmpegExists():
         await ctx.channel.send("WARNING: ffmpeg command not found on the bot's server. Please contact the developers.")
         return
 
+    # With triage, a quick verdict from a few windows of each rip is sent first, and the full one once it is done
+    triage = get_config('vet_all_triage')
+
     async with ctx.channel.typing():
-        all_pins = await vet_pins(channel)
-        result = ""
-        for rip_id, rip_info in all_pins.items():
-            result += make_markdown(rip_info, True)
-        result += f"```\nLEGEND:\n{QOC_DEFAULT_LINKERR}: Link cannot be parsed\n{DEFAULT_CHECK}: Rip is OK\n{DEFAULT_FIX}: Rip has potential issues, see below\n{QOC_DEFAULT_BITRATE}: Bitrate is not 320kbps\n{QOC_DEFAULT_CLIPPING}: Clipping```"
-        await send_embed(ctx, result, time)
+        all_pins = await vet_pins(channel, bool(triage), refresh)
+        await send_embed(ctx, make_vet_summary(all_pins), time)
+
+    if triage:
+        start_background_task(send_full_vet(ctx, channel, time, refresh), "full QoC of !vet_all")
+
+
+async def send_full_vet(ctx: Context, channel: TextChannel, time: float, refresh: bool = False):
+    """
+    Perform the full QoC of all pinned messages after a triage !vet_all, and send the final summary.
+    """
+    all_pins = await vet_pins(channel, refresh=refresh)
+    await send_embed(ctx, "**Full QoC finished, this replaces the provisional verdicts above.**\n" + make_vet_summary(all_pins), time)
+
+
+def start_background_task(coro: typing.Coroutine, description: str) -> asyncio.Task:
+    """
+    Run a coroutine after the command that started it returns.
+    The task is kept until it is done (the event loop only keeps weak references), and its errors are logged.
+    """
+    task = bot.loop.create_task(coro)
+    background_tasks.add(task)
+
+    def finish(task: asyncio.Task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            error = ''.join(traceback.format_exception(task.exception()))
+            print(f"Error in {description}:\n{error}")
+            write_log(f"Error in {description}:\n{error}")
+
+    task.add_done_callback(finish)
+    return task
+
+
+def make_vet_summary(all_pins: dict) -> str:
+    """
+    Convert the vetted pins to the !vet_all summary, with a legend
+    """
+    result = ""
+    for rip_id, rip_info in all_pins.items():
+        result += make_markdown(rip_info, True)
+    result += f"```\nLEGEND:\n{QOC_DEFAULT_LINKERR}: Link cannot be parsed\n{DEFAULT_CHECK}: Rip is OK\n{DEFAULT_FIX}: Rip has potential issues, see below\n{QOC_DEFAULT_BITRATE}: Bitrate is not 320kbps, or the rip may be transcoded\n{QOC_DEFAULT_CLIPPING}: Clipping\n{QOC_DEFAULT_SAMPLED}: Provisional, only parts of the rip were checked```"
+    return result
 
 
 @bot.command(name='vet_msg', brief='vet a single message link')
-async def vet_msg(ctx: Context, msg_link: str = None):
+async def vet_msg(ctx: Context, msg_link: str = None, refresh: str = None):
     """
     Perform basic QoC on a linked message.
     The first non-YouTube link found in the message is treated as the rip URL.
+    Accepts an optional argument to check the rip again even if it did not change since it was last vetted.
     """
     if not channel_is_types(ctx.channel, ['ROUNDUP', 'PROXY_ROUNDUP']): return
     heard_command("vet_msg", ctx.message.author.name)
@@ -602,16 +655,17 @@ async def vet_msg(ctx: Context, msg_link: str = None):
             await ctx.channel.send(status)
             return
 
-        verdict, msg = await check_qoc_and_metadata(message, True)
+        verdict, msg = await check_qoc_and_metadata(message, True, refresh is not None)
         rip_title = get_rip_title(message)
 
         await ctx.channel.send("**Rip**: **{}**\n**Verdict**: {}\n**Comments**:\n{}".format(rip_title, verdict, msg))
 
 
 @bot.command(name='vet_url', brief='vet a single url')
-async def vet_url(ctx: Context, url: str = None):
+async def vet_url(ctx: Context, url: str = None, refresh: str = None):
     """
     Perform basic QoC on an URL.
+    Accepts an optional argument to check the rip again even if it did not change since it was last vetted.
     """
     if not channel_is_types(ctx.channel, ['ROUNDUP', 'PROXY_ROUNDUP']): return
     heard_command("vet_url", ctx.message.author.name)
@@ -622,7 +676,7 @@ async def vet_url(ctx: Context, url: str = None):
         return
 
     async with ctx.channel.typing():
-        code, msg = await run_blocking(performQoC, urls[0])
+        code, msg = await performQoCAsync(urls[0], checks=qoc_checks(), useFeatureCache=bool(get_config('feature_cache')), refresh=refresh is not None)
         verdict = code_to_verdict(code, msg)
 
         await ctx.channel.send("**Verdict**: {}\n**Comments**:\n{}".format(verdict, msg))
@@ -633,6 +687,7 @@ async def count_dupe(ctx: Context, msg_link: str = None, check_queues: str = Non
     """
     Count the number of dupes for a given link to rip message.
     Accepts an optional argument to also count rips in queues, which can take longer.
+    If the audio_dupes config is set, also reports pinned (and queued) rips with the same audio, among those compared before.
     """
     if not channel_is_types(ctx.channel, ['ROUNDUP', 'PROXY_ROUNDUP']): return
     heard_command("count_dupe", ctx.message.author.name)
@@ -656,6 +711,9 @@ async def count_dupe(ctx: Context, msg_link: str = None, check_queues: str = Non
             await ctx.channel.send(msg)
             if check_queues is None: return
 
+        pinned_rips = await get_rips(channel, 'pin')
+        other_rips = [r for r in pinned_rips[channel.id] if r.id != message.id]
+
         if check_queues is not None:
             q = 0
             queue_channels = [k for k, v in CHANNELS.items() if 'QUEUE' in v]
@@ -663,10 +721,12 @@ async def count_dupe(ctx: Context, msg_link: str = None, check_queues: str = Non
                 queue_channel = server.get_channel(queue_channel_id)
                 queue_rips = await get_rips(queue_channel, 'msg')
                 q += sum([isDupe(description, get_rip_description(r)) for r in queue_rips[queue_channel_id] if r.id != message.id])
+                other_rips.extend([r for r in queue_rips[queue_channel_id] if r.id != message.id])
 
                 queue_thread_rips = await get_rips(queue_channel, 'thread')
                 for thread, rips in queue_thread_rips.items():
                     q += sum([isDupe(description, get_rip_description(r)) for r in rips if r.id != message.id])
+                    other_rips.extend([r for r in rips if r.id != message.id])
 
         # https://codegolf.stackexchange.com/questions/4707/outputting-ordinal-numbers-1st-2nd-3rd#answer-4712 how
         ordinal = lambda n: "%d%s" % (n,"tsnrhtdd"[(n//10%10!=1)*(n%10<4)*n%10::4])
@@ -676,6 +736,37 @@ async def count_dupe(ctx: Context, msg_link: str = None, check_queues: str = Non
         else:
             await ctx.channel.send(f"**Rip**: **{rip_title}**\nFound {p} rips of the same track on the channel. This is the {ordinal(p + 1)} rip of this track.")
 
+        # Downloads and fingerprints the rip if it was not compared before
+        if get_config('audio_dupes'):
+            audio_msg = await find_audio_dupes(message, other_rips)
+            if len(audio_msg) > 0:
+                await ctx.channel.send(audio_msg)
+
+
+async def find_audio_dupes(message: Message, other_rips: typing.List[Message]) -> str:
+    """
+    Report which of the given rips have the same audio as a rip message, using the fingerprints of rips that were compared before.
+    Only the rip itself is downloaded, and only if it was not compared before.
+    """
+    urls = extract_rip_link(message.content)
+    if len(urls) == 0:
+        return ""
+
+    candidates = {}
+    for r in other_rips:
+        for url in extract_rip_link(r.content):
+            candidates[url] = r
+
+    try:
+        matches, indexed = await run_blocking(findAudioDupes, urls[0], list(candidates))
+    except QoCException as e:
+        return "Could not compare the audio of the rip: {}".format(e.message)
+
+    if len(matches) == 0:
+        return f"No rips with the same audio among the {indexed} rips compared before."
+    titles = ["**{}** ({})".format(get_rip_title(candidates[url]), candidates[url].jump_url) for url in matches]
+    return f"Found {len(matches)} rips with the same audio among the {indexed} rips compared before:\n" + "\n".join(titles)
+
 
 @bot.command(name='scan', brief='scan queue/sub channel for metadata issues')
 async def scan(ctx: Context, channel_link: str = None, start_index: int = None, end_index: int = None):
@@ -899,8 +990,8 @@ async def help(ctx: Context):
             + "\n`!frames, !alerts, !metadata [queue_channel: link]`" \
             + "\n`!scout <prefix: str> [queue_channel: link]`" + scout.brief \
             + "\n`!scout_stats [queue_channel: link]`" + scout_stats.brief \
-            + "\n_**Auto QoC tools:**_\n`!vet` " + vet.brief + "\n`!vet_all` " + vet_all.brief \
-            + "\n`!vet_msg <message: link>` " + vet_msg.brief + "\n`!vet_url <URL: link>` " + vet_url.brief \
+            + "\n_**Auto QoC tools:**_\n`!vet` " + vet.brief + "\n`!vet_all [embed_minutes: int] [refresh]` " + vet_all.brief \
+            + "\n`!vet_msg <message: link> [refresh: any]` " + vet_msg.brief + "\n`!vet_url <URL: link> [refresh: any]` " + vet_url.brief \
             + "\n`!peek_msg <message: link> [ffprobe: any]` " + peek_msg.brief + "\n`!peek_url <URL: link> [ffprobe: any]` " + peek_url.brief \
             + "\n`!count_dupe <message: link> [count_queues: any]`" + count_dupe.brief \
             + "\n_**Experimental tools:**_\n`!scan <queue_channel: link> [start_index: int] [end_index: int]`" + scan.brief \
@@ -1380,32 +1471,41 @@ def get_rip_description(message: Message) -> str:
         return ""  # Return empty string if no match was found
 
 
-async def get_pinned_msgs_and_react(channel: TextChannel, react_func: typing.Callable | None = None) -> dict:
+async def get_pinned_msgs_and_react(channel: TextChannel, react_func: typing.Callable | None = None, concurrency: int = 1) -> dict:
     """
     Unified function to retrieve all pinned messages (except the first one) from a channel and give corresponding emojis.
     - react_func: A function in the form of fn(TextChannel, Message) that returns some emojis for a message. If None, show no emojis.
+    - concurrency: How many messages react_func may run on at once, e.g. when it waits on downloads
     
     Returns a dictionary of pinned messages.
     """
     pin_list = await get_pins(channel)
 
+    # Only a few rips are fetched and downloaded at a time, so they do not pile up on disk waiting to be analyzed
+    limit = asyncio.Semaphore(max(1, concurrency))
+
+    async def react(pinned_message: Message) -> typing.Tuple[str, str]:
+        if react_func is None:
+            return "", ""
+        async with limit:
+            message = await channel.fetch_message(pinned_message.id)
+            return await react_func(channel, message)
+
+    if concurrency > 1:
+        all_reacts = await asyncio.gather(*[react(pinned_message) for pinned_message in pin_list])
+    else:
+        all_reacts = [await react(pinned_message) for pinned_message in pin_list]
+
     dict_index = 1
     pins_in_message = {}  # make a dict for everything
 
-    for pinned_message in pin_list:
+    for pinned_message, (reacts, indicator) in zip(pin_list, all_reacts):
         # Get the rip title
         rip_title = get_rip_title(pinned_message)
 
         # Find the rip's author
         author = get_rip_author(pinned_message)        
 
-        # Get reactions
-        if react_func is not None:
-            message = await channel.fetch_message(pinned_message.id)
-            reacts, indicator = await react_func(channel, message)
-        else:
-            reacts, indicator = "", ""
-
         #get rid of all asterisks and underscores in the author so an odd number of them doesn't mess up the rest of the message
         author = author.replace('*', '').replace('_', '')
 
@@ -1544,14 +1644,16 @@ async def process_pins(channel: TextChannel, get_reacts: bool):
     return await get_pinned_msgs_and_react(channel, get_reactions if get_reacts else None)
 
 
-async def vet_message(channel: TextChannel, message: Message) -> typing.Tuple[str, str]:
+async def vet_message(channel: TextChannel, message: Message, sampled: bool = False, refresh: bool = False) -> typing.Tuple[str, str]:
     """
     Return the QoC verdict of a message as emoji reactions.
+    - sampled: Only check a few windows of long rips, for a quick provisional verdict
+    - refresh: Check the rip again even if it did not change since it was last vetted
     """
     urls = extract_rip_link(message.content)
     reacts = ""
     for url in urls:
-        code, msg = await run_blocking(performQoC, url)
+        code, msg = await performQoCAsync(url, checks=qoc_checks(), useFeatureCache=bool(get_config('feature_cache')), sampled=sampled, refresh=refresh)
         reacts = code_to_verdict(code, msg)
         
         # debug
@@ -1562,11 +1664,32 @@ async def vet_message(channel: TextChannel, message: Message) -> typing.Tuple[st
 
     return reacts, ""
 
-async def vet_pins(channel: TextChannel):
+async def vet_pins(channel: TextChannel, sampled: bool = False, refresh: bool = False):
     """
     Retrieve all pinned messages (except the first one) from a channel and perform basic QoC, showing verdicts as emojis.
+    - sampled: Only check a few windows of long rips, for a quick provisional verdict
+    - refresh: Check rips again even if they did not change since they were last vetted
+    """
+    return await get_pinned_msgs_and_react(channel, functools.partial(vet_message, sampled=sampled, refresh=refresh), vet_concurrency())
+
+
+def vet_concurrency() -> int:
+    """
+    Number of rips vetted at once by vet_pins, one per analysis thread
+    """
+    return get_config('analysis_threads') or os.cpu_count() or 1
+
+
+def qoc_checks() -> tuple:
+    """
+    Names of the checks run by the vet commands, see simpleQoC's HEADER_CHECKS and SAMPLE_CHECKS
     """
-    return await get_pinned_msgs_and_react(channel, vet_message)
+    checks = DEFAULT_QOC_CHECKS
+    if get_config('transcode'):
+        checks += ('transcode',) # spectral lowpass of rips re-encoded from a low bitrate, on the same decode
+    if get_config('loudness'):
+        checks += ('loudness',) # measured on the same decode as the clipping check
+    return checks
 
 
 def code_to_verdict(code: int, msg: str) -> str:
@@ -1582,22 +1705,25 @@ def code_to_verdict(code: int, msg: str) -> str:
     if code == 1:
         if msgContainsSigninErr(msg):
             verdict = QOC_DEFAULT_LINKERR
-        if msgContainsBitrateFix(msg):
+        if msgContainsBitrateFix(msg) or msgContainsTranscodeFix(msg):
             verdict += ' ' + QOC_DEFAULT_BITRATE
         if msgContainsClippingFix(msg):
             verdict += ' ' + QOC_DEFAULT_CLIPPING
+    if code != -1 and msgIsSampled(msg):
+        verdict += ' ' + QOC_DEFAULT_SAMPLED
     return verdict
 
 
-async def check_qoc(message: Message, fullFeedback: bool = False) -> typing.Tuple[str, str, str]:
+async def check_qoc(message: Message, fullFeedback: bool = False, refresh: bool = False) -> typing.Tuple[str, str, str]:
     """
     Perform simpleQoC on a message.
+    - **refresh**: Check the rip again even if it did not change since it was last vetted
     """
     urls = extract_rip_link(message.content)
     qcCode, qcMsg = -1, "No links detected."
     detectedUrl = None
     for url in urls:
-        qcCode, qcMsg = await run_blocking(performQoC, url, fullFeedback)
+        qcCode, qcMsg = await performQoCAsync(url, fullFeedback, qoc_checks(), bool(get_config('feature_cache')), refresh=refresh)
         if qcCode != -1:
             detectedUrl = url
             break
@@ -1652,19 +1778,20 @@ async def check_metadata(message: Message, fullFeedback: bool = False) -> typing
     return mtCode, mtMsg
 
 
-async def check_qoc_and_metadata(message: Message, fullFeedback: bool = False) -> typing.Tuple[str, str]:
+async def check_qoc_and_metadata(message: Message, fullFeedback: bool = False, refresh: bool = False) -> typing.Tuple[str, str]:
     """
     Perform simpleQoC and metadata checking on a message.
 
     - **message**: Message to check
     - **fullFeedback**: If True, display "OK" messages. Otherwise, display only issues.
+    - **refresh**: If True, check the rip again even if it did not change since it was last vetted.
     """
     verdict = ""
     msg = ""
     rip_title = get_rip_title(message)
     
     # QoC
-    qcCode, qcMsg, detectedUrl = await check_qoc(message, fullFeedback)
+    qcCode, qcMsg, detectedUrl = await check_qoc(message, fullFeedback, refresh)
     if qcCode == -1:
         write_log("Warning: cannot QoC message\nRip: {}\n{}".format(rip_title, qcMsg))
     elif (qcCode == 1) or fullFeedback:
@@ -1821,4 +1948,7 @@ def write_log(msg: str):
 
 
 # Now that everything's defined, run the dang thing
+if get_config('cache_dir'):
+    setCacheDir(get_config('cache_dir')) # downloads, features, verdicts and fingerprints kept between runs
+clearScratchDirs() # files of QoC jobs that were running when the bot last stopped
 bot.run(TOKEN)
@@ -1,4 +1,8 @@
 import os
+import io
+import asyncio
+import functools
+import itertools
 from pathlib import Path
 from inspect import getsourcefile
 from typing import Tuple
@@ -6,16 +10,114 @@ import requests
 import cgi
 import re
 import json
-
-from mutagen import File, FileType, flac, wave
+import struct
+import hashlib
+import shutil
+import sqlite3
+import threading
+import time
+import tempfile
+from contextlib import closing, contextmanager
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from mutagen import File, FileType, MutagenError, flac, wave, aiff, mp3, ogg
 from scipy.io import wavfile
+from scipy import signal
+from scipy.ndimage import maximum_filter1d
 import subprocess
 import numpy as np
+try:
+    import numba    # optional, compiles the run scanner used by findRuns
+except ImportError:
+    numba = None
+try:
+    import aiohttp  # optional, used by the asyncio download engine (installed with discord.py)
+except ImportError:
+    aiohttp = None
 
 DOWNLOAD_DIR = Path(os.path.abspath(getsourcefile(lambda:0))).parent / 'audioDownloads'
+SCRATCH_DIR_PREFIX = 'job-'     # directories of DOWNLOAD_DIR holding the files of a single QoC job, see scratchDir
+CACHE_DIR = DOWNLOAD_DIR / 'cache'  # directory of the caches below, see setCacheDir
+
+DOWNLOAD_CACHE_DIR = CACHE_DIR / 'downloads'
+DOWNLOAD_CACHE_MAX_BYTES = 2 * 2**30    # least recently used downloads are evicted above this size
+
+PARTIAL_HEAD_BYTES = 256 * 2**10    # bytes fetched from the start of a file when only its headers and tags are needed
+PARTIAL_TAIL_BYTES = 128 * 2**10    # same, from its end (ID3v1 and APE tags, MP4 moov atoms written last, the last Ogg page)
+
+HTTP_CONNECT_TIMEOUT = 10   # seconds to wait for a connection to a file host
+HTTP_READ_TIMEOUT = 60      # seconds to wait for each read of a response before giving up on it
+HTTP_POOL_HOSTS = 16        # hosts whose connections are kept alive between requests
+HTTP_POOL_SIZE = min(32, (os.cpu_count() or 1) + 4)  # connections kept alive per host, as many as the threads of the default executor
+HOST_CONCURRENCY = {        # requests made at once to each file host (and its subdomains) by the asyncio download engine
+    'drive.usercontent.google.com': 4,
+    'dropbox.com': 4,
+    'siiva-gunner.com': 2,
+    'cgas.io': 2,
+}
+DEFAULT_HOST_CONCURRENCY = 4    # same, for other hosts
+DOWNLOAD_RETRIES = 5            # times a dropped download is resumed with a Range request before giving up on it
+DOWNLOAD_BACKOFF_SECONDS = 1    # wait before resuming a download, doubled for each other dropped download from the same host
+DOWNLOAD_MAX_BACKOFF_SECONDS = 30
+DOWNLOAD_TIME_BUDGET = 900      # seconds from the start of a download after which it is not resumed anymore
+HTTP_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'
+
+FEATURE_CACHE_DIR = CACHE_DIR / 'features'
+FEATURE_CACHE_MAX_BYTES = 256 * 2**20  # least recently used records are evicted above this size
+FEATURE_VERSION = 8                     # bump when the analysis changes, so that older records are not used
+
+VERDICT_CACHE_PATH = CACHE_DIR / 'verdicts.sqlite3'
+VERDICT_VERSION = 1         # bump when the verdicts change without FEATURE_VERSION changing (e.g. their messages)
+VERDICT_MAX_DAYS = 90       # verdicts not refreshed for this long are dropped
 
 DEFAULT_CLIPPING_THRESHOLD = 3
 DEFAULT_DS_CLIPPING_THRESHOLD = 5
+MAX_LISTED_CLIPS = 10           # more clipping runs than this are summarized instead of listed
+RUN_HISTOGRAM_BINS = 4096       # runs at least this long minus one are counted together in run histograms
+ENVELOPE_WINDOW = 512           # samples per channel summarized by each point of the finest min/max envelope
+ENVELOPE_FACTOR = 4             # ratio between the window sizes of consecutive envelope levels
+ENVELOPE_OVERVIEW_POINTS = 64   # envelope levels are added until one has at most this many points
+
+SPECTRUM_FFT_SIZE = 4096        # samples in each window of the transcode detector
+SPECTRUM_STRIDE = 16384         # samples between the starts of consecutive windows, so only a quarter of the rip is transformed
+SPECTRUM_FLOOR_DB = 60          # the cutoff is the highest frequency less than this many dB under the midrange level
+SPECTRUM_SHELF_DB = 25          # drop across the cutoff above which it is a hard lowpass shelf rather than a natural roll-off
+TRANSCODE_CUTOFF_HZ = 19000     # hard shelves below this frequency are typical of lossy sources under 320kbps
+
+FINGERPRINT_DIR = CACHE_DIR / 'fingerprints'
+FINGERPRINT_FRAME_SECONDS = 0.1     # length of the frame summarized by each 32-bit fingerprint word
+FINGERPRINT_HOP_SECONDS = 0.025     # time between consecutive fingerprint words
+FINGERPRINT_INDEX_STRIDE = 4        # only every this many words of each fingerprint are put in the lookup index
+FINGERPRINT_MAX_HITS = 256          # words found more often than this in the index are too common to vote for alignments
+FINGERPRINT_MIN_VOTES = 3           # index hits needed on the same alignment before comparing whole fingerprints
+FINGERPRINT_MIN_OVERLAP = 200       # words two fingerprints must overlap by to be compared (5s), unless one is shorter
+FINGERPRINT_MAX_BER = 0.35          # fraction of differing bits under which two fingerprints are the same audio
+FINGERPRINT_MAX_RIPS = 5000         # the oldest rips are dropped from the index above this many
+
+TRUE_PEAK_OVERSAMPLING = 4      # oversampling factor of the true-peak measurement, as in ITU-R BS.1770
+TRUE_PEAK_TAPS_PER_PHASE = 12   # taps of each phase of the polyphase interpolation filter (even, see LoudnessAnalyzer)
+
+STREAM_BLOCK_SIZE = 65536   # samples per channel in each block read from ffmpeg
+
+TRIAGE_WINDOWS = 8          # windows decoded by a sampled QoC, spread evenly over the rip
+TRIAGE_WINDOW_SECONDS = 3   # length of each of these windows
+
+ANALYSIS_THREADS = min(4, os.cpu_count() or 1)  # threads sharing the channels of a block, see setAnalysisThreads
+PARALLEL_MIN_SAMPLES = 32768                     # samples per channel below which channels are not split between threads
+
+# ffmpeg codecs used to decode sources of each bit depth (None: float or unknown depth).
+# 24-bit sources are streamed as 32-bit, with the samples in the upper bytes like scipy reads 24-bit WAVs
+WAV_FILE_CODECS = {16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le', None: 'pcm_f32le'}
+WAV_STREAM_CODECS = {16: 'pcm_s16le', 24: 'pcm_s32le', 32: 'pcm_s32le', None: 'pcm_f32le'}
+
+# +1 to min in order to mimic Audacity's Find Clipping algorithm,
+# even though WAV samples can technically go lower
+SAMPLE_LIMITS = {
+    16: (-2**15     +1,     2**15-1     ),
+    24: (-2**31     +1,     2147483392  ),
+    32: (-2**31     +1,     2**31-1     ),
+}
 
 #=======================================#
 #               DEBUGGING               #
@@ -76,11 +178,12 @@ def ffprobeUrl(validUrl: str):
     return json.loads(probeOutput)
 
 
-def ffmpegToWAV(filepath: str, wav_filepath: str):
+def ffmpegToWAV(filepath: str, wav_filepath: str, bits: int = None):
     """
     Runs ffmpeg to create a WAV file from the provided audio filepath or URL.
     - **filepath**: Path to local file, or URL to file
     - **wav_filepath**: Path to WAV file to be generated
+    - **bits**: Integer bit depth of the source (see getNativeBits), or None to decode to 32-bit float
     """
     try:
         subprocess.call([
@@ -88,7 +191,7 @@ def ffmpegToWAV(filepath: str, wav_filepath: str):
             '-hide_banner',
             '-loglevel', 'error',
             '-i', filepath,
-            '-c:a', 'pcm_f32le',
+            '-c:a', WAV_FILE_CODECS[bits],
             wav_filepath,
         ])
     except FileNotFoundError:
@@ -97,6 +200,474 @@ def ffmpegToWAV(filepath: str, wav_filepath: str):
     if not os.path.exists(wav_filepath):
         raise QoCException("ERROR: ffmpeg failed to generate .wav file.")
 
+
+def ffmpegToWAVStream(filepath: str, bits: int = None, start: float = None, duration: float = None, stdin = None) -> subprocess.Popen:
+    """
+    Runs ffmpeg to decode the provided audio filepath or URL into a WAV stream on its stdout,
+    without writing anything to disk.
+    - **bits**: Integer bit depth of the source (see getNativeBits), or None to decode to 32-bit float
+    - **start**, **duration**: Only decode this many seconds from this time, seeking in the input instead of decoding up to it
+    - **stdin**: subprocess.PIPE to write the input to ffmpeg's stdin instead, with **filepath** 'pipe:0'
+
+    The caller is responsible for closing `stdout` (and `stdin`) and waiting for the process.
+    """
+    window = [] if start is None else ['-ss', str(start), '-t', str(duration)]
+    try:
+        return subprocess.Popen([
+            'ffmpeg',
+            '-hide_banner',
+            '-loglevel', 'error',
+            *window,
+            '-i', filepath,
+            '-c:a', WAV_STREAM_CODECS[bits],
+            '-f', 'wav',
+            'pipe:1',
+        ], stdin=stdin, stdout=subprocess.PIPE)
+    except FileNotFoundError:
+        raise QoCException("ERROR: ffmpeg failed to run (make sure the command 'ffmpeg' can run).")
+
+
+#=======================================#
+#             PCM STREAMS               #
+#=======================================#
+"""
+Helpers to read WAV data in fixed-size blocks, so that long rips never have to be loaded all at once.
+"""
+
+def readWAVHeader(stream) -> Tuple[int, int, np.dtype, int, int]:
+    """
+    Reads a WAV header from a stream or file, leaving it at the start of the sample data.
+    Returns (framerate, channels, sample dtype, bits per sample, data size in bytes).
+    24-bit samples are reported as int32, the same way scipy reads them.
+    Streams written by ffmpeg to a pipe do not have a meaningful data size.
+    """
+    riff = stream.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise QoCException("ERROR: Audio data is not in WAV format.")
+
+    fmt = None
+    while True:
+        chunkHeader = stream.read(8)
+        if len(chunkHeader) < 8:
+            raise QoCException("ERROR: WAV stream does not contain any data.")
+        chunkId, chunkSize = chunkHeader[:4], struct.unpack('<I', chunkHeader[4:])[0]
+        if chunkId == b'data':
+            break
+        chunk = stream.read(chunkSize + (chunkSize & 1)) # chunks are padded to even size
+        if chunkId == b'fmt ':
+            fmt = chunk
+
+    if fmt is None:
+        raise QoCException("ERROR: WAV stream has no format chunk.")
+
+    formatTag, channels, framerate = struct.unpack('<HHI', fmt[:8])
+    bits = struct.unpack('<H', fmt[14:16])[0]
+    if formatTag == 0xFFFE: # WAVE_FORMAT_EXTENSIBLE, actual format is at the start of the subformat GUID
+        formatTag = struct.unpack('<H', fmt[24:26])[0]
+
+    dtypes = {
+        (1, 16): np.dtype('<i2'),
+        (1, 24): np.dtype('<i4'),
+        (1, 32): np.dtype('<i4'),
+        (3, 32): np.dtype('<f4'),
+        (3, 64): np.dtype('<f8'),
+    }
+    if (formatTag, bits) not in dtypes:
+        raise QoCException("ERROR: Unsupported WAV format (format {}, {}-bit).".format(formatTag, bits))
+
+    return framerate, channels, dtypes[(formatTag, bits)], bits, chunkSize
+
+
+def iterStreamBlocks(stream, channels: int, dtype: np.dtype, blockSize: int = STREAM_BLOCK_SIZE):
+    """
+    Yields (samples x channels) blocks read from a raw PCM stream until EOF.
+    The same buffer is reused for every block, so consumers must copy anything they want to keep.
+    """
+    buffer = np.empty((blockSize, channels), dtype=dtype)
+    view = memoryview(buffer).cast('B')
+    frameSize = channels * dtype.itemsize
+
+    while True:
+        read = 0
+        while read < len(view):
+            n = stream.readinto(view[read:])
+            if not n:
+                break
+            read += n
+
+        frames = read // frameSize
+        if frames > 0:
+            yield buffer[:frames]
+        if read < len(view):
+            return
+
+
+def getFormatLimits(dtype: np.dtype, bits: int) -> Tuple[float, float]:
+    """
+    Returns the (min, max) sample values used for clipping detection.
+    """
+    # Apparently WAV 32-bit float can go over +-1.0
+    if np.issubdtype(dtype, np.floating):
+        return (-1.0, 1.0)
+    return SAMPLE_LIMITS[bits]
+
+
+def getFullScale(dtype: np.dtype) -> float:
+    """
+    Returns the sample value corresponding to 1.0 in floating point.
+    """
+    if np.issubdtype(dtype, np.floating):
+        return 1.0
+    return float(np.iinfo(dtype).max) + 1
+
+
+def getNativeBits(file: FileType) -> int:
+    """
+    Returns the bit depth of a lossless integer source, so that it can be decoded without conversion.
+    Returns None for everything else: lossy decoders output floats, so those are decoded to 32-bit float.
+    """
+    if isinstance(file, (flac.FLAC, aiff.AIFF, wave.WAVE)) and file.info.bits_per_sample in (16, 24, 32):
+        return file.info.bits_per_sample
+    return None
+
+
+def feedBlock(analyzers: list, block: np.ndarray, formatMin, formatMax):
+    """
+    Gives a block to every analyzer. Analyzers that need the raw samples get it first,
+    then the block is clipped in place to the format limits for the others.
+    """
+    for analyzer in analyzers:
+        if not analyzer.clipped and not analyzer.done:
+            analyzer.process(block)
+
+    block.clip(formatMin, formatMax, out=block)
+    for analyzer in analyzers:
+        if analyzer.clipped and not analyzer.done:
+            analyzer.process(block)
+
+
+def analyzeStream(filepath: str, analyzerFactories: list, blockSize: int = STREAM_BLOCK_SIZE, bits: int = None, windows: list = None,
+                  feed = None) -> Tuple[int, list]:
+    """
+    Decodes a file or URL through ffmpeg and feeds the samples block by block to a set of analyzers.
+    Decoding stops early once all analyzers are done.
+    - **analyzerFactories**: Callables (channels, formatMin, formatMax) -> BlockAnalyzer.
+    - **bits**: Integer bit depth of the source (see getNativeBits), or None to decode to 32-bit float.
+    - **windows**: (start, duration) pairs in seconds, in order, to decode instead of the whole file (see getTriageWindows).
+    The analyzers are told where each window starts with `seek`.
+    - **feed**: Callable writing the input to ffmpeg's stdin, given as its argument, instead of ffmpeg reading **filepath**.
+    It runs in another thread while the samples are analyzed (see feedProcess), and its exceptions are raised again here.
+    Cannot be used with **windows**, which need seeking.
+
+    Returns the framerate and the analyzers, in the same order as the factories.
+    """
+    if feed is not None and windows is not None:
+        raise ValueError('Windows cannot be decoded from a pipe')
+
+    analyzers = None
+    for start, duration in windows or [(None, None)]:
+        feeder = None
+        if feed is None:
+            process = ffmpegToWAVStream(filepath, bits, start, duration)
+        else:
+            process = ffmpegToWAVStream('pipe:0', bits, stdin=subprocess.PIPE)
+            feedErrors = []
+            feeder = threading.Thread(target=feedProcess, args=(feed, process.stdin, feedErrors), daemon=True)
+            feeder.start()
+        try:
+            framerate, channels, dtype, streamBits, _ = readWAVHeader(process.stdout)
+            if analyzers is None:
+                formatMin, formatMax = getFormatLimits(dtype, bits or streamBits)
+                analyzers = [factory(channels, formatMin, formatMax) for factory in analyzerFactories]
+                for analyzer in analyzers:
+                    analyzer.framerate = framerate
+            if start is not None:
+                for analyzer in analyzers:
+                    analyzer.seek(round(start * framerate))
+
+            for block in iterStreamBlocks(process.stdout, channels, dtype, blockSize):
+                feedBlock(analyzers, block, formatMin, formatMax)
+                if all(analyzer.done for analyzer in analyzers):
+                    process.kill()
+                    break
+        finally:
+            process.stdout.close()
+            process.wait()
+            if feeder is not None:
+                feeder.join()
+                if len(feedErrors) > 0:
+                    raise feedErrors[0] # e.g. the download failed, which also cut the decoded stream short
+
+        if all(analyzer.done for analyzer in analyzers):
+            break
+
+    return framerate, analyzers
+
+
+def feedProcess(feed, stdin, errors: list):
+    """
+    Runs the **feed** of analyzeStream on the stdin of ffmpeg, then closes it so that ffmpeg sees the end of its input.
+    Exceptions are added to **errors**, for analyzeStream to raise them again.
+    """
+    try:
+        feed(stdin)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError: # ffmpeg already exited
+            pass
+
+
+def openWAVMemmap(wav_filepath: Path) -> Tuple[int, int, np.memmap]:
+    """
+    Memory-maps the sample data of a local WAV file without reading it.
+    Returns (framerate, bits per sample, (samples x channels) memmap).
+    24-bit files are mapped as raw bytes with shape (samples x channels x 3), use iterWAVBlocks to read them.
+    """
+    with open(wav_filepath, 'rb') as f:
+        framerate, channels, dtype, bits, dataSize = readWAVHeader(f)
+        dataOffset = f.tell()
+
+    sampleSize = 3 if bits == 24 else dtype.itemsize
+    dataSize = min(dataSize, os.path.getsize(wav_filepath) - dataOffset)
+    frames = dataSize // (channels * sampleSize)
+    if frames == 0:
+        raise QoCException("ERROR: WAV file does not contain any audio.")
+
+    if bits == 24:
+        data = np.memmap(wav_filepath, dtype=np.uint8, mode='r', offset=dataOffset, shape=(frames, channels, 3))
+    else:
+        data = np.memmap(wav_filepath, dtype=dtype, mode='r', offset=dataOffset, shape=(frames, channels))
+
+    return framerate, bits, data
+
+
+def iterWAVBlocks(data: np.memmap, bits: int, blockSize: int = STREAM_BLOCK_SIZE):
+    """
+    Yields (samples x channels) blocks copied from a WAV memmap opened with openWAVMemmap.
+    The same buffer is reused for every block, so consumers must copy anything they want to keep.
+    """
+    frames, channels = data.shape[:2]
+    buffer = np.empty((min(blockSize, frames), channels), dtype=np.int32 if bits == 24 else data.dtype)
+
+    for start in range(0, frames, blockSize):
+        block = buffer[:min(blockSize, frames - start)]
+        if bits == 24:
+            # Put the 3 bytes of each sample in the upper bytes of an int32, as scipy does
+            raw = block.view(np.uint8).reshape(block.shape + (4,))
+            raw[..., 0] = 0
+            raw[..., 1:] = data[start:start + block.shape[0]]
+        else:
+            block[:] = data[start:start + block.shape[0]]
+        yield block
+
+
+def analyzeWAV(wav_filepath: Path, analyzerFactories: list, blockSize: int = STREAM_BLOCK_SIZE) -> Tuple[int, list]:
+    """
+    Memory-maps a local WAV file and analyzes it block by block, so that it never has to fit in memory.
+    A first pass finds the max/min value of each channel and how many times they occur,
+    then a second pass feeds the blocks to the analyzers, until all of them are done.
+    - **analyzerFactories**: Callables (channels, formatMin, formatMax) -> BlockAnalyzer.
+
+    Returns the framerate and the analyzers, in the same order as the factories.
+    """
+    framerate, bits, data = openWAVMemmap(wav_filepath)
+    dtype = np.dtype(np.int32) if bits == 24 else data.dtype
+    formatMin, formatMax = getFormatLimits(dtype, bits)
+
+    maxVals = np.full(data.shape[1], formatMin, dtype=dtype)
+    minVals = np.full(data.shape[1], formatMax, dtype=dtype)
+    maxCounts = np.zeros(data.shape[1], dtype=np.int64)
+    minCounts = np.zeros(data.shape[1], dtype=np.int64)
+    for block in iterWAVBlocks(data, bits, blockSize):
+        block.clip(formatMin, formatMax, out=block)
+        blockMax = block.max(axis=0)
+        blockMin = block.min(axis=0)
+        maxCounts[blockMax > maxVals] = 0
+        minCounts[blockMin < minVals] = 0
+        np.maximum(maxVals, blockMax, out=maxVals)
+        np.minimum(minVals, blockMin, out=minVals)
+        maxCounts += np.count_nonzero(block == maxVals, axis=0)
+        minCounts += np.count_nonzero(block == minVals, axis=0)
+
+    analyzers = [factory(data.shape[1], formatMin, formatMax) for factory in analyzerFactories]
+    for analyzer in analyzers:
+        analyzer.framerate = framerate
+        analyzer.useExtremes(maxVals, minVals, maxCounts, minCounts)
+
+    for block in iterWAVBlocks(data, bits, blockSize):
+        if all(analyzer.done for analyzer in analyzers):
+            break
+        feedBlock(analyzers, block, formatMin, formatMax)
+
+    del data # close the memmap
+    return framerate, analyzers
+
+
+class BlockAnalyzer:
+    """
+    Base class for analyzers fed with blocks of samples by analyzeStream or analyzeWAV.
+    Keeps track of the max/min value of each channel, unless they are already known from a previous pass.
+    Analyzers set `done` once their result can no longer change, after which they are not fed any more blocks.
+    `framerate` is set by analyzeStream and analyzeWAV before the first block.
+    """
+    clipped = True # whether the blocks should be clipped to the format limits before being processed
+
+    def __init__(self, channels: int, formatMin, formatMax):
+        self.channels = channels
+        self.formatMin = formatMin
+        self.formatMax = formatMax
+        self.framerate = None
+        self.maxVals = None
+        self.minVals = None
+        self.fixedExtremes = False
+        self.done = False
+
+    def useExtremes(self, maxVals: np.ndarray, minVals: np.ndarray, maxCounts: np.ndarray = None, minCounts: np.ndarray = None):
+        """
+        Sets the final max/min values of each channel, computed beforehand,
+        optionally with how many samples of each channel are at these values.
+        """
+        self.maxVals = maxVals
+        self.minVals = minVals
+        self.fixedExtremes = True
+
+    def finalExtremes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns for each channel whether the current max and min are sure to be the final ones.
+        Running extremes only move outwards, so they are final once they reach the format limits.
+        """
+        if self.fixedExtremes:
+            return np.full(self.channels, True), np.full(self.channels, True)
+        return self.maxVals == self.formatMax, self.minVals == self.formatMin
+
+    def updateExtremes(self, block: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Updates the running max/min values with a block.
+        Returns for each channel whether the max and the min changed.
+        """
+        if self.fixedExtremes:
+            return np.full(self.channels, False), np.full(self.channels, False)
+
+        blockMax = block.max(axis=0)
+        blockMin = block.min(axis=0)
+        if self.maxVals is None:
+            self.maxVals, self.minVals = blockMax, blockMin
+            return np.full(self.channels, True), np.full(self.channels, True)
+
+        newMax = blockMax > self.maxVals
+        newMin = blockMin < self.minVals
+        self.maxVals = np.maximum(self.maxVals, blockMax)
+        self.minVals = np.minimum(self.minVals, blockMin)
+        return newMax, newMin
+
+    def seek(self, offset: int):
+        """
+        Called when the next block does not follow the previous one but starts at sample **offset** of the file,
+        when only some windows of it are analyzed. Nothing may carry over from one window to the next.
+        """
+        raise NotImplementedError
+
+    def process(self, block: np.ndarray):
+        raise NotImplementedError
+
+
+class WindowedAnalyzer(BlockAnalyzer):
+    """
+    Base class for analyzers of windows of `windowSize` samples of the mono mix, starting every `stride` samples of the stream.
+    The windows of each block are given at once to `processWindows`, as a (windows x windowSize) strided view.
+    Only the samples of the next window that are already available are kept between blocks.
+    """
+    def __init__(self, channels: int, formatMin, formatMax, windowSize: int = None, stride: int = None):
+        super().__init__(channels, formatMin, formatMax)
+        self.windowSize = windowSize
+        self.stride = stride
+        self.windows = 0
+        self.samples = 0
+        self.pending = np.empty(0, dtype=np.float32)
+        self.pendingStart = 0 # position of the first pending sample in the stream
+        self.nextWindow = 0   # position of the start of the next window in the stream
+
+    def seek(self, offset: int):
+        self.pending = np.empty(0, dtype=np.float32)
+        self.pendingStart = offset
+        self.nextWindow = offset
+
+    def process(self, block: np.ndarray):
+        """
+        - **block**: (samples x channels) array.
+        """
+        self.samples += len(block)
+        mono = block.mean(axis=1, dtype=np.float32) / np.float32(getFullScale(block.dtype))
+        data = np.concatenate((self.pending, mono))
+        first = self.nextWindow - self.pendingStart
+        if len(data) >= self.windowSize + first:
+            windows = np.lib.stride_tricks.sliding_window_view(data, self.windowSize)[first::self.stride]
+            self.processWindows(windows)
+            self.windows += len(windows)
+            self.nextWindow += len(windows) * self.stride
+
+        keepFrom = min(self.nextWindow - self.pendingStart, len(data))
+        self.pending = data[keepFrom:]
+        self.pendingStart += keepFrom
+
+    def processWindows(self, windows: np.ndarray):
+        raise NotImplementedError
+
+
+#=======================================#
+#          LOCAL DIRECTORIES            #
+#=======================================#
+"""
+Every QoC job downloads and converts its files in a directory of its own, so jobs running at once never share a path
+(e.g. two rips both sent as video0.mp4, or two temporary WAV files).
+The caches live in CACHE_DIR, which is kept between runs.
+"""
+
+def setCacheDir(directory: str):
+    """
+    Moves the download, feature, verdict and fingerprint caches to **directory**.
+    Whatever was cached in the previous directory is left there, not moved.
+    """
+    global CACHE_DIR, DOWNLOAD_CACHE_DIR, FEATURE_CACHE_DIR, VERDICT_CACHE_PATH, FINGERPRINT_DIR
+    CACHE_DIR = Path(directory)
+    DOWNLOAD_CACHE_DIR = CACHE_DIR / 'downloads'
+    FEATURE_CACHE_DIR = CACHE_DIR / 'features'
+    VERDICT_CACHE_PATH = CACHE_DIR / 'verdicts.sqlite3'
+    FINGERPRINT_DIR = CACHE_DIR / 'fingerprints'
+
+
+@contextmanager
+def scratchDir():
+    """
+    Context manager creating a new directory of DOWNLOAD_DIR for the files of one job,
+    and removing it with everything left in it when the job ends, whether it succeeded or not.
+    """
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    directory = Path(tempfile.mkdtemp(prefix=SCRATCH_DIR_PREFIX, dir=DOWNLOAD_DIR))
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def clearScratchDirs():
+    """
+    Removes the scratch directories, and the loose files of DOWNLOAD_DIR, left behind by jobs that never finished
+    (e.g. when the bot was killed). The caches are kept. Only call this at startup, before any job runs.
+    """
+    if not DOWNLOAD_DIR.exists():
+        return
+    for path in DOWNLOAD_DIR.iterdir():
+        if path.is_dir():
+            if path.name.startswith(SCRATCH_DIR_PREFIX):
+                shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+
+
 #=======================================#
 #           URL DOWNLOADING             #
 #=======================================#
@@ -145,25 +716,65 @@ def parseUrl(url: str) -> str:
     return url
 
 # https://stackoverflow.com/questions/38511444/python-download-files-from-google-drive-using-url
-def save_response_content(response, destination):
+def save_response_content(response, destination, validUrl: str = None) -> str:
+    """
+    Returns the SHA-256 of the saved contents, as hex.
+    - **validUrl**: URL of the response, to resume the download if the connection drops (see iterResponseChunks).
+    """
     CHUNK_SIZE = 32768
 
+    sha = hashlib.sha256()
     with open(destination, "wb") as f:
-        for chunk in response.iter_content(CHUNK_SIZE):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
+        for chunk in iterResponseChunks(response, validUrl, CHUNK_SIZE):
+            f.write(chunk)
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
-def getResponseFromUrl(validUrl: str, head: bool = False):
-    try:
+httpAdapter = None          # connection pools shared by the sessions of all threads, see getSession
+httpSessions = threading.local()
+
+def setHTTPPoolSize(size: int):
+    """
+    Sets how many connections to each host are kept alive, which should be the number of threads downloading rips at once.
+    More threads than this still work, but their connections are closed after each request.
+    """
+    global HTTP_POOL_SIZE, httpAdapter
+    if size < 1:
+        raise ValueError('At least one connection per host is needed')
+    HTTP_POOL_SIZE = size
+    httpAdapter = None
+
+
+def getSession() -> requests.Session:
+    """
+    Returns the requests session of the calling thread. Sessions are not thread-safe, so each thread has its own,
+    but they share the same connection pools (which are thread-safe), so TCP and TLS handshakes happen once per host and connection.
+    """
+    global httpAdapter
+    if httpAdapter is None:
+        httpAdapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+
+    session = getattr(httpSessions, 'session', None)
+    if session is None or session.get_adapter('https://') is not httpAdapter:
         session = requests.Session()
+        session.mount('https://', httpAdapter)
+        session.mount('http://', httpAdapter)
         # https://stackoverflow.com/questions/33174804/python-requests-getting-connection-aborted-badstatusline-error
-        headers = { 'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36' }
-        
+        session.headers['User-Agent'] = HTTP_USER_AGENT
+        httpSessions.session = session
+    return session
+
+
+def getResponseFromUrl(validUrl: str, head: bool = False, headers: dict = None):
+    try:
+        session = getSession()
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
         if head:
-            response = session.head(validUrl, stream=True, headers=headers)
+            response = session.head(validUrl, headers=headers, timeout=timeout) # not streamed, so the connection goes straight back to the pool
         else:
-            response = session.get(validUrl, stream=True, headers=headers)
+            response = session.get(validUrl, stream=True, headers=headers, timeout=timeout)
 
         return response
     
@@ -182,205 +793,1008 @@ def getHeadFromUrl(validUrl: str):
     return getResponseFromUrl(validUrl, True).headers
 
 
-def downloadAudioFromUrl(validUrl: str) -> str:
-    filepath = None
+def downloadAudioFromUrl(validUrl: str, useCache: bool = True, directory: Path = None) -> str:
+    """
+    Downloads a file and returns its path. The caller removes the file when done with it.
+    - **useCache**: Reuse the copy in the download cache if the server confirms it is unchanged, and cache new downloads.
+    - **directory**: Where to save the file, by default DOWNLOAD_DIR. Jobs that may run at once should use a scratchDir.
+    """
+    return downloadAudio(validUrl, useCache, directory)[0]
+
+
+def downloadAudio(validUrl: str, useCache: bool = True, directory: Path = None) -> Tuple[str, str]:
+    """
+    Same as downloadAudioFromUrl, also returning the validator of the downloaded file (see downloadValidator).
+    """
+    entry = loadDownloadEntry(validUrl) if useCache else None
+    response = getResponseFromUrl(validUrl, headers=conditionalHeaders(entry))
+    return saveDownload(validUrl, response, entry, useCache, directory), downloadValidator(response.status_code, response.headers, entry)
+
+
+def saveDownload(validUrl: str, response, entry: dict, useCache: bool, directory: Path = None) -> str:
+    """
+    Saves the file sent in a response to downloadAudioFromUrl, or links the cached file if **entry** is still fresh.
+    """
+    if directory is None:
+        directory = DOWNLOAD_DIR
+    try:
+        if entry is not None and downloadIsFresh(response.status_code, response.headers, entry):
+            return reuseCachedDownload(entry, directory)
+
+        text = response.text if 'html' in response.headers.get('Content-Type', '') else None
+        filepath = directory / getResponseFilename(validUrl, response.headers, text)
+        contentHash = save_response_content(response, filepath, validUrl)
+    finally:
+        response.close()    # hands the connection back to the pool
+
+    if useCache:
+        cacheDownload(validUrl, response.headers, filepath, contentHash)
+    
+    DEBUG('Downloaded filepath: {}'.format(filepath))
+    return filepath
+
 
-    response = getResponseFromUrl(validUrl)
+def getResponseFilename(validUrl: str, headers, text: str = None) -> str:
+    """
+    Returns the name of the file sent in a response.
+    - **text**: Body of the response, needed to report errors from HTML pages.
+    """
     try:
         # apparently cgi is deprecated? may need to change to email.message
         # https://stackoverflow.com/questions/32330152/how-can-i-parse-the-value-of-content-type-from-an-http-header-response
-        _, params = cgi.parse_header(response.headers['Content-Disposition'])
+        _, params = cgi.parse_header(headers['Content-Disposition'])
         filename = params['filename']
     except KeyError:
-        if not ('audio' in response.headers['Content-Type'] or 'video' in response.headers['Content-Type']):
-            if 'html' in response.headers['Content-Type']:
-                text = response.text
-                title = re.search(r'<\W*title\W*(.*)</title', text, re.IGNORECASE)
+        if not ('audio' in headers['Content-Type'] or 'video' in headers['Content-Type']):
+            if 'html' in headers['Content-Type']:
+                title = re.search(r'<\W*title\W*(.*)</title', text or '', re.IGNORECASE)
                 raise QoCException('Filename cannot be parsed from the URL (server response: {}).'.format(title.group(1) if title else None))
             else:
                 raise QoCException('Unknown error trying to parse filename.')
         filename = validUrl.split('/')[-1]
     
-    filename = filename.replace('/', '_')
-    filepath = DOWNLOAD_DIR / filename
-    save_response_content(response, filepath)
-    
-    DEBUG('Downloaded filepath: {}'.format(filepath))
-    return filepath
-
-
-def parseAudio(filepath: str) -> FileType:
-    return File(filepath)
+    return filename.replace('/', '_')
 
 
-#=======================================#
-#           BITRATE CHECKING            #
-#=======================================#
-
-def checkBitrateFromFile(file: FileType) -> Tuple[bool, str]:
+def downloadAudioHeadFromUrl(validUrl: str, directory: Path = None) -> str:
     """
-    Check the bitrate of a mutagen File.
-    Requires either lossless format or the metadata contains bitrate information.
-    If not, raises QoCException with the file metadata.
+    Downloads only the start and end of a file with Range requests, into a sparse file of the full size, and returns its path.
+    That is enough for mutagen to read the headers and tags (e.g. for checkBitrateFromFile or pprint), but not to decode the audio.
+    - **directory**: Where to save the file, see downloadAudioFromUrl.
+
+    Falls back to downloadAudioFromUrl if the file is in the download cache, or mutagen cannot parse the partial file.
+    If the server ignores Range, the whole file it sends instead is saved.
     """
-    if isinstance(file, wave.WAVE) or isinstance(file, flac.FLAC):
-        return (True, "Lossless file is OK.")
-    
-    # seems video files show lower bitrate on properties view for some reason, shouldn't be an issue generally
-    if hasattr(file.info, 'bitrate'):
-        bitrate = file.info.bitrate
-        if bitrate == 0:      # Some MP4 files have 0 kbps bitrate?
-            return (True, "Bitrate is OK (0 kbps detected).")
-        elif bitrate < 300000:    # Apparently some weird files can have bitrate at 317kbps or even 319.999kbps. Let's say 300k is good enough
-            return (False, "The {} file's bitrate is {}kbps. Please re-render at 320kbps.".format(type(file).__name__, bitrate // 1000))
-        else:
-            return (True, "Bitrate is OK.")
-    
-    raise QoCException("ERROR: Unknown bitrate. File metadata: {}".format(file.pprint()))
+    return downloadAudioHead(validUrl, directory)[0]
 
 
-def checkBitrateFromUrl(validUrl: str) -> Tuple[bool, str]:
+def downloadAudioHead(validUrl: str, directory: Path = None) -> Tuple[str, bool, str]:
     """
-    Check the bitrate of an URL by first finding the type of media
-    If media is wav or flac, no need to do anything further.
-    Otherwise, use ffprobe to download and check bitrate.
+    Same as downloadAudioHeadFromUrl, also returning whether only the start and end of the file were downloaded,
+    and the validator of the file (see downloadValidator).
     """
-    contentType = getHeadFromUrl(validUrl)['Content-Type'].lower()
-    if 'wav' in contentType or 'flac' in contentType:
-        return (True, "Lossless file is OK.")
-    
+    if loadDownloadEntry(validUrl) is not None:
+        filepath, validator = downloadAudio(validUrl, directory=directory)
+        return filepath, False, validator
+
+    response = getResponseFromUrl(validUrl, headers={'Range': 'bytes=0-{}'.format(PARTIAL_HEAD_BYTES - 1)})
+    if response.status_code != 206:
+        return saveDownload(validUrl, response, None, True, directory), False, responseValidator(response.status_code, response.headers)
+    match = re.fullmatch(r'bytes 0-\d+/(\d+)', response.headers.get('Content-Range', ''))
+    if match is None:
+        response.close()
+        filepath, validator = downloadAudio(validUrl, directory=directory)
+        return filepath, False, validator
+
+    size = int(match.group(1))
+    # validators of the whole file, which is Content-Length bytes long in a 200 response
+    headers = requests.structures.CaseInsensitiveDict(response.headers)
+    headers['Content-Length'] = str(size)
+    validator = responseValidator(200, headers)
     try:
-        probeOutput = ffprobeUrl(validUrl)
-        bitrate = int(probeOutput['streams'][0]['bit_rate'])
-    except KeyError:
-        # seems FLAC does not contain this info but it should have been skipped anyway
-        raise QoCException("ERROR: Bitrate cannot be detected from ffprobe output:\n{}".format(probeOutput))
-    except ValueError:
-        raise QoCException("ERROR: Bitrate cannot be parsed from ffprobe output:\n{}".format(probeOutput))
+        filepath = (directory or DOWNLOAD_DIR) / getResponseFilename(validUrl, response.headers)
+        with open(filepath, 'wb') as f:
+            f.truncate(size)    # the missing middle reads as zeros, without taking disk space
+        saveResponseRange(response, filepath, 0)
+    finally:
+        response.close()
 
+    file = None
     try:
-        filetype = probeOutput['format']['format_name'].upper()
-    except KeyError:
-        filetype = "[TYPE UNKNOWN]"
+        tailStart = max(PARTIAL_HEAD_BYTES, size - PARTIAL_TAIL_BYTES)
+        tailFetched = tailStart >= size
+        if not tailFetched:
+            # the tail is only sent if the file did not change since its head was
+            response = getResponseFromUrl(validUrl, headers=resumeHeaders(tailStart, headers.get('ETag') or headers.get('Last-Modified')))
+            try:
+                tailFetched = isResumed(response.status_code, response.headers, tailStart)
+                if tailFetched:
+                    saveResponseRange(response, filepath, tailStart)
+            finally:
+                response.close()
+        if tailFetched:
+            file = parseAudio(filepath)
+    except MutagenError:
+        pass
+    finally:
+        if file is None and os.path.exists(filepath):
+            os.remove(filepath)
+    if file is None:
+        DEBUG('Partial download could not be parsed, downloading all of it')
+        filepath, validator = downloadAudio(validUrl, directory=directory)
+        return filepath, False, validator
 
-    if bitrate == 0:      # Some MP4 files have 0 kbps bitrate?
-        return (True, "Bitrate is OK (0 kbps detected).")
-    elif bitrate < 300000:    # Apparently some weird files can have bitrate at 317kbps or even 319.999kbps. Let's say 300k is good enough
-        return (False, "The {} file's bitrate is {}kbps. Please re-render at 320kbps.".format(filetype, bitrate // 1000))
-    else:
-        return (True, "Bitrate is OK.")
+    DEBUG('Downloaded the headers of: {}'.format(filepath))
+    return filepath, True, validator
 
 
-#=======================================#
-#           CLIPPING CHECKING           #
-#=======================================#
+def downloadSampledRip(validUrl: str, directory: Path = None) -> Tuple[str, str, str]:
+    """
+    Downloads what a sampled QoC needs of a rip. If it is long enough to be sampled (see getTriageWindows),
+    only its start and end are downloaded (see downloadAudioHead), and ffmpeg decodes the windows straight from
+    the URL with Range requests. Otherwise, or if the server does not support Range, the whole rip is downloaded.
 
-# https://stackoverflow.com/a/24892274
-def sameValueRuns(arr: np.ndarray, value) -> np.ndarray:
-    # Create an array that is 1 where a is value, and pad each end with an extra 0.
-    iszero = np.concatenate(([0], np.equal(arr, value), [0]))
-    absdiff = np.abs(np.diff(iszero))
-    # Runs start and end where absdiff is 1.
-    ranges = np.where(absdiff == 1)[0].reshape(-1, 2)
-    return ranges
-
-def getClipping(channel: np.ndarray, ceiling, threshold: int) -> list:
-    clipSamples = []
-    runs = sameValueRuns(channel, ceiling)
-    for run in runs:
-        if run[1] - run[0] >= threshold:
-            clipSamples.append(run)
-    return clipSamples
-
-def channelHasClipping(channel: np.ndarray, max, min, threshold: int) -> list:
-    return getClipping(channel, max, threshold) + getClipping(channel, min, threshold)
-    
+    Returns the path of the file, the URL to decode it from, or None if the file was downloaded whole,
+    and the validator of the file (see downloadValidator).
+    """
+    filepath, partial, validator = downloadAudioHead(validUrl, directory)
+    if not partial:
+        return filepath, None, validator
+    if getTriageWindows(getattr(parseAudio(filepath).info, 'length', 0)) is not None:
+        return filepath, validUrl, validator
+    os.remove(filepath)
+    filepath, validator = downloadAudio(validUrl, directory=directory)
+    return filepath, None, validator
 
-def checkClipping(wav_filepath: Path, threshold: int, doGradientAnalysis: bool) -> Tuple[bool, str]:
+
+def saveResponseRange(response, filepath: Path, offset: int):
     """
-    Checks whether a WAV file is clipping (waveform contains "flat" peaks).
-    - **wav_filepath**: Path to a local WAV file.
-    - **threshold**: How many consecutive samples to look for. Recommended value: 3.
-    - **doGradientAnalysis**: Set to True if the waveform may contain overflows.
+    Writes a response body into an existing file, from **offset**.
     """
-    wavFile = parseAudio(wav_filepath)
+    CHUNK_SIZE = 32768
 
-    clips = []
-    framerate, data = wavfile.read(wav_filepath)
+    try:
+        with open(filepath, 'r+b') as f:
+            f.seek(offset)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+    except requests.exceptions.RequestException as e:
+        os.remove(filepath)
+        raise QoCException('Connection error. {}'.format(e))
 
-    # Special case: 24-bit FLACs can go over sample limit and cause overflow/underflow,
-    # apply specialized algorithm to check for clicking instead.
-    if doGradientAnalysis:
-        data_deriv = np.gradient(data, axis=0)
-        maxG = np.max(data_deriv)
-        minG = np.min(data_deriv)
-        DEBUG('G: Max: {}, Min: {}'.format(maxG, minG))
 
-        # TODO: fine tune arbitrarily chosen threshold
-        # it may be possible to use 'and' since overflow/underflow will create large gradient both ways
-        if maxG > 0.8 or minG < -0.8:
-            return (False, "Detected large gradient. Please verify clipping in Audacity.")
-        else:
-            return (True, "The rip is not clipping.")
+def canPipelineResponse(status: int, headers) -> bool:
+    """
+    Whether the file sent in a response can be decoded while it downloads, see downloadAudioWithFeaturesFromUrl.
+    Its size is needed to parse its headers from the first chunks, and error pages are left to saveDownload to report.
+    """
+    return status == 200 and 'Content-Length' in headers and 'html' not in headers.get('Content-Type', '')
 
-    # +1 to min in order to mimic Audacity's Find Clipping algorithm,
-    # even though WAV samples can technically go lower
-    limits = {
-        16: (-2**15     +1,     2**15-1     ),
-        24: (-2**31     +1,     2147483392  ),
-        32: (-2**31     +1,     2**31-1     ),
-    }
 
-    # Apparently WAV 32-bit float can go over +-1.0
-    if data.dtype == np.float32:
-        data.clip(-1.0, 1.0, out=data)
-    else:
-        data.clip(limits[wavFile.info.bits_per_sample][0], limits[wavFile.info.bits_per_sample][1], out=data)
+hostFailures = {}   # downloads from each host key that dropped since one last completed, see hostBackoff
+hostFailuresLock = threading.Lock()
 
-    # If audio is mono, reshape data for consistency
-    if data.ndim == 1:
-        data = data[:,None]
+def hostBackoff(validUrl: str) -> float:
+    """
+    Records a dropped download from the host of a URL, and returns how long to wait before resuming it:
+    DOWNLOAD_BACKOFF_SECONDS, doubled for each other download from that host that dropped since one last completed.
+    """
+    key = getHostKey(validUrl)
+    with hostFailuresLock:
+        failures = hostFailures.get(key, 0)
+        hostFailures[key] = failures + 1
+    return min(DOWNLOAD_MAX_BACKOFF_SECONDS, DOWNLOAD_BACKOFF_SECONDS * 2 ** failures)
 
-    # Find max and min values in case someone tries to fix clipping in Audacity
-    maxVals = data.max(axis=0)
-    minVals = data.min(axis=0)
 
-    DEBUG('Data type: {}'.format(data.dtype))
-    DEBUG('Max: {}'.format(maxVals))
-    DEBUG('Min: {}'.format(minVals))
+def hostRecovered(validUrl: str):
+    with hostFailuresLock:
+        hostFailures.pop(getHostKey(validUrl), None)
 
-    debugClipSamples = []
-    upperClip = np.full(maxVals.shape, False)
-    lowerClip = np.full(minVals.shape, False)
-
-    clipSamples = []
-    for c in range(maxVals.size):
-        samples = channelHasClipping(data[:, c], maxVals[c], minVals[c], threshold)
-        for s in samples:
-            upperClip[c] = upperClip[c] or (data[s[0], c] == maxVals[c])
-            lowerClip[c] = lowerClip[c] or (data[s[0], c] == minVals[c])
-            debugClipSamples.append((s[0] / framerate, data[s[0]:s[1], 0]))
-        clipSamples.extend(samples)
-
-    for d in debugClipSamples:
-        DEBUG(d)
-
-    clipSamples.sort(key = lambda x: (x[0], x[1])) # Sort by time for viewing purpose
-    for clipSample in clipSamples:
-        clips.append('{:.2f} sec ({} samples)'.format(clipSample[0] / framerate, clipSample[1] - clipSample[0]))
-    
-    if len(clips) > 0:
+
+def resumeDelay(validUrl: str, retries: int, deadline: float) -> float:
+    """
+    Returns how long to wait before resuming a dropped download (see hostBackoff), or None if it should not be resumed:
+    it already was DOWNLOAD_RETRIES times, or it would be resumed after its **deadline** (see time.monotonic).
+    """
+    if validUrl is None or retries >= DOWNLOAD_RETRIES:
+        return None
+    delay = hostBackoff(validUrl)
+    if time.monotonic() + delay > deadline:
+        return None
+    return delay
+
+
+def resumeHeaders(received: int, validator: str) -> dict:
+    """
+    Headers requesting the rest of a file from byte **received**, unless it changed since its **validator** (ETag or Last-Modified).
+    """
+    headers = {'Range': 'bytes={}-'.format(received)}
+    if validator is not None:
+        headers['If-Range'] = validator
+    return headers
+
+
+def isResumed(status: int, headers, received: int) -> bool:
+    return status == 206 and headers.get('Content-Range', '').startswith('bytes {}-'.format(received))
+
+
+def iterResponseChunks(response, validUrl: str = None, chunkSize: int = 32768):
+    """
+    Yields the body of a streamed response, raising a QoCException if the connection drops or times out.
+    - **validUrl**: URL of the response, to request the rest of the file from where it stopped instead, see resumeDelay.
+    If the server does not answer with that range (e.g. the file changed), the download fails as if it was not resumed.
+    """
+    deadline = time.monotonic() + DOWNLOAD_TIME_BUDGET
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    received = 0
+    retries = 0
+    part = response
+    while True:
+        try:
+            for chunk in part.iter_content(chunkSize):
+                if chunk:  # filter out keep-alive new chunks
+                    received += len(chunk)
+                    yield chunk
+            break
+        except requests.exceptions.RequestException as e:
+            error = QoCException('Connection error. {}'.format(e))
+        finally:
+            if part is not response:
+                part.close()
+
+        part = None
+        while part is None:
+            delay = resumeDelay(validUrl, retries, deadline)
+            if delay is None:
+                raise error
+            retries += 1
+            DEBUG('Download dropped after {} bytes, resuming in {}s'.format(received, delay))
+            time.sleep(delay)
+            try:
+                part = getResponseFromUrl(validUrl, headers=resumeHeaders(received, validator))
+            except QoCException as e:
+                error = e
+                continue
+            if not isResumed(part.status_code, part.headers, received):
+                part.close()
+                raise error
+
+    if validUrl is not None:
+        hostRecovered(validUrl)
+
+
+def teeChunks(chunks, destination: Path, stdin = None) -> str:
+    """
+    Writes chunks of a response body to an existing file, from its start, and to the stdin of a process as they arrive.
+    The process may exit before the end (e.g. once its output is not needed anymore), the rest is still written to the file.
+    Returns the SHA-256 of the contents, as hex.
+    """
+    sha = hashlib.sha256()
+    with open(destination, 'r+b') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            sha.update(chunk)
+            if stdin is not None:
+                try:
+                    stdin.write(chunk)
+                except BrokenPipeError:
+                    stdin = None
+        f.truncate()
+    return sha.hexdigest()
+
+
+def parseAudio(filepath: str) -> FileType:
+    return File(filepath)
+
+
+#=======================================#
+#            DOWNLOAD CACHE             #
+#=======================================#
+"""
+Downloads are kept in DOWNLOAD_CACHE_DIR, so that checking the same rip again (e.g. !vet then !peek_msg) does not download it again:
+- `files/<SHA-256 of the contents>`: the downloaded files. Files with the same contents are stored once, whatever their URL.
+- `urls/<SHA-256 of the URL>.json`: the file last downloaded from each (parsed) URL, with the validators the server sent for it.
+
+A cached file is only reused after a conditional request: the server answers 304 Not Modified, or its ETag, Last-Modified
+and Content-Length headers (whichever it sends) match those of the cached download.
+"""
+
+VALIDATOR_HEADERS = {'etag': 'ETag', 'lastModified': 'Last-Modified', 'contentLength': 'Content-Length'}
+
+def downloadCachePath(contentHash: str) -> Path:
+    return DOWNLOAD_CACHE_DIR / 'files' / contentHash
+
+
+def downloadEntryPath(validUrl: str) -> Path:
+    return DOWNLOAD_CACHE_DIR / 'urls' / '{}.json'.format(hashlib.sha256(validUrl.encode('utf-8')).hexdigest())
+
+
+def loadDownloadEntry(validUrl: str) -> dict:
+    """
+    Returns the cache entry of the file last downloaded from a URL, or None if it is not cached anymore.
+    """
+    path = downloadEntryPath(validUrl)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        DEBUG('Dropping unreadable download entry {}: {}'.format(path.name, e))
+        path.unlink(missing_ok=True)
+        return None
+
+    if entry.get('url') != validUrl or not downloadCachePath(entry['hash']).exists():
+        return None
+    return entry
+
+
+def conditionalHeaders(entry: dict) -> dict:
+    if entry is None:
+        return None
+    headers = {}
+    if entry['etag'] is not None:
+        headers['If-None-Match'] = entry['etag']
+    if entry['lastModified'] is not None:
+        headers['If-Modified-Since'] = entry['lastModified']
+    return headers
+
+
+def downloadIsFresh(status: int, headers, entry: dict) -> bool:
+    """
+    Whether the response to a conditional request shows that the cached download is still what the server has.
+    """
+    if status == 304:
+        return True
+    if status != 200:
+        return False
+    matched = False
+    for key, header in VALIDATOR_HEADERS.items():
+        value = headers.get(header)
+        if value is not None and entry[key] is not None:
+            if value != entry[key]:
+                return False
+            matched = True
+    return matched
+
+
+def downloadValidator(status: int, headers, entry: dict = None) -> str:
+    """
+    Returns the validator of the file saved from the response to a download (see responseValidator),
+    which is that of the cached file if the response shows that **entry** is still fresh.
+    """
+    if entry is not None and downloadIsFresh(status, headers, entry):
+        return responseValidator(200, {header: entry[key] for key, header in VALIDATOR_HEADERS.items()})
+    return responseValidator(status, headers)
+
+
+def reuseCachedDownload(entry: dict, directory: Path = None) -> Path:
+    filepath = (directory or DOWNLOAD_DIR) / entry['filename']
+    linkFile(downloadCachePath(entry['hash']), filepath)
+    os.utime(downloadCachePath(entry['hash'])) # mark as recently used
+    DEBUG('Reused cached download: {}'.format(filepath))
+    return filepath
+
+
+def linkFile(source: Path, destination: Path):
+    """
+    Makes **destination** a hard link to **source**, or a copy if links are not supported.
+    """
+    Path(destination).unlink(missing_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def cacheDownload(validUrl: str, headers, filepath: Path, contentHash: str):
+    """
+    Adds a new download to the download cache, unless its server sends no validators to check it against later.
+    """
+    entry = {key: headers.get(header) for key, header in VALIDATOR_HEADERS.items()}
+    if all(value is None for value in entry.values()):
+        return
+    entry.update(url=validUrl, filename=Path(filepath).name, hash=contentHash)
+
+    cachePath = downloadCachePath(contentHash)
+    cachePath.parent.mkdir(parents=True, exist_ok=True)
+    if not cachePath.exists():
+        tempPath = cachePath.with_suffix('.tmp{}'.format(threading.get_ident()))
+        linkFile(filepath, tempPath)
+        os.replace(tempPath, cachePath)
+
+    entryPath = downloadEntryPath(validUrl)
+    entryPath.parent.mkdir(parents=True, exist_ok=True)
+    tempPath = entryPath.with_suffix('.tmp{}'.format(threading.get_ident()))
+    with open(tempPath, 'w', encoding='utf-8') as f:
+        json.dump(entry, f)
+    os.replace(tempPath, entryPath)
+    evictDownloadCache()
+
+
+def evictDownloadCache(maxBytes: int = None):
+    """
+    Removes the least recently used downloads until the cache is at most **maxBytes** (default DOWNLOAD_CACHE_MAX_BYTES).
+    The entries of their URLs are dropped the next time they are looked up.
+    """
+    if maxBytes is None:
+        maxBytes = DOWNLOAD_CACHE_MAX_BYTES
+    entries = []
+    for path in (DOWNLOAD_CACHE_DIR / 'files').glob('*'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+#=======================================#
+#          ASYNC DOWNLOADING            #
+#=======================================#
+"""
+asyncio variants of the download functions, using aiohttp, so that the bot can wait on the network from its event loop
+and keep executor threads for the analysis. Requests to each host are limited by HOST_CONCURRENCY, on top of
+the connections aiohttp opens per host (HTTP_POOL_SIZE).
+"""
+
+asyncSession = None     # aiohttp session of asyncLoop, see getAsyncSession
+asyncLoop = None
+hostSemaphores = {}     # semaphore of each host key, see getHostKey
+
+async def getAsyncSession():
+    """
+    Returns the aiohttp session of the running event loop. Sessions and semaphores belong to a loop, so they are replaced
+    if a different loop asks for them. The session of the previous loop is then closed.
+    """
+    global asyncSession, asyncLoop, hostSemaphores
+    if aiohttp is None:
+        raise QoCException('ERROR: aiohttp is needed to download asynchronously.')
+    loop = asyncio.get_running_loop()
+    if asyncSession is None or asyncSession.closed or asyncLoop is not loop:
+        previous, previousLoop = asyncSession, asyncLoop
+        asyncSession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=HTTP_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            headers={'User-Agent': HTTP_USER_AGENT},
+        )
+        asyncLoop = loop
+        hostSemaphores = {}
+        # replaced before waiting, so that other tasks of this loop get the new session meanwhile
+        session = asyncSession
+        if previous is not None and not previous.closed:
+            await retireAsyncSession(previous, previousLoop)
+        return session
+    return asyncSession
+
+
+async def retireAsyncSession(session, loop: asyncio.AbstractEventLoop):
+    """
+    Closes the session of an event loop that is no longer the one downloading.
+    """
+    if loop.is_running():
+        # e.g. a loop in another thread, the session can only be closed from there
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), loop))
+    elif loop.is_closed():
+        # the connections cannot be used anymore, closing only marks them closed
+        await session.close()
+    else:
+        # a stopped loop would have to run again to close its connections, leave them to it
+        session.detach()
+
+
+async def closeAsyncSession():
+    global asyncSession
+    if asyncSession is not None:
+        await asyncSession.close()
+        asyncSession = None
+
+
+def getHostKey(validUrl: str) -> str:
+    """
+    Returns the key of HOST_CONCURRENCY matching the host of a URL, or the host itself.
+    """
+    host = urlparse(validUrl).hostname or ''
+    return next((key for key in HOST_CONCURRENCY if host == key or host.endswith('.' + key)), host)
+
+
+def getHostSemaphore(validUrl: str) -> asyncio.Semaphore:
+    key = getHostKey(validUrl)
+    if key not in hostSemaphores:
+        hostSemaphores[key] = asyncio.Semaphore(HOST_CONCURRENCY.get(key, DEFAULT_HOST_CONCURRENCY))
+    return hostSemaphores[key]
+
+
+def asyncRequestError(e: Exception) -> QoCException:
+    """
+    Converts an aiohttp error to the QoCException getResponseFromUrl raises for the same problem.
+    """
+    if isinstance(e, asyncio.TimeoutError):
+        return QoCException('Request timed out. {}'.format(e))
+    if isinstance(e, aiohttp.TooManyRedirects):
+        return QoCException('Bad URL. {}'.format(e))
+    if isinstance(e, aiohttp.ClientConnectionError):
+        return QoCException('Connection error. {}'.format(e))
+    return QoCException('Unknown URL error. {}'.format(e))
+
+
+async def getUrlValidatorAsync(validUrl: str) -> str:
+    """
+    asyncio variant of getUrlValidator.
+    """
+    session = await getAsyncSession()
+    try:
+        async with getHostSemaphore(validUrl), session.head(validUrl) as response:
+            return responseValidator(response.status, response.headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def downloadAudioFromUrlAsync(validUrl: str, useCache: bool = True, directory: Path = None) -> str:
+    """
+    asyncio variant of downloadAudioFromUrl. The file is written as it arrives, see saveDownloadAsync.
+    """
+    return (await downloadAudioAsync(validUrl, useCache, directory))[0]
+
+
+async def downloadAudioAsync(validUrl: str, useCache: bool = True, directory: Path = None) -> Tuple[str, str]:
+    """
+    asyncio variant of downloadAudio.
+    """
+    session = await getAsyncSession()
+    entry = await asyncio.get_running_loop().run_in_executor(None, loadDownloadEntry, validUrl) if useCache else None
+    try:
+        async with getHostSemaphore(validUrl), session.get(validUrl, headers=conditionalHeaders(entry)) as response:
+            return await saveDownloadAsync(validUrl, response, entry, useCache, directory), downloadValidator(response.status, response.headers, entry)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise asyncRequestError(e)
+
+
+async def saveDownloadAsync(validUrl: str, response, entry: dict, useCache: bool, directory: Path = None) -> str:
+    """
+    asyncio variant of saveDownload, for an aiohttp response.
+    Chunks are gathered on the event loop, and written and hashed WRITE_SIZE bytes at a time in the loop's default executor,
+    like the rest of the file work, so that the loop is never blocked on the disk.
+    """
+    CHUNK_SIZE = 32768
+    WRITE_SIZE = 2**20
+    loop = asyncio.get_running_loop()
+
+    if directory is None:
+        directory = DOWNLOAD_DIR
+    if entry is not None and downloadIsFresh(response.status, response.headers, entry):
+        return await loop.run_in_executor(None, reuseCachedDownload, entry, directory)
+
+    text = await response.text() if 'html' in response.headers.get('Content-Type', '') else None
+    filepath = directory / getResponseFilename(validUrl, response.headers, text)
+    sha = hashlib.sha256()
+
+    def write(f, chunks: list):
+        data = b''.join(chunks)
+        f.write(data)
+        sha.update(data)
+
+    f = await loop.run_in_executor(None, open, filepath, 'wb')
+    try:
+        chunks = []
+        size = 0
+        async for chunk in iterResponseChunksAsync(response, validUrl, CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= WRITE_SIZE:
+                await loop.run_in_executor(None, write, f, chunks)
+                chunks = []
+                size = 0
+        await loop.run_in_executor(None, write, f, chunks)
+    finally:
+        await loop.run_in_executor(None, f.close)
+
+    if useCache:
+        await loop.run_in_executor(None, cacheDownload, validUrl, response.headers, filepath, sha.hexdigest())
+
+    DEBUG('Downloaded filepath: {}'.format(filepath))
+    return filepath
+
+
+async def iterResponseChunksAsync(response, validUrl: str = None, chunkSize: int = 32768):
+    """
+    asyncio variant of iterResponseChunks, for an aiohttp response. Errors are raised as by asyncRequestError.
+    """
+    deadline = time.monotonic() + DOWNLOAD_TIME_BUDGET
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    received = 0
+    retries = 0
+    part = response
+    while True:
+        try:
+            async for chunk in part.content.iter_chunked(chunkSize):
+                received += len(chunk)
+                yield chunk
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = asyncRequestError(e)
+        finally:
+            if part is not response:
+                part.release()
+
+        part = None
+        while part is None:
+            delay = resumeDelay(validUrl, retries, deadline)
+            if delay is None:
+                raise error
+            retries += 1
+            DEBUG('Download dropped after {} bytes, resuming in {}s'.format(received, delay))
+            await asyncio.sleep(delay)
+            try:
+                session = await getAsyncSession()
+                part = await session.get(validUrl, headers=resumeHeaders(received, validator))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = asyncRequestError(e)
+                continue
+            if not isResumed(part.status, part.headers, received):
+                part.release()
+                raise error
+
+    if validUrl is not None:
+        hostRecovered(validUrl)
+
+
+def iterAsyncChunks(chunks, loop):
+    """
+    Yields the chunks of an async iterator (e.g. iterResponseChunksAsync) to another thread than the one running
+    its event loop **loop**, which reads each chunk while the thread waits for it.
+    """
+    async def nextChunk():
+        return await chunks.__anext__()
+
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(nextChunk(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+#=======================================#
+#           BITRATE CHECKING            #
+#=======================================#
+
+def checkBitrateFromFile(file: FileType) -> Tuple[bool, str]:
+    """
+    Check the bitrate of a mutagen File.
+    Requires either lossless format or the metadata contains bitrate information.
+    If not, raises QoCException with the file metadata.
+    """
+    if isinstance(file, wave.WAVE) or isinstance(file, flac.FLAC):
+        return (True, "Lossless file is OK.")
+    
+    # seems video files show lower bitrate on properties view for some reason, shouldn't be an issue generally
+    if hasattr(file.info, 'bitrate'):
+        bitrate = file.info.bitrate
+        if bitrate == 0:      # Some MP4 files have 0 kbps bitrate?
+            return (True, "Bitrate is OK (0 kbps detected).")
+        elif bitrate < 300000:    # Apparently some weird files can have bitrate at 317kbps or even 319.999kbps. Let's say 300k is good enough
+            return (False, "The {} file's bitrate is {}kbps. Please re-render at 320kbps.".format(type(file).__name__, bitrate // 1000))
+        else:
+            return (True, "Bitrate is OK.")
+    
+    raise QoCException("ERROR: Unknown bitrate. File metadata: {}".format(file.pprint()))
+
+
+def checkBitrateFromUrl(validUrl: str) -> Tuple[bool, str]:
+    """
+    Check the bitrate of an URL by first finding the type of media
+    If media is wav or flac, no need to do anything further.
+    Otherwise, use ffprobe to download and check bitrate.
+    """
+    contentType = getHeadFromUrl(validUrl)['Content-Type'].lower()
+    if 'wav' in contentType or 'flac' in contentType:
+        return (True, "Lossless file is OK.")
+    
+    try:
+        probeOutput = ffprobeUrl(validUrl)
+        bitrate = int(probeOutput['streams'][0]['bit_rate'])
+    except KeyError:
+        # seems FLAC does not contain this info but it should have been skipped anyway
+        raise QoCException("ERROR: Bitrate cannot be detected from ffprobe output:\n{}".format(probeOutput))
+    except ValueError:
+        raise QoCException("ERROR: Bitrate cannot be parsed from ffprobe output:\n{}".format(probeOutput))
+
+    try:
+        filetype = probeOutput['format']['format_name'].upper()
+    except KeyError:
+        filetype = "[TYPE UNKNOWN]"
+
+    if bitrate == 0:      # Some MP4 files have 0 kbps bitrate?
+        return (True, "Bitrate is OK (0 kbps detected).")
+    elif bitrate < 300000:    # Apparently some weird files can have bitrate at 317kbps or even 319.999kbps. Let's say 300k is good enough
+        return (False, "The {} file's bitrate is {}kbps. Please re-render at 320kbps.".format(filetype, bitrate // 1000))
+    else:
+        return (True, "Bitrate is OK.")
+
+
+#=======================================#
+#           CLIPPING CHECKING           #
+#=======================================#
+
+"""
+Runs of equal consecutive samples are found for all channels at once by findRuns, and returned as a
+structured array with one (channel, start, length, value) record per run.
+Both the clipping and the DLS clipping checks work on these arrays.
+"""
+
+def runDtype(valueDtype: np.dtype) -> np.dtype:
+    return np.dtype([('channel', np.int32), ('start', np.int64), ('length', np.int64), ('value', valueDtype)])
+
+
+analysisPool = None
+
+def setAnalysisThreads(threads: int):
+    """
+    Sets how many threads findRuns may split the channels of large blocks between. 1 disables channel-parallel analysis.
+    NumPy releases the GIL in the comparisons doing most of the work, and jitScanRuns is compiled without it, so the threads do run in parallel.
+    """
+    global ANALYSIS_THREADS, analysisPool
+    if threads < 1:
+        raise ValueError('At least one analysis thread is needed')
+    if analysisPool is not None:
+        analysisPool.shutdown(wait=False)
+        analysisPool = None
+    ANALYSIS_THREADS = threads
+
+
+def getAnalysisPool() -> ThreadPoolExecutor:
+    global analysisPool
+    if analysisPool is None:
+        analysisPool = ThreadPoolExecutor(ANALYSIS_THREADS, thread_name_prefix='qoc-analysis')
+    return analysisPool
+
+
+def findRuns(data: np.ndarray, minLength: int = 2, previous: np.ndarray = None, keepEdges: bool = False) -> np.ndarray:
+    """
+    Finds the runs of at least **minLength** (and at least 2) equal consecutive samples in every channel, in one pass.
+    Large multichannel blocks are split by channel between ANALYSIS_THREADS threads.
+    - **data**: (samples x channels) array.
+    - **previous**: Last sample of each channel before **data**, if it continues a stream.
+    Runs continuing from it have start -1, and their length includes that sample.
+    - **keepEdges**: Also return the runs touching either end of **data** regardless of their length,
+    so they can be merged with the neighbouring blocks.
+
+    Returns a runDtype array sorted by channel, then start.
+    """
+    samples, channels = data.shape
+    threads = min(ANALYSIS_THREADS, channels)
+    if threads < 2 or samples < PARALLEL_MIN_SAMPLES:
+        return findChannelRuns(data, minLength, previous, keepEdges)
+
+    bounds = np.linspace(0, channels, threads + 1).astype(int)
+    futures = [
+        getAnalysisPool().submit(findChannelRuns, data[:, first:last], minLength, None if previous is None else previous[first:last], keepEdges)
+        for first, last in zip(bounds[:-1], bounds[1:])
+    ]
+    groups = []
+    for first, future in zip(bounds[:-1], futures):
+        runs = future.result()
+        runs['channel'] += first
+        groups.append(runs)
+    return np.concatenate(groups)
+
+
+def scanRuns(data: np.ndarray, minLength: int, previous: np.ndarray, hasPrevious: bool, keepEdges: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Loop implementation of findChannelRuns, visiting every sample once per pass.
+    Compiled by numba into jitScanRuns when it is installed; far too slow to use uncompiled.
+    The runs are counted in a first pass so that the second one can fill arrays of their final size.
+    - **previous**: Ignored unless **hasPrevious**, since the compiled function needs an array either way.
+
+    Returns the channel, start and length arrays of the runs.
+    """
+    samples, channels = data.shape
+    channel = np.empty(0, dtype=np.int32)
+    start = np.empty(0, dtype=np.int64)
+    length = np.empty(0, dtype=np.int64)
+    count = 0
+    for fill in range(2):
+        if fill:
+            channel = np.empty(count, dtype=np.int32)
+            start = np.empty(count, dtype=np.int64)
+            length = np.empty(count, dtype=np.int64)
+        count = 0
+        for c in range(channels):
+            runStart = -1 if hasPrevious and data[0, c] == previous[c] else 0
+            for i in range(1, samples + 1):
+                if i == samples or data[i, c] != data[i - 1, c]:
+                    runLength = i - runStart
+                    if runLength >= 2 and (runLength >= minLength or (keepEdges and (runStart == -1 or i == samples))):
+                        if fill:
+                            channel[count] = c
+                            start[count] = runStart
+                            length[count] = runLength
+                        count += 1
+                    runStart = i
+    return channel, start, length
+
+
+jitScanRuns = numba.njit(nogil=True, cache=True)(scanRuns) if numba is not None else None
+
+
+def findChannelRuns(data: np.ndarray, minLength: int, previous: np.ndarray, keepEdges: bool) -> np.ndarray:
+    """
+    Single-threaded implementation of findRuns. Uses jitScanRuns when numba is installed, NumPy otherwise.
+    """
+    samples, channels = data.shape
+    dtype = runDtype(data.dtype)
+    if samples == 0:
+        return np.empty(0, dtype=dtype)
+
+    if jitScanRuns is not None:
+        return packRuns(data, *jitScanRuns(data, minLength, data[0] if previous is None else previous, previous is not None, keepEdges))
+
+    # same[c, i+1] is True where sample i equals sample i-1, padded with False on both ends
+    same = np.zeros((channels, samples + 2), dtype=bool)
+    np.equal(data[1:].T, data[:-1].T, out=same[:, 2:samples+1])
+    if previous is not None:
+        np.equal(data[0], previous, out=same[:, 1])
+
+    # Every run of equal samples turns `same` on then off once, so the edges come in (rise, fall) pairs
+    edges = np.flatnonzero(same[:, 1:] != same[:, :-1]).reshape(-1, 2)
+    channel, rise = np.divmod(edges[:, 0], samples + 1)
+    fall = edges[:, 1] % (samples + 1)
+
+    runs = np.empty(len(edges), dtype=dtype)
+    runs['channel'] = channel
+    runs['start'] = rise - 1
+    runs['length'] = fall - rise + 1
+    runs['value'] = data[fall - 1, channel]
+
+    keep = runs['length'] >= minLength
+    if keepEdges:
+        keep |= (runs['start'] == -1) | (fall == samples)
+    return runs[keep]
+
+
+def packRuns(data: np.ndarray, channel: np.ndarray, start: np.ndarray, length: np.ndarray) -> np.ndarray:
+    """
+    Builds the runDtype array of the runs returned by scanRuns.
+    """
+    runs = np.empty(len(start), dtype=runDtype(data.dtype))
+    runs['channel'] = channel
+    runs['start'] = start
+    runs['length'] = length
+    runs['value'] = data[start + length - 1, channel]
+    return runs
+
+
+class RunTracker:
+    """
+    Finds runs of equal samples over consecutive blocks of a stream with findRuns,
+    carrying over the runs that cross block boundaries. Starts are counted from the start of the stream.
+    """
+    def __init__(self, channels: int, minLength: int):
+        self.minLength = minLength
+        self.previous = None
+        self.carryStarts = np.zeros(channels, dtype=np.int64) # start of the run containing the previous sample
+        self.offset = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """
+        Returns the runs of at least **minLength** samples that ended in this block or right before it.
+        """
+        samples = block.shape[0]
+        runs = findRuns(block, 2, self.previous, keepEdges=True)
+        closed = [self.stoppedRuns(block)]
+
+        end = self.offset + runs['start'] + runs['length'] - 1
+        continued = runs['start'] == -1
+        runs['start'] = np.where(continued, self.carryStarts[runs['channel']], self.offset + runs['start'])
+        runs['length'] = end - runs['start'] + 1
+
+        isOpen = end == self.offset + samples - 1
+        self.carryStarts[:] = self.offset + samples - 1
+        self.carryStarts[runs['channel'][isOpen]] = runs['start'][isOpen]
+        closed.append(runs[~isOpen])
+
+        self.previous = block[-1].copy()
+        self.offset += samples
+
+        closed = np.concatenate(closed)
+        return closed[closed['length'] >= self.minLength]
+
+    def skip(self, block: np.ndarray) -> np.ndarray:
+        """
+        Moves past a block without looking for runs in it, when none of the runs overlapping it matter.
+        Returns the runs of at least **minLength** samples that ended right before this block.
+        """
+        closed = self.stoppedRuns(block)
+        self.carryStarts[:] = self.offset + block.shape[0] - 1
+        self.previous = block[-1].copy()
+        self.offset += block.shape[0]
+        return closed[closed['length'] >= self.minLength]
+
+    def stoppedRuns(self, block: np.ndarray) -> np.ndarray:
+        """
+        Returns the carried runs that stopped right before a block, regardless of their length.
+        """
+        if self.previous is None:
+            return np.empty(0, dtype=runDtype(block.dtype))
+
+        stopped = np.flatnonzero(block[0] != self.previous)
+        carried = np.empty(len(stopped), dtype=runDtype(block.dtype))
+        carried['channel'] = stopped
+        carried['start'] = self.carryStarts[stopped]
+        carried['length'] = self.offset - carried['start']
+        carried['value'] = self.previous[stopped]
+        return carried
+
+    def seek(self, offset: int) -> np.ndarray:
+        """
+        Continues with a block starting at sample **offset** of the stream, after a gap.
+        Returns the runs of at least **minLength** samples that were still open before the gap.
+        """
+        closed = self.finish()
+        self.previous = None
+        self.offset = offset
+        return closed
+
+    def finish(self) -> np.ndarray:
+        """
+        Returns the runs of at least **minLength** samples still open at the end of the stream.
+        """
+        if self.previous is None:
+            return np.empty(0, dtype=runDtype(np.float32))
+
+        runs = np.empty(self.previous.size, dtype=runDtype(self.previous.dtype))
+        runs['channel'] = np.arange(self.previous.size)
+        runs['start'] = self.carryStarts
+        runs['length'] = self.offset - self.carryStarts
+        runs['value'] = self.previous
+        return runs[runs['length'] >= self.minLength]
+
+
+def clippingRuns(runs: np.ndarray, maxVals: np.ndarray, minVals: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the runs at the max value and the runs at the min value of their channel.
+    """
+    return runs[runs['value'] == maxVals[runs['channel']]], runs[runs['value'] == minVals[runs['channel']]]
+
+
+def clippingVerdict(runs: np.ndarray, framerate: int, maxVals: np.ndarray, minVals: np.ndarray, formatMin, formatMax) -> Tuple[bool, str]:
+    """
+    Builds the result of the clipping check.
+    - **runs**: runDtype array of the runs of at least the threshold length (at any value).
+    """
+    upperRuns, lowerRuns = clippingRuns(runs, maxVals, minVals)
+    upperClip = np.bincount(upperRuns['channel'], minlength=maxVals.size) > 0
+    lowerClip = np.bincount(lowerRuns['channel'], minlength=minVals.size) > 0
+    return clippingMessage(np.concatenate((upperRuns, lowerRuns)), len(upperRuns) + len(lowerRuns), upperClip, lowerClip,
+                           framerate, maxVals, minVals, formatMin, formatMax)
+
+
+def clippingMessage(clipRuns: np.ndarray, clipCount: int, upperClip: np.ndarray, lowerClip: np.ndarray,
+                    framerate: int, maxVals: np.ndarray, minVals: np.ndarray, formatMin, formatMax) -> Tuple[bool, str]:
+    """
+    Builds the result of the clipping check from a summary of the clipping runs.
+    - **clipRuns**: The runs at the max/min of their channel, only needed if there are at most MAX_LISTED_CLIPS.
+    - **clipCount**: Number of runs at the max of their channel plus number of runs at the min.
+    - **upperClip**, **lowerClip**: Whether each channel has runs at its max, and at its min.
+    """
+    if clipCount > 0:
         msg = ""
 
         # Detect if volume was reduced post-render
-        formatMin, formatMax = (-1.0, 1.0) if data.dtype == np.float32 else limits[wavFile.info.bits_per_sample]
-
         if np.any(np.logical_and(upperClip, maxVals < formatMax)) or np.any(np.logical_and(lowerClip, minVals > formatMin)):
             msg = " Post-render volume reduction detected, please lower the volume before rendering."
         
-        if len(clips) > 10:
+        if clipCount > MAX_LISTED_CLIPS:
             msg = "The rip is heavily clipping." + msg
         else:
+            clipRuns = clipRuns[np.lexsort((clipRuns['length'], clipRuns['start']))] # Sort by time for viewing purpose
+            clips = ['{:.2f} sec ({} samples)'.format(run['start'] / framerate, run['length']) for run in clipRuns]
             msg = "The rip is clipping at: " + ", ".join(clips) + "." + msg
         
         return (False, msg)
@@ -388,214 +1802,1653 @@ def checkClipping(wav_filepath: Path, threshold: int, doGradientAnalysis: bool)
         return (True, "The rip is not clipping.")
 
 
-def checkClippingFromFile(file: FileType, filepath: str, threshold: int = DEFAULT_CLIPPING_THRESHOLD) -> Tuple[bool, str]:
+def checkClipping(wav_filepath: Path, threshold: int, doGradientAnalysis: bool) -> Tuple[bool, str]:
+    """
+    Checks whether a WAV file is clipping (waveform contains "flat" peaks).
+    - **wav_filepath**: Path to a local WAV file.
+    - **threshold**: How many consecutive samples to look for. Recommended value: 3.
+    - **doGradientAnalysis**: Set to True if the waveform may contain overflows.
+    """
+    wavFile = parseAudio(wav_filepath)
+
+    framerate, data = wavfile.read(wav_filepath)
+
+    # Special case: 24-bit FLACs can go over sample limit and cause overflow/underflow,
+    # apply specialized algorithm to check for clicking instead.
+    if doGradientAnalysis:
+        data_deriv = np.gradient(data, axis=0)
+        maxG = np.max(data_deriv)
+        minG = np.min(data_deriv)
+        DEBUG('G: Max: {}, Min: {}'.format(maxG, minG))
+
+        # TODO: fine tune arbitrarily chosen threshold
+        # it may be possible to use 'and' since overflow/underflow will create large gradient both ways
+        # (relative to full scale, integer samples are not normalized)
+        gradientThreshold = 0.8 * getFullScale(data.dtype)
+        if maxG > gradientThreshold or minG < -gradientThreshold:
+            return (False, "Detected large gradient. Please verify clipping in Audacity.")
+        else:
+            return (True, "The rip is not clipping.")
+
+    formatMin, formatMax = getFormatLimits(data.dtype, wavFile.info.bits_per_sample)
+    data.clip(formatMin, formatMax, out=data)
+
+    # If audio is mono, reshape data for consistency
+    if data.ndim == 1:
+        data = data[:,None]
+
+    # Find max and min values in case someone tries to fix clipping in Audacity
+    maxVals = data.max(axis=0)
+    minVals = data.min(axis=0)
+
+    DEBUG('Data type: {}'.format(data.dtype))
+    DEBUG('Max: {}'.format(maxVals))
+    DEBUG('Min: {}'.format(minVals))
+
+    # A channel can only clip if its max or min value occurs at least threshold times
+    maxCounts = np.count_nonzero(data == maxVals, axis=0)
+    minCounts = np.count_nonzero(data == minVals, axis=0)
+    candidates = np.flatnonzero((maxCounts >= threshold) | (minCounts >= threshold))
+    DEBUG('Channels that may clip: {}'.format(candidates))
+
+    if len(candidates) == data.shape[1]:
+        runs = findRuns(data, threshold)
+    else:
+        runs = findRuns(data[:, candidates], threshold)
+        runs['channel'] = candidates[runs['channel']]
+
+    if DEBUG_MODE:
+        for clipRuns in clippingRuns(runs, maxVals, minVals):
+            for run in clipRuns:
+                DEBUG((run['start'] / framerate, data[run['start']:run['start']+run['length'], run['channel']]))
+
+    return clippingVerdict(runs, framerate, maxVals, minVals, formatMin, formatMax)
+
+
+class ClippingAnalyzer(BlockAnalyzer):
+    """
+    Block-wise version of checkClipping. Feed it blocks of samples with `process`, then call `result`.
+    Only runs at the running max/min of each channel are kept, since no other run can end up being clipping,
+    and blocks without any sample at these values are skipped.
+    When the number of samples at the final max/min is known, only channels where it reaches the threshold are looked at.
+    - **earlyExit**: Stop as soon as the rip is sure to be heavily clipping,
+    and whether the volume was reduced post-render is known.
+    """
+    def __init__(self, channels: int, formatMin, formatMax, threshold: int, earlyExit: bool = True):
+        super().__init__(channels, formatMin, formatMax)
+        self.threshold = threshold
+        self.candidates = np.arange(channels) # channels that may clip
+        self.tracker = RunTracker(channels, threshold)
+        self.runs = []
+        self.earlyExit = earlyExit
+        self.clipCount = 0 # runs sure to be at the final max/min of their channel
+        self.upperFound = np.full(channels, False)
+        self.lowerFound = np.full(channels, False)
+
+    def useExtremes(self, maxVals: np.ndarray, minVals: np.ndarray, maxCounts: np.ndarray = None, minCounts: np.ndarray = None):
+        super().useExtremes(maxVals, minVals, maxCounts, minCounts)
+        if maxCounts is not None and minCounts is not None:
+            self.candidates = np.flatnonzero((maxCounts >= self.threshold) | (minCounts >= self.threshold))
+            self.tracker = RunTracker(len(self.candidates), self.threshold)
+            self.done = len(self.candidates) == 0
+            DEBUG('Channels that may clip: {}'.format(self.candidates))
+
+    def addRuns(self, runs: np.ndarray):
+        runs['channel'] = self.candidates[runs['channel']]
+        upperRuns, lowerRuns = clippingRuns(runs, self.maxVals, self.minVals)
+        self.runs.extend((upperRuns, lowerRuns[lowerRuns['value'] != self.maxVals[lowerRuns['channel']]]))
+        if self.earlyExit:
+            self.checkDone(upperRuns, lowerRuns)
+
+    def checkDone(self, upperRuns: np.ndarray, lowerRuns: np.ndarray):
+        """
+        Sets `done` once there are more than MAX_LISTED_CLIPS runs at final extremes, and for each channel
+        either a clipping run at a reduced max/min was found or none of them can matter any more.
+        """
+        upperFinal, lowerFinal = self.finalExtremes()
+        upperRuns = upperRuns[upperFinal[upperRuns['channel']]]
+        lowerRuns = lowerRuns[lowerFinal[lowerRuns['channel']]]
+        self.clipCount += len(upperRuns) + len(lowerRuns)
+        self.upperFound[upperRuns['channel']] = True
+        self.lowerFound[lowerRuns['channel']] = True
+        if self.clipCount <= MAX_LISTED_CLIPS:
+            return
+
+        upperReduced = self.maxVals < self.formatMax
+        lowerReduced = self.minVals > self.formatMin
+        volumeReduced = np.any(self.upperFound & upperReduced) or np.any(self.lowerFound & lowerReduced)
+        decided = upperFinal & lowerFinal & (self.upperFound | ~upperReduced) & (self.lowerFound | ~lowerReduced)
+        decided[np.setdiff1d(np.arange(self.channels), self.candidates)] = True
+        self.done = bool(volumeReduced or np.all(decided))
+
+    def seek(self, offset: int):
+        runs = self.tracker.seek(offset)
+        if len(runs) > 0:
+            self.addRuns(runs)
+
+    def process(self, block: np.ndarray):
+        """
+        - **block**: (samples x channels) array, already clipped to the format limits.
+        """
+        self.updateExtremes(block)
+        if len(self.candidates) < self.channels:
+            block = block[:, self.candidates]
+        maxVals = self.maxVals[self.candidates]
+        minVals = self.minVals[self.candidates]
+
+        # Runs overlapping a block without any sample at the max/min are not at the max/min either
+        if np.any((block == maxVals) | (block == minVals)):
+            self.addRuns(self.tracker.process(block))
+        else:
+            self.addRuns(self.tracker.skip(block))
+
+    def result(self, framerate: int) -> Tuple[bool, str]:
+        if self.maxVals is None:
+            raise QoCException("ERROR: No audio samples to analyze.")
+
+        self.addRuns(self.tracker.finish())
+
+        DEBUG('Max: {}'.format(self.maxVals))
+        DEBUG('Min: {}'.format(self.minVals))
+
+        # Runs at a max/min that was exceeded later are dropped by clippingVerdict
+        return clippingVerdict(np.concatenate(self.runs), framerate, self.maxVals, self.minVals, self.formatMin, self.formatMax)
+
+
+class GradientAnalyzer(BlockAnalyzer):
+    """
+    Block-wise version of the gradient analysis of checkClipping, for files that may contain overflows (24-bit FLAC).
+    Works on the raw samples, before clipping. Only the running max/min gradient and the last two samples are kept,
+    so that the central differences of np.gradient can be computed across block boundaries.
+    - **earlyExit**: Stop as soon as a large gradient is found.
+    """
+    clipped = False
+
+    def __init__(self, channels: int, formatMin, formatMax, earlyExit: bool = True):
+        super().__init__(channels, formatMin, formatMax)
+        self.earlyExit = earlyExit
+        self.tail = None
+        self.edge = True # whether the next block starts the stream or a window, with a one-sided difference
+        self.maxG = None
+        self.minG = None
+        self.gradientThreshold = None
+
+    def addGradients(self, gradients: np.ndarray):
+        maxG = gradients.max()
+        minG = gradients.min()
+        self.maxG = maxG if self.maxG is None else max(self.maxG, maxG)
+        self.minG = minG if self.minG is None else min(self.minG, minG)
+
+    def seek(self, offset: int):
+        if self.tail is not None and len(self.tail) == 2:
+            self.addGradients(self.tail[1] - self.tail[0])
+        self.tail = None
+        self.edge = True
+
+    def process(self, block: np.ndarray):
+        if self.tail is None:
+            # TODO: fine tune arbitrarily chosen threshold
+            self.gradientThreshold = 0.8 * getFullScale(block.dtype)
+            data = block
+        else:
+            data = np.concatenate((self.tail, block))
+
+        # np.gradient works in float64 for integer samples, so differences of integers must not overflow
+        if np.issubdtype(data.dtype, np.integer):
+            data = data.astype(np.int64)
+
+        # Gradients of samples already seen may be computed again, which does not change the max/min
+        if len(data) >= 2 and self.edge:
+            self.addGradients(data[1] - data[0])
+            self.edge = False
+        if len(data) >= 3:
+            self.addGradients((data[2:] - data[:-2]) / 2)
+        self.tail = data[-2:].copy()
+
+        if self.earlyExit and self.maxG is not None:
+            self.done = bool(self.maxG > self.gradientThreshold or self.minG < -self.gradientThreshold)
+
+    def result(self, framerate: int) -> Tuple[bool, str]:
+        if self.tail is None or len(self.tail) < 2:
+            raise QoCException("ERROR: No audio samples to analyze.")
+
+        self.addGradients(self.tail[1] - self.tail[0])
+        maxG = self.maxG
+        minG = self.minG
+        DEBUG('G: Max: {}, Min: {}'.format(maxG, minG))
+
+        # it may be possible to use 'and' since overflow/underflow will create large gradient both ways
+        if maxG > self.gradientThreshold or minG < -self.gradientThreshold:
+            return (False, "Detected large gradient. Please verify clipping in Audacity.")
+        else:
+            return (True, "The rip is not clipping.")
+
+
+def checkClippingFromStream(filepath: str, threshold: int = DEFAULT_CLIPPING_THRESHOLD, blockSize: int = STREAM_BLOCK_SIZE, earlyExit: bool = True, bits: int = None) -> Tuple[bool, str]:
+    """
+    Checks whether a file or URL is clipping, decoding it block by block through an ffmpeg pipe.
+    Gives the same result as checkClipping, but without a temporary WAV file and with constant memory usage.
+    With **earlyExit**, stops reading as soon as the result can no longer change.
+    Integer sources are decoded at their own depth if **bits** is given (see getNativeBits).
+    """
+    framerate, (analyzer,) = analyzeStream(filepath, [
+        lambda channels, formatMin, formatMax: ClippingAnalyzer(channels, formatMin, formatMax, threshold, earlyExit),
+    ], blockSize, bits)
+    return analyzer.result(framerate)
+
+
+def checkClippingFromWAV(wav_filepath: Path, threshold: int = DEFAULT_CLIPPING_THRESHOLD, blockSize: int = STREAM_BLOCK_SIZE, earlyExit: bool = True) -> Tuple[bool, str]:
+    """
+    Checks whether a local WAV file is clipping, reading it block by block through a memory map.
+    Gives the same result as checkClipping without loading the whole file or making a clipped copy of it.
+    With **earlyExit**, stops reading as soon as the result can no longer change.
+    """
+    framerate, (analyzer,) = analyzeWAV(wav_filepath, [
+        lambda channels, formatMin, formatMax: ClippingAnalyzer(channels, formatMin, formatMax, threshold, earlyExit),
+    ], blockSize)
+    return analyzer.result(framerate)
+
+
+def checkClippingFromFile(file: FileType, filepath: str, threshold: int = DEFAULT_CLIPPING_THRESHOLD, streaming: bool = True) -> Tuple[bool, str]:
+    """
+    Checks whether a mutagen File is clipping.
+    Requires the file having been downloaded locally.
+    - **streaming**: Default True. If True, non-WAV files are decoded through an ffmpeg pipe instead of a temporary WAV file,
+    and WAV files are read block by block through a memory map.
+    """
+    is24bitFLAC = isinstance(file, flac.FLAC) and file.info.bits_per_sample == 24
+    bits = getNativeBits(file)
+
+    if streaming and isinstance(file, wave.WAVE):
+        return checkClippingFromWAV(filepath, threshold)
+    if streaming and is24bitFLAC:
+        DEBUG("Input file is detected as 24-bit FLAC. Recommend verifing clipping in Audacity.")
+        framerate, (analyzer,) = analyzeStream(str(filepath), [GradientAnalyzer], bits=bits)
+        return analyzer.result(framerate)
+    if streaming:
+        return checkClippingFromStream(str(filepath), threshold, bits=bits)
+
+    if isinstance(file, wave.WAVE):
+        DEBUG('Bits per sample: {}'.format(file.info.bits_per_sample))
+        return checkClipping(Path(filepath), threshold, False)
+
+    with scratchDir() as directory:
+        wav_filepath = directory / "{}_temp.wav".format(Path(filepath).stem)
+        ffmpegToWAV(filepath, wav_filepath, bits)
+
+        # do gradient analysis if file is 24-bit FLAC
+        if is24bitFLAC:
+            DEBUG("Input file is detected as 24-bit FLAC. Recommend verifing clipping in Audacity.")
+            return checkClipping(wav_filepath, threshold, True)
+        else:
+            return checkClipping(wav_filepath, threshold, False)
+
+
+def checkClippingFromUrl(validUrl: str, threshold: int = DEFAULT_CLIPPING_THRESHOLD, streaming: bool = True) -> Tuple[bool, str]:
+    """
+    Checks whether a URL media is clipping.
+    Will only download locally if the URL contains WAV; otherwise convert to local WAV file directly,
+    or decode it through an ffmpeg pipe if **streaming** is True.
+    """
+    contentType = getHeadFromUrl(validUrl)['Content-Type'].lower()
+
+    # do gradient analysis if file is 24-bit FLAC
+    is24bitFLAC = False
+    try:
+        probeOutput = ffprobeUrl(validUrl)
+        is24bitFLAC = ('flac' in probeOutput['format']['format_name']) and (int(probeOutput['streams'][0]['bits_per_raw_sample']) == 24)
+    except (KeyError, ValueError):
+        pass
+
+    if streaming and 'wav' not in contentType and not is24bitFLAC:
+        return checkClippingFromStream(validUrl, threshold)
+
+    with scratchDir() as directory:
+        wav_filepath = directory / 'temp.wav'
+        if 'wav' in contentType:
+            wav_filepath = downloadAudioFromUrl(validUrl, directory=directory)
+        else:
+            ffmpegToWAV(validUrl, wav_filepath, 24 if is24bitFLAC else None)
+
+        if is24bitFLAC:
+            DEBUG("Input file is detected as 24-bit FLAC. Recommend verifing clipping in Audacity.")
+            return checkClipping(wav_filepath, threshold, True)
+        elif streaming:
+            return checkClippingFromWAV(wav_filepath, threshold)
+        else:
+            return checkClipping(wav_filepath, threshold, False)
+
+
+#=======================================#
+#         DLS CLIPPING CHECKING         #
+#=======================================#
+"""
+Same idea behind checking clipping, but not limited to min/max values.
+We assume that DLS clipping will create non-peaking flat lines in the waveform that causes distortion.
+"""
+
+def dlsClippingVerdict(runs: np.ndarray, framerate: int, maxVals: np.ndarray, minVals: np.ndarray, formatMin, formatMax) -> Tuple[bool, str]:
+    """
+    Builds the result of the DLS clipping check.
+    - **runs**: runDtype array of the runs of at least the threshold length.
+    """
+    values = runs['value']
+    channelMax = maxVals[runs['channel']]
+    channelMin = minVals[runs['channel']]
+    relative = np.abs(values) / formatMax # this needs to be changed if unsigned WAVs will be used
+
+    atMax = values == channelMax
+    atMin = (values == channelMin) & ~atMax
+    maxClip = np.any(atMax & (channelMax < formatMax))
+    minClip = np.any(atMin & (channelMin < formatMin))
+    dlsClip = np.any(~atMax & ~atMin & (relative > 1e-3))
+
+    consRuns = runs[~((values == formatMax) | (values == formatMin) | np.isin(values, maxVals) | np.isin(values, minVals) | (relative < 1e-3))]
+    return dlsClippingMessage(consRuns, len(consRuns), dlsClip, maxClip, minClip, framerate)
+
+
+def dlsClippingMessage(consRuns: np.ndarray, consCount: int, dlsClip: bool, maxClip: bool, minClip: bool, framerate: int) -> Tuple[bool, str]:
+    """
+    Builds the result of the DLS clipping check from a summary of the runs.
+    - **consRuns**: The runs to list, only needed if there are at most MAX_LISTED_CLIPS.
+    - **consCount**: Number of runs to list.
+    - **dlsClip**: Whether any run is not at the max/min of its channel and not near zero.
+    - **maxClip**, **minClip**: Whether any run is at a reduced max/min of its channel.
+    """
+    if consCount > 0:
+        msg = ""
+
+        if dlsClip:
+            msg = "DLS clipping detected"
+            if consCount > MAX_LISTED_CLIPS:
+                msg = msg + " at many samples."
+            else:
+                consRuns = consRuns[np.lexsort((consRuns['channel'], consRuns['length'], consRuns['start']))] # Sort by time for viewing purpose
+                cons = ['{:.2f} sec ({} samples, value: {})'.format(run['start'] / framerate, run['length'], run['value']) for run in consRuns]
+                msg = msg + " at: " + ", ".join(cons) + "."
+        elif maxClip or minClip:
+            msg = "No DLS clipping detected, but post-render volume reduction clipping detected"
+        else:
+            msg = "No DLS clipping detected, but clipping detected"
+        
+        return (False, msg)
+    else:
+        return (True, "The rip has no DLS clipping.")
+
+
+def checkDLSClipping(wav_filepath: Path, threshold: int) -> Tuple[bool, str]:
+    """
+    Checks whether a WAV file might have DLS clipping (waveform contains non-zero "flat" samples).
+    - **wav_filepath**: Path to a local WAV file.
+    - **threshold**: How many consecutive samples to look for. Recommended value: 5.
+    """
+    wavFile = parseAudio(wav_filepath)
+
+    framerate, data = wavfile.read(wav_filepath)
+
+    formatMin, formatMax = getFormatLimits(data.dtype, wavFile.info.bits_per_sample)
+    data.clip(formatMin, formatMax, out=data)
+
+    # If audio is mono, reshape data for consistency
+    if data.ndim == 1:
+        data = data[:,None]
+
+    # Find max and min values
+    maxVals = data.max(axis=0)
+    minVals = data.min(axis=0)
+
+    DEBUG('Data type: {}'.format(data.dtype))
+    DEBUG('Max: {}'.format(maxVals))
+    DEBUG('Min: {}'.format(minVals))
+
+    return dlsClippingVerdict(findRuns(data, threshold), framerate, maxVals, minVals, formatMin, formatMax)
+
+
+class DLSClippingAnalyzer(BlockAnalyzer):
+    """
+    Block-wise version of checkDLSClipping. Feed it blocks of samples with `process`, then call `result`.
+    Only the aggregates of dlsClippingVerdict are kept: whether each kind of clipping was seen, how many runs are listed,
+    and the first MAX_LISTED_CLIPS of them. Runs whose value may still turn out to be the max/min of a channel
+    are kept until it is known, at most MAX_LISTED_CLIPS of them per channel and value (see compressRuns).
+    - **earlyExit**: Stop as soon as DLS clipping is sure to be detected at many samples.
+    """
+    def __init__(self, channels: int, formatMin, formatMax, threshold: int, earlyExit: bool = True):
+        super().__init__(channels, formatMin, formatMax)
+        self.tracker = RunTracker(channels, threshold)
+        self.earlyExit = earlyExit
+        self.dlsClip = False
+        self.maxClip = False
+        self.minClip = False
+        self.consCount = 0
+        self.consRuns = None
+        self.pending = None # runs that may be at the max/min of a channel
+        self.pendingWeights = None # number of runs each pending run stands for
+
+    def countRuns(self, runs: np.ndarray, weights: np.ndarray):
+        """
+        Adds runs to the aggregates, using the current max/min values as the final ones.
+        """
+        values = runs['value']
+        channelMax = self.maxVals[runs['channel']]
+        channelMin = self.minVals[runs['channel']]
+        relative = np.abs(values) / self.formatMax # this needs to be changed if unsigned WAVs will be used
+
+        atMax = values == channelMax
+        atMin = (values == channelMin) & ~atMax
+        self.maxClip = self.maxClip or bool(np.any(atMax & (channelMax < self.formatMax)))
+        self.minClip = self.minClip or bool(np.any(atMin & (channelMin < self.formatMin)))
+        self.dlsClip = self.dlsClip or bool(np.any(~atMax & ~atMin & (relative > 1e-3)))
+
+        cons = ~((values == self.formatMax) | (values == self.formatMin) | np.isin(values, self.maxVals) | np.isin(values, self.minVals) | (relative < 1e-3))
+        self.consCount += int(weights[cons].sum())
+        consRuns = runs[cons] if self.consRuns is None else np.concatenate((self.consRuns, runs[cons]))
+        self.consRuns = consRuns[:MAX_LISTED_CLIPS] # all of them while they can be listed
+        self.done = self.earlyExit and self.dlsClip and self.consCount > MAX_LISTED_CLIPS
+
+    def addRuns(self, runs: np.ndarray, weights: np.ndarray = None):
+        if weights is None:
+            weights = np.ones(len(runs), dtype=np.int64)
+        if self.fixedExtremes:
+            self.countRuns(runs, weights)
+            return
+
+        # Running extremes only move outwards: a run strictly inside the range of its channel is not at its max/min,
+        # and a run strictly inside the range of every channel is not at the max/min of any of them
+        values = runs['value']
+        insideOwn = (values < self.maxVals[runs['channel']]) & (values > self.minVals[runs['channel']])
+        insideAll = np.all((values[:,None] < self.maxVals) & (values[:,None] > self.minVals), axis=1)
+        settled = insideOwn & (insideAll | (np.abs(values) / self.formatMax < 1e-3))
+        self.countRuns(runs[settled], weights[settled])
+
+        if self.pending is not None:
+            runs = np.concatenate((self.pending, runs[~settled]))
+            weights = np.concatenate((self.pendingWeights, weights[~settled]))
+        else:
+            runs, weights = runs[~settled], weights[~settled]
+        self.pending, self.pendingWeights = compressRuns(runs, weights)
+
+    def settlePending(self):
+        if self.pending is not None:
+            pending, weights = self.pending, self.pendingWeights
+            self.pending = self.pendingWeights = None
+            self.addRuns(pending, weights)
+
+    def seek(self, offset: int):
+        runs = self.tracker.seek(offset)
+        if len(runs) > 0:
+            self.addRuns(runs)
+
+    def process(self, block: np.ndarray):
+        """
+        - **block**: (samples x channels) array, already clipped to the format limits.
+        """
+        newMax, newMin = self.updateExtremes(block)
+        if np.any(newMax) or np.any(newMin):
+            self.settlePending()
+        self.addRuns(self.tracker.process(block))
+
+    def result(self, framerate: int) -> Tuple[bool, str]:
+        if self.maxVals is None:
+            raise QoCException("ERROR: No audio samples to analyze.")
+
+        self.addRuns(self.tracker.finish())
+        if self.pending is not None:
+            self.countRuns(self.pending, self.pendingWeights)
+            self.pending = self.pendingWeights = None
+
+        DEBUG('Max: {}'.format(self.maxVals))
+        DEBUG('Min: {}'.format(self.minVals))
+
+        return dlsClippingMessage(self.consRuns, self.consCount, self.dlsClip, self.maxClip, self.minClip, framerate)
+
+
+def compressRuns(runs: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keeps the first MAX_LISTED_CLIPS runs of each channel and value, which are all that can be listed.
+    The last run kept of each channel and value also stands for the runs that were dropped, through its weight.
+    """
+    if len(runs) <= MAX_LISTED_CLIPS:
+        return runs, weights
+    order = np.lexsort((runs['value'], runs['channel'])) # stable, so runs stay in order within a group
+    runs, weights = runs[order], weights[order]
+    newGroup = np.concatenate(([True], (runs['channel'][1:] != runs['channel'][:-1]) | (runs['value'][1:] != runs['value'][:-1])))
+    groupStarts = np.flatnonzero(newGroup)
+    groups = np.cumsum(newGroup) - 1
+    keep = np.arange(len(runs)) - groupStarts[groups] < MAX_LISTED_CLIPS
+    dropped = np.add.reduceat(np.where(keep, 0, weights), groupStarts)
+
+    runs, weights, groups = runs[keep], weights[keep], groups[keep]
+    lastOfGroup = np.concatenate((groups[1:] != groups[:-1], [True]))
+    weights[lastOfGroup] += dropped
+    return runs, weights
+
+
+def checkDLSClippingFromStream(filepath: str, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD, blockSize: int = STREAM_BLOCK_SIZE, earlyExit: bool = True, bits: int = None) -> Tuple[bool, str]:
+    """
+    Checks whether a file or URL has DLS clipping, decoding it block by block through an ffmpeg pipe.
+    Gives the same result as checkDLSClipping, but without a temporary WAV file.
+    With **earlyExit**, stops reading as soon as the result can no longer change.
+    Integer sources are decoded at their own depth if **bits** is given (see getNativeBits).
+    """
+    framerate, (analyzer,) = analyzeStream(filepath, [
+        lambda channels, formatMin, formatMax: DLSClippingAnalyzer(channels, formatMin, formatMax, threshold, earlyExit),
+    ], blockSize, bits)
+    return analyzer.result(framerate)
+
+
+def checkDLSClippingFromWAV(wav_filepath: Path, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD, blockSize: int = STREAM_BLOCK_SIZE, earlyExit: bool = True) -> Tuple[bool, str]:
+    """
+    Checks whether a local WAV file has DLS clipping, reading it block by block through a memory map.
+    Gives the same result as checkDLSClipping without loading the whole file.
+    With **earlyExit**, stops reading as soon as the result can no longer change.
+    """
+    framerate, (analyzer,) = analyzeWAV(wav_filepath, [
+        lambda channels, formatMin, formatMax: DLSClippingAnalyzer(channels, formatMin, formatMax, threshold, earlyExit),
+    ], blockSize)
+    return analyzer.result(framerate)
+
+
+def checkDLSClippingFromFile(file: FileType, filepath: str, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD, streaming: bool = True) -> Tuple[bool, str]:
+    """
+    Checks whether a mutagen File has DLS clipping.
+    Requires the file having been downloaded locally.
+    - **streaming**: Default True. If True, non-WAV files are decoded through an ffmpeg pipe instead of a temporary WAV file,
+    and WAV files are read block by block through a memory map.
+    """
+    bits = getNativeBits(file)
+
+    if streaming and isinstance(file, wave.WAVE):
+        return checkDLSClippingFromWAV(filepath, threshold)
+    if streaming:
+        return checkDLSClippingFromStream(str(filepath), threshold, bits=bits)
+
+    if isinstance(file, wave.WAVE):
+        DEBUG('Bits per sample: {}'.format(file.info.bits_per_sample))
+        return checkDLSClipping(Path(filepath), threshold)
+
+    with scratchDir() as directory:
+        wav_filepath = directory / "{}_temp.wav".format(Path(filepath).stem)
+        ffmpegToWAV(filepath, wav_filepath, bits)
+        return checkDLSClipping(wav_filepath, threshold)
+
+def checkDLSClippingFromUrl(validUrl: str, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD, streaming: bool = True) -> Tuple[bool, str]:
+    """
+    Checks whether a URL media has DLS clipping.
+    Will only download locally if the URL contains WAV; otherwise convert to local WAV file directly,
+    or decode it through an ffmpeg pipe if **streaming** is True.
+    """
+    contentType = getHeadFromUrl(validUrl)['Content-Type'].lower()
+    if streaming and 'wav' not in contentType:
+        return checkDLSClippingFromStream(validUrl, threshold)
+
+    with scratchDir() as directory:
+        wav_filepath = directory / 'temp.wav'
+        if 'wav' in contentType:
+            wav_filepath = downloadAudioFromUrl(validUrl, directory=directory)
+        else:
+            ffmpegToWAV(validUrl, wav_filepath)
+
+        if streaming:
+            return checkDLSClippingFromWAV(wav_filepath, threshold)
+        else:
+            return checkDLSClipping(wav_filepath, threshold)
+
+
+#=======================================#
+#          TRANSCODE DETECTION          #
+#=======================================#
+"""
+Lossy encoders remove everything above a cutoff that depends on the bitrate, so a low-bitrate rip
+re-encoded at 320kbps keeps the hard lowpass shelf of its source even though its header looks fine.
+The shelf is found in the mean power spectrum of windows taken every SPECTRUM_STRIDE samples of the mono mix.
+"""
+
+def transcodeVerdict(power: np.ndarray, framerate: int) -> Tuple[bool, str]:
+    """
+    Builds the result of the transcode check.
+    - **power**: Mean power spectrum of the SPECTRUM_FFT_SIZE windows, empty if the rip is shorter than one window.
+    """
+    if len(power) == 0 or not np.any(power > 0):
+        return (True, "The rip is too short or quiet to check for transcoding.")
+
+    freqs = np.fft.rfftfreq(SPECTRUM_FFT_SIZE, 1 / framerate)
+    level = 10 * np.log10(np.maximum(power, np.finfo(np.float32).tiny))
+    reference = np.median(level[(freqs >= 500) & (freqs <= 5000)])
+    cutoff = freqs[np.flatnonzero(level > reference - SPECTRUM_FLOOR_DB)[-1]]
+    DEBUG('Spectrum: reference {:.1f}dB, cutoff {:.0f}Hz'.format(reference, cutoff))
+
+    below = level[(freqs >= cutoff - 1500) & (freqs <= cutoff - 500)]
+    above = level[(freqs >= cutoff + 500) & (freqs <= cutoff + 1500)]
+    if cutoff < TRANSCODE_CUTOFF_HZ and len(below) > 0 and len(above) > 0 and np.median(below) - np.median(above) > SPECTRUM_SHELF_DB:
+        return (False, "Detected a hard lowpass at {:.1f}kHz, the rip may be transcoded from a low-bitrate source. Please verify the spectrogram.".format(cutoff / 1000))
+    return (True, "No low-bitrate lowpass detected.")
+
+
+class SpectrumAnalyzer(WindowedAnalyzer):
+    """
+    Block-wise mean power spectrum of the mono mix for the transcode check, computed with batched FFTs
+    over windows of SPECTRUM_FFT_SIZE samples starting every SPECTRUM_STRIDE samples of the stream.
+    """
+    def __init__(self, channels: int, formatMin, formatMax):
+        super().__init__(channels, formatMin, formatMax, SPECTRUM_FFT_SIZE, SPECTRUM_STRIDE)
+        self.taper = np.hanning(SPECTRUM_FFT_SIZE).astype(np.float32)
+        self.power = np.zeros(SPECTRUM_FFT_SIZE // 2 + 1)
+
+    def processWindows(self, windows: np.ndarray):
+        spectra = np.fft.rfft(windows * self.taper, axis=1)
+        self.power += np.sum(spectra.real**2 + spectra.imag**2, axis=0)
+
+    def meanPower(self) -> np.ndarray:
+        if self.windows == 0:
+            return np.empty(0, dtype=np.float32)
+        return (self.power / self.windows).astype(np.float32)
+
+    def result(self, framerate: int) -> Tuple[bool, str]:
+        if self.samples == 0:
+            raise QoCException("ERROR: No audio samples to analyze.")
+        return transcodeVerdict(self.meanPower(), framerate)
+
+
+def checkTranscodeFromFile(file: FileType, filepath: str, blockSize: int = STREAM_BLOCK_SIZE) -> Tuple[bool, str]:
+    """
+    Checks whether a mutagen File looks transcoded from a low-bitrate lossy source, from its spectrum.
+    Requires the file having been downloaded locally.
+    """
+    if isinstance(file, wave.WAVE):
+        framerate, (analyzer,) = analyzeWAV(filepath, [SpectrumAnalyzer], blockSize)
+    else:
+        framerate, (analyzer,) = analyzeStream(str(filepath), [SpectrumAnalyzer], blockSize, getNativeBits(file))
+    return analyzer.result(framerate)
+
+
+#=======================================#
+#               LOUDNESS                #
+#=======================================#
+"""
+Integrated loudness (ITU-R BS.1770 / EBU R128) and true peak, measured block by block on the decoded samples.
+The K-weighting and interpolation filters carry their state between blocks, so blocks can have any size.
+"""
+
+def kWeightingFilters(framerate: int) -> list:
+    """
+    Returns the (b, a) coefficients of the two K-weighting stages of BS.1770 (high shelf, then high-pass) at any framerate.
+    At 48kHz, they are the coefficients given in the standard.
+    """
+    # high shelf modelling the acoustic effect of the head
+    K = np.tan(np.pi * 1681.974450955533 / framerate)
+    Q = 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K**2
+    shelf = (np.array([Vh + Vb * K / Q + K**2, 2 * (K**2 - Vh), Vh - Vb * K / Q + K**2]) / a0,
+             np.array([1, 2 * (K**2 - 1) / a0, (1 - K / Q + K**2) / a0]))
+
+    # revised low-frequency B-weighting high-pass
+    K = np.tan(np.pi * 38.13547087602444 / framerate)
+    Q = 0.5003270373238773
+    a0 = 1 + K / Q + K**2
+    highpass = (np.array([1.0, -2.0, 1.0]),
+                np.array([1, 2 * (K**2 - 1) / a0, (1 - K / Q + K**2) / a0]))
+    return [shelf, highpass]
+
+
+def loudnessChannelWeights(channels: int) -> np.ndarray:
+    """
+    Weights of the channels in the loudness sum: surround channels of 5.1 count more, and the LFE channel is left out.
+    """
+    if channels == 6:
+        return np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    return np.ones(channels)
+
+
+def integratedLoudness(hopPowers: np.ndarray, weights: np.ndarray) -> float:
+    """
+    Gated integrated loudness in LUFS, from the mean square of the K-weighted samples of each channel
+    over consecutive 100ms hops. Gating blocks are 400ms long and overlap by 75%, so each is made of 4 hops.
+    Returns -inf if no block is above the absolute gate.
+    """
+    if len(hopPowers) < 4:
+        return -np.inf
+    blockPowers = (hopPowers[:-3] + hopPowers[1:-2] + hopPowers[2:-1] + hopPowers[3:]) / 4
+    power = blockPowers @ weights
+    with np.errstate(divide='ignore'):
+        blockLoudness = -0.691 + 10 * np.log10(power)
+
+    gated = blockLoudness > -70
+    if not np.any(gated):
+        return -np.inf
+    relativeGate = -0.691 + 10 * np.log10(np.mean(power[gated])) - 10
+    gated &= blockLoudness > relativeGate
+    return float(-0.691 + 10 * np.log10(np.mean(power[gated])))
+
+
+def loudnessVerdict(loudness: float, truePeak: float) -> Tuple[bool, str]:
+    """
+    Builds the result of the loudness measurement, which is only informative and never fails.
+    - **loudness**: Integrated loudness in LUFS.
+    - **truePeak**: True peak in dBTP.
+    """
+    if np.isinf(loudness):
+        return (True, "The rip is too short or quiet to measure its loudness.")
+    return (True, "Integrated loudness: {:.1f} LUFS, true peak: {:.1f} dBTP.".format(loudness, truePeak))
+
+
+class LoudnessAnalyzer(BlockAnalyzer):
+    """
+    Block-wise integrated loudness and true peak. Works on the raw samples, before clipping, so that overs count in the true peak.
+    Only the filter states, the sum of squares of the unfinished 100ms hop and the mean square of each finished hop are kept.
+    """
+    clipped = False
+
+    def __init__(self, channels: int, formatMin, formatMax):
+        super().__init__(channels, formatMin, formatMax)
+        self.weights = loudnessChannelWeights(channels)
+        self.hopPowers = []
+        self.hopSum = np.zeros(channels)
+        self.hopFill = 0
+        self.truePeak = 0.0
+        self.samples = 0
+        self.filterStates = None
+        self.tail = None
+        # Lowpass at the original Nyquist frequency, one tap short of a whole number of phases so that its last phase
+        # is a plain delay giving back the original samples. The columns are the other phases, reversed so that
+        # multiplying windows of samples by them convolves the samples with them.
+        taps = signal.firwin(TRUE_PEAK_OVERSAMPLING * TRUE_PEAK_TAPS_PER_PHASE - 1, 1 / TRUE_PEAK_OVERSAMPLING) * TRUE_PEAK_OVERSAMPLING
+        taps = np.append(taps, 0)
+        self.interpolation = np.stack([taps[phase::TRUE_PEAK_OVERSAMPLING][::-1] for phase in range(TRUE_PEAK_OVERSAMPLING - 1)], axis=1)
+        self.interpolationGain = np.abs(self.interpolation).sum(axis=0).max() # interpolated samples are at most this times the largest sample
+
+    def startFilters(self):
+        """
+        (Re)starts the K-weighting and interpolation filters from silence.
+        """
+        self.kFilters = kWeightingFilters(self.framerate)
+        self.hop = round(self.framerate / 10)
+        self.filterStates = [np.zeros((len(a) - 1, self.channels)) for _, a in self.kFilters]
+        self.tail = np.zeros((TRUE_PEAK_TAPS_PER_PHASE - 1, self.channels))
+
+    def seek(self, offset: int):
+        # a hop cannot span the gap, and the filters must not ring across it
+        self.hopSum[:] = 0
+        self.hopFill = 0
+        self.filterStates = None
+
+    def process(self, block: np.ndarray):
+        """
+        - **block**: (samples x channels) array, before clipping.
+        """
+        if self.filterStates is None:
+            self.startFilters()
+        self.samples += len(block)
+        data = block / getFullScale(block.dtype)
+        self.addTruePeak(data)
+
+        weighted = data
+        states = self.filterStates
+        for stage, (b, a) in enumerate(self.kFilters):
+            weighted, states[stage] = signal.lfilter(b, a, weighted, axis=0, zi=states[stage])
+        squares = weighted**2
+
+        # complete the current hop, then add every full hop of the block at once
+        first = min(self.hop - self.hopFill, len(squares))
+        self.hopSum += squares[:first].sum(axis=0)
+        self.hopFill += first
+        if self.hopFill < self.hop:
+            return
+        self.hopPowers.append(self.hopSum[None] / self.hop)
+
+        rest = squares[first:]
+        hops = len(rest) // self.hop
+        self.hopPowers.append(rest[:hops * self.hop].reshape(hops, self.hop, self.channels).mean(axis=1))
+        self.hopSum = rest[hops * self.hop:].sum(axis=0)
+        self.hopFill = len(rest) - hops * self.hop
+
+    def addTruePeak(self, data: np.ndarray):
+        """
+        Updates the true peak with the 4x interpolated samples, only computed for the windows of samples
+        that could be interpolated above the true peak so far, which are few once it is close to its final value.
+        """
+        taps = TRUE_PEAK_TAPS_PER_PHASE
+        extended = np.concatenate((self.tail, data))
+        self.tail = extended[len(data):]
+        samplePeak = np.abs(extended).max()
+        self.truePeak = max(self.truePeak, samplePeak)
+        if samplePeak * self.interpolationGain <= self.truePeak:
+            return
+
+        # largest sample of each window of `taps` samples, starting at each sample of `extended`
+        windowMax = maximum_filter1d(np.abs(extended), taps, axis=0, origin=-(taps // 2))[:len(data)]
+        windows = np.lib.stride_tricks.sliding_window_view(extended, taps, axis=0)
+        windows = windows[np.any(windowMax * self.interpolationGain > self.truePeak, axis=1)]
+        if len(windows) > 0:
+            self.truePeak = max(self.truePeak, np.abs(windows @ self.interpolation).max())
+
+    def loudness(self) -> Tuple[float, float]:
+        """
+        Returns the integrated loudness in LUFS and the true peak in dBTP.
+        """
+        hopPowers = np.concatenate(self.hopPowers) if self.hopPowers else np.empty((0, self.channels))
+        with np.errstate(divide='ignore'):
+            truePeak = 20 * np.log10(self.truePeak)
+        return integratedLoudness(hopPowers, self.weights), float(truePeak)
+
+    def result(self, framerate: int) -> Tuple[bool, str]:
+        if self.samples == 0:
+            raise QoCException("ERROR: No audio samples to analyze.")
+        return loudnessVerdict(*self.loudness())
+
+
+#=======================================#
+#             FINGERPRINTS              #
+#=======================================#
+"""
+Compact audio fingerprints, used to find re-submissions of the same audio regardless of their metadata.
+Each word summarizes one frame: bit m is set if the energy difference between bands m and m+1
+(of 33 log-spaced bands from 300Hz to 2kHz) grew since the previous frame, as in Haitsma & Kalker's fingerprints.
+Only the shape of the spectrum over time matters, so the words survive re-encoding and volume changes.
+"""
+
+class FingerprintAnalyzer(WindowedAnalyzer):
+    """
+    Block-wise fingerprint of the mono mix, one uint32 word every FINGERPRINT_HOP_SECONDS.
+    """
+    def __init__(self, channels: int, formatMin, formatMax):
+        super().__init__(channels, formatMin, formatMax)
+        self.words = []
+        self.previous = None # band energy differences of the previous frame
+
+    def startFrames(self):
+        self.windowSize = round(self.framerate * FINGERPRINT_FRAME_SECONDS)
+        self.stride = round(self.framerate * FINGERPRINT_HOP_SECONDS)
+        self.taper = np.hanning(self.windowSize).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.windowSize, 1 / self.framerate)
+        self.bandEdges = np.searchsorted(freqs, np.geomspace(300, 2000, 34))
+
+    def seek(self, offset: int):
+        super().seek(offset)
+        self.previous = None
+
+    def process(self, block: np.ndarray):
+        if self.windowSize is None:
+            self.startFrames()
+        super().process(block)
+
+    def processWindows(self, windows: np.ndarray):
+        spectra = np.fft.rfft(windows * self.taper, axis=1)
+        cumulative = np.cumsum(spectra.real**2 + spectra.imag**2, axis=1)
+        bands = cumulative[:, self.bandEdges[1:] - 1] - cumulative[:, self.bandEdges[:-1] - 1]
+        differences = bands[:, :-1] - bands[:, 1:]
+
+        if self.previous is not None:
+            differences = np.concatenate((self.previous[None], differences))
+        self.previous = differences[-1]
+        bits = np.ascontiguousarray(differences[1:] > differences[:-1])
+        if len(bits) > 0:
+            self.words.append(np.packbits(bits, axis=1, bitorder='little').view('<u4')[:, 0])
+
+    def fingerprint(self) -> np.ndarray:
+        return np.concatenate(self.words) if self.words else np.empty(0, dtype='<u4')
+
+
+def fingerprintErrorRate(fingerprint: np.ndarray, other: np.ndarray, offset: int) -> Tuple[float, int]:
+    """
+    Returns the fraction of differing bits between two fingerprints, with word i of **fingerprint**
+    aligned to word i + **offset** of **other**, and how many words overlap.
+    """
+    start = max(0, -offset)
+    stop = min(len(fingerprint), len(other) - offset)
+    if stop <= start:
+        return 1.0, 0
+    differing = np.bitwise_xor(fingerprint[start:stop], other[start + offset:stop + offset])
+    return np.unpackbits(differing.view(np.uint8)).sum() / (32 * (stop - start)), stop - start
+
+
+fingerprintLock = threading.Lock() # serializes changes to the fingerprint index between threads
+
+class FingerprintIndex:
+    """
+    On-disk index of the fingerprints of rips, by URL, in FINGERPRINT_DIR:
+    - `<content hash>.npy`: fingerprint of each file.
+    - `rips.json`: URL and content hash of each indexed rip, by id. Ids grow as rips are added.
+    - `lookup.npz`: every FINGERPRINT_INDEX_STRIDE-th word of every fingerprint, sorted, with its rip id and position.
+
+    Lookups binary-search each word of a fingerprint in the sorted words. Every hit votes for an alignment
+    of the two rips, and only the best alignment of each rip is checked by comparing the whole fingerprints.
+    """
+    def __init__(self, directory: Path = None):
+        self.directory = Path(directory or FINGERPRINT_DIR)
+        try:
+            with open(self.directory / 'rips.json', 'r', encoding='utf-8') as f:
+                rips = json.load(f)
+            self.nextId = rips['nextId']
+            self.rips = {int(ripId): tuple(rip) for ripId, rip in rips['rips'].items()}
+            with np.load(self.directory / 'lookup.npz') as lookup:
+                self.words, self.ripIds, self.positions = lookup['words'], lookup['ripIds'], lookup['positions']
+        except FileNotFoundError:
+            self.nextId = 0
+            self.rips = {}
+            self.words = np.empty(0, dtype='<u4')
+            self.ripIds = np.empty(0, dtype=np.int32)
+            self.positions = np.empty(0, dtype=np.int32)
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tempPath = self.directory / 'lookup.tmp'
+        with open(tempPath, 'wb') as f:
+            np.savez(f, words=self.words, ripIds=self.ripIds, positions=self.positions)
+        os.replace(tempPath, self.directory / 'lookup.npz')
+        tempPath = self.directory / 'rips.tmp'
+        with open(tempPath, 'w', encoding='utf-8') as f:
+            json.dump({'nextId': self.nextId, 'rips': self.rips}, f)
+        os.replace(tempPath, self.directory / 'rips.json')
+
+    def urlId(self, url: str) -> int:
+        return next((ripId for ripId, (ripUrl, _) in self.rips.items() if ripUrl == url), None)
+
+    def fingerprintOf(self, url: str) -> np.ndarray:
+        """
+        Returns the fingerprint of an indexed rip, or None if it is not indexed.
+        """
+        ripId = self.urlId(url)
+        if ripId is None:
+            return None
+        return self.load(self.rips[ripId][1])
+
+    def load(self, key: str) -> np.ndarray:
+        return np.load(self.directory / '{}.npy'.format(key))
+
+    def add(self, url: str, key: str, fingerprint: np.ndarray):
+        """
+        Indexes the fingerprint of the file with content hash **key** found at **url**, replacing what was indexed for it before.
+        """
+        ripId = self.urlId(url)
+        if ripId is not None and self.rips[ripId][1] == key:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        np.save(self.directory / '{}.npy'.format(key), fingerprint)
+
+        dropped = [] if ripId is None else [ripId]
+        dropped += sorted(self.rips)[:max(0, len(self.rips) - len(dropped) + 1 - FINGERPRINT_MAX_RIPS)]
+        for droppedId in dropped:
+            _, droppedKey = self.rips.pop(droppedId)
+            if all(ripKey != droppedKey for _, ripKey in self.rips.values()) and droppedKey != key:
+                (self.directory / '{}.npy'.format(droppedKey)).unlink(missing_ok=True)
+        keep = ~np.isin(self.ripIds, dropped)
+
+        ripId = self.nextId
+        self.nextId += 1
+        self.rips[ripId] = (url, key)
+        positions = np.arange(0, len(fingerprint), FINGERPRINT_INDEX_STRIDE, dtype=np.int32)
+        words = fingerprint[positions]
+        positions = positions[(words != 0) & (words != 0xFFFFFFFF)] # silence and constant spectra are in every rip
+
+        words = np.concatenate((self.words[keep], fingerprint[positions]))
+        order = np.argsort(words, kind='stable')
+        self.words = words[order]
+        self.ripIds = np.concatenate((self.ripIds[keep], np.full(len(positions), ripId, dtype=np.int32)))[order]
+        self.positions = np.concatenate((self.positions[keep], positions))[order]
+        self.save()
+
+    def query(self, fingerprint: np.ndarray) -> list:
+        """
+        Returns the (URL, bit error rate) of the indexed rips with the same audio as a fingerprint, best match first.
+        """
+        queryPositions = np.flatnonzero((fingerprint != 0) & (fingerprint != 0xFFFFFFFF))
+        first = np.searchsorted(self.words, fingerprint[queryPositions], 'left')
+        counts = np.searchsorted(self.words, fingerprint[queryPositions], 'right') - first
+        counts[counts > FINGERPRINT_MAX_HITS] = 0
+        if counts.sum() == 0:
+            return []
+
+        # every hit of every word, with the alignment it votes for
+        hits = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        offsets = self.positions[hits].astype(np.int64) - np.repeat(queryPositions, counts)
+        alignments, votes = np.unique(np.stack((self.ripIds[hits], offsets), axis=1), axis=0, return_counts=True)
+
+        # best alignment of each rip
+        order = np.argsort(-votes, kind='stable')
+        alignments, votes = alignments[order], votes[order]
+        _, best = np.unique(alignments[:, 0], return_index=True)
+
+        matches = []
+        for (ripId, offset), count in zip(alignments[best], votes[best]):
+            if count < FINGERPRINT_MIN_VOTES:
+                continue
+            url, key = self.rips[int(ripId)]
+            other = self.load(key)
+            errorRate, overlap = fingerprintErrorRate(fingerprint, other, int(offset))
+            if errorRate <= FINGERPRINT_MAX_BER and overlap >= min(FINGERPRINT_MIN_OVERLAP, len(fingerprint), len(other)):
+                matches.append((url, float(errorRate)))
+        return sorted(matches, key=lambda match: match[1])
+
+
+def getFingerprint(file: FileType, filepath: str) -> np.ndarray:
+    """
+    Decodes a downloaded file for its fingerprint only.
+    """
+    if isinstance(file, wave.WAVE):
+        _, (analyzer,) = analyzeWAV(filepath, [FingerprintAnalyzer])
+    else:
+        _, (analyzer,) = analyzeStream(str(filepath), [FingerprintAnalyzer], bits=getNativeBits(file))
+    return analyzer.fingerprint()
+
+
+def indexFingerprint(url: str, key: str, fingerprint: np.ndarray):
+    """
+    Adds the fingerprint of a rip to the fingerprint index.
+    """
+    with fingerprintLock:
+        FingerprintIndex().add(url, key, fingerprint)
+
+
+def findAudioDupes(url: str, candidates: list = None) -> Tuple[list, int]:
+    """
+    Finds the indexed rips with the same audio as the rip at **url**, which is only downloaded if it was not indexed yet.
+    Fingerprints are only computed here, so the index holds the rips that findAudioDupes was called on.
+    Other rips are never downloaded.
+    - **candidates**: Only consider these URLs.
+
+    Returns the matching URLs, best match first, and how many of the candidates are indexed.
+    """
+    index = FingerprintIndex()
+    fingerprint = index.fingerprintOf(url)
+    if fingerprint is None:
+        with scratchDir() as directory:
+            probe = AudioProbe(downloadAudioFromUrl(parseUrl(url), directory=directory))
+            fingerprint = getFingerprint(probe.file, probe.filepath)
+            indexFingerprint(url, probe.contentHash, fingerprint)
+        index = FingerprintIndex()
+
+    matches = [match for match, _ in index.query(fingerprint) if match != url and (candidates is None or match in candidates)]
+    indexedUrls = set(ripUrl for ripUrl, _ in index.rips.values())
+    indexed = len(indexedUrls) - 1 if candidates is None else len(indexedUrls.intersection(candidates) - {url})
+    return matches, indexed
+
+
+#=======================================#
+#            RUN HISTOGRAMS             #
+#=======================================#
+"""
+Counts of flat runs by length, so that the clipping checks can be evaluated at any threshold from a single decode.
+"""
+
+class RunHistogram:
+    """
+    Number of runs of equal samples of each length, per value class and channel.
+    Runs longer than RUN_HISTOGRAM_BINS - 1 samples are all counted in the last bin.
+    - **counts**: (classes x channels x bins) array, classes being the indices of CLASSES:
+    runs at the max of their channel and at its min (which checkClipping reports),
+    runs checkDLSClipping lists (not at the max/min of any channel, and not near zero),
+    and flat runs (not at the max/min of their own channel, and not near zero), which make checkDLSClipping fail.
+    - **topRuns**: For the max, min and dls classes, the MAX_LISTED_CLIPS longest runs, with their position,
+    which are all the runs the checks can list.
+    """
+    CLASSES = ('max', 'min', 'dls', 'flat')
+    LISTED_CLASSES = ('max', 'min', 'dls')
+
+    def __init__(self, counts: np.ndarray, topRuns: dict, maxVals: np.ndarray, minVals: np.ndarray, formatMin, formatMax):
+        self.counts = counts
+        self.topRuns = topRuns
+        self.maxVals = maxVals
+        self.minVals = minVals
+        self.formatMin = formatMin
+        self.formatMax = formatMax
+        # atLeast[..., n] is the number of runs of at least n samples
+        self.atLeast = np.cumsum(counts[..., ::-1], axis=-1)[..., ::-1]
+
+    def runCounts(self, threshold: int) -> dict:
+        """
+        Returns the number of runs of at least **threshold** samples in each channel, for each class.
+        """
+        counts = self.atLeast[..., min(max(threshold, 0), self.atLeast.shape[-1] - 1)]
+        return dict(zip(self.CLASSES, counts))
+
+    def listedRuns(self, runClass: str, threshold: int) -> np.ndarray:
+        """
+        Returns the runs of a class of at least **threshold** samples, if there are at most MAX_LISTED_CLIPS of them.
+        """
+        runs = self.topRuns[runClass]
+        return runs[runs['length'] >= threshold]
+
+    def isClipping(self, threshold: int = DEFAULT_CLIPPING_THRESHOLD) -> bool:
+        counts = self.runCounts(threshold)
+        return bool(np.any(counts['max']) or np.any(counts['min']))
+
+    def hasVolumeReduction(self, threshold: int = DEFAULT_CLIPPING_THRESHOLD) -> bool:
+        """
+        Whether checkClipping would report post-render volume reduction at this threshold.
+        """
+        counts = self.runCounts(threshold)
+        return bool(np.any((counts['max'] > 0) & (self.maxVals < self.formatMax)) or np.any((counts['min'] > 0) & (self.minVals > self.formatMin)))
+
+    def hasDLSClipping(self, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD) -> bool:
+        """
+        Whether checkDLSClipping would list runs at this threshold.
+        """
+        return bool(np.any(self.runCounts(threshold)['dls']))
+
+
+class RunHistogramAnalyzer(BlockAnalyzer):
+    """
+    Builds a RunHistogram block by block. Feed it blocks of samples with `process`, then call `result`.
+    Without a previous pass, runs whose value may still turn out to be the max/min of a channel are kept
+    until it is known; the others are counted right away.
+    """
+    def __init__(self, channels: int, formatMin, formatMax):
+        super().__init__(channels, formatMin, formatMax)
+        self.tracker = RunTracker(channels, 2)
+        self.counts = np.zeros((len(RunHistogram.CLASSES), channels, RUN_HISTOGRAM_BINS), dtype=np.int64)
+        self.topRuns = {}
+        self.pending = []
+
+    def countRuns(self, runs: np.ndarray):
+        """
+        Adds runs to the histogram, using the current max/min values as the final ones.
+        """
+        channel = runs['channel']
+        values = runs['value']
+        bins = np.minimum(runs['length'], RUN_HISTOGRAM_BINS - 1)
+        atMax = values == self.maxVals[channel]
+        atMin = values == self.minVals[channel]
+        relative = np.abs(values) / self.formatMax
+        dls = ~(np.isin(values, self.maxVals) | np.isin(values, self.minVals) | (values == self.formatMax) | (values == self.formatMin)
+                | (relative < 1e-3))
+        flat = ~atMax & ~atMin & (relative > 1e-3)
+        for index, mask in enumerate((atMax, atMin, dls, flat)):
+            np.add.at(self.counts[index], (channel[mask], bins[mask]), 1)
+
+        for runClass, mask in zip(RunHistogram.LISTED_CLASSES, (atMax, atMin, dls)):
+            top = runs[mask] if runClass not in self.topRuns else np.concatenate((self.topRuns[runClass], runs[mask]))
+            self.topRuns[runClass] = top[np.argsort(-top['length'], kind='stable')[:MAX_LISTED_CLIPS]]
+
+    def addRuns(self, runs: np.ndarray):
+        if self.fixedExtremes:
+            self.countRuns(runs)
+            return
+
+        # Running extremes only move outwards: a run strictly inside the range of its channel is not at its max/min,
+        # and a run strictly inside the range of every channel is not at the max/min of any of them
+        values = runs['value']
+        insideOwn = (values < self.maxVals[runs['channel']]) & (values > self.minVals[runs['channel']])
+        insideAll = np.all((values[:,None] < self.maxVals) & (values[:,None] > self.minVals), axis=1)
+        settled = insideOwn & (insideAll | (np.abs(values) / self.formatMax < 1e-3))
+        self.countRuns(runs[settled])
+        self.pending.append(runs[~settled])
+
+    def process(self, block: np.ndarray):
+        """
+        - **block**: (samples x channels) array, already clipped to the format limits.
+        """
+        newMax, newMin = self.updateExtremes(block)
+        if len(self.pending) > 0 and (np.any(newMax) or np.any(newMin)):
+            pending = np.concatenate(self.pending)
+            self.pending = []
+            self.addRuns(pending)
+        self.addRuns(self.tracker.process(block))
+
+    def result(self, framerate: int) -> RunHistogram:
+        if self.maxVals is None:
+            raise QoCException("ERROR: No audio samples to analyze.")
+
+        self.addRuns(self.tracker.finish())
+        if len(self.pending) > 0:
+            self.countRuns(np.concatenate(self.pending))
+            self.pending = []
+
+        return RunHistogram(self.counts, self.topRuns, self.maxVals, self.minVals, self.formatMin, self.formatMax)
+
+
+def getRunHistogramFromFile(file: FileType, filepath: str, blockSize: int = STREAM_BLOCK_SIZE) -> RunHistogram:
+    """
+    Decodes a downloaded file once and returns the RunHistogram of its samples.
+    """
+    if isinstance(file, wave.WAVE):
+        framerate, (analyzer,) = analyzeWAV(filepath, [RunHistogramAnalyzer], blockSize)
+    else:
+        framerate, (analyzer,) = analyzeStream(str(filepath), [RunHistogramAnalyzer], blockSize, getNativeBits(file))
+    return analyzer.result(framerate)
+
+
+#=======================================#
+#            AUDIO FEATURES             #
+#=======================================#
+"""
+Everything the sample checks need, extracted in one decode and small enough to be kept on disk,
+so that re-checking a file (possibly with other thresholds) does not need ffmpeg or any pass over the samples.
+Records are .npz files in FEATURE_CACHE_DIR named after the SHA-256 of the file contents.
+"""
+
+class EnvelopePyramid:
+    """
+    Min/max envelope of each channel at several resolutions, for drawing the waveform around a timestamp.
+    Values are stored as int16 relative to full scale (rounded outwards), which is plenty for display.
+    - **levels**: List of ((points x channels) max, (points x channels) min) arrays, from the finest level to the coarsest.
+    Each point of level i summarizes window * factor**i samples.
+    """
+    def __init__(self, levels: list, window: int, factor: int):
+        self.levels = levels
+        self.window = window
+        self.factor = factor
+
+    @classmethod
+    def fromEnvelope(cls, envelopeMax: np.ndarray, envelopeMin: np.ndarray, fullScale: float,
+                     window: int = ENVELOPE_WINDOW, factor: int = ENVELOPE_FACTOR):
+        """
+        Builds the pyramid from the finest envelope, in sample units.
+        """
+        scale = 32768 / fullScale
+        levelMax = np.clip(np.ceil(envelopeMax * scale), -32768, 32767).astype(np.int16)
+        levelMin = np.clip(np.floor(envelopeMin * scale), -32768, 32767).astype(np.int16)
+        levels = [(levelMax, levelMin)]
+        while len(levelMax) > ENVELOPE_OVERVIEW_POINTS:
+            groups = np.arange(0, len(levelMax), factor)
+            levelMax = np.maximum.reduceat(levelMax, groups, axis=0)
+            levelMin = np.minimum.reduceat(levelMin, groups, axis=0)
+            levels.append((levelMax, levelMin))
+        return cls(levels, window, factor)
+
+    def snippet(self, start: int, stop: int, points: int = 80) -> Tuple[int, np.ndarray, np.ndarray]:
+        """
+        Returns the envelope between samples **start** and **stop**, at the finest level with at most **points** points.
+        Returns (samples per point, (points x channels) max, (points x channels) min).
+        """
+        for level, (levelMax, levelMin) in enumerate(self.levels):
+            window = self.window * self.factor**level
+            first, last = max(start, 0) // window, -(-stop // window)
+            if last - first <= points or level == len(self.levels) - 1:
+                return window, levelMax[first:last], levelMin[first:last]
+
+
+def renderEnvelope(envelopeMax: np.ndarray, envelopeMin: np.ndarray, height: int = 8) -> str:
     """
-    Checks whether a mutagen File is clipping.
-    Requires the file having been downloaded locally.
+    Draws a 1D int16 min/max envelope as text, one column per point, full scale from top to bottom.
     """
-    wav_filepath = Path(filepath)
-    newfile = False
-    if not isinstance(file, wave.WAVE):
-        newfile = True
-        wav_filepath = "{}_temp.wav".format(Path.joinpath(wav_filepath.parent, wav_filepath.stem))
-    else:
-        DEBUG('Bits per sample: {}'.format(file.info.bits_per_sample))
-        
-    if not os.path.exists(wav_filepath):
-        ffmpegToWAV(filepath, wav_filepath)
+    bands = np.linspace(32768, -32768, height + 1)
+    rows = []
+    for top, bottom in zip(bands[:-1], bands[1:]):
+        # a cell is filled if the range of its column overlaps its band
+        filled = (envelopeMax.astype(np.int32) >= bottom) & (envelopeMin.astype(np.int32) < top)
+        rows.append(''.join('█' if cell else ' ' for cell in filled))
+    return '\n'.join(rows)
 
-    # do gradient analysis if file is 24-bit FLAC
-    if isinstance(file, flac.FLAC) and file.info.bits_per_sample == 24:
-        DEBUG("Input file is detected as 24-bit FLAC. Recommend verifing clipping in Audacity.")
-        check, msg = checkClipping(wav_filepath, threshold, True)
-    else:
-        check, msg = checkClipping(wav_filepath, threshold, False)
 
-    if newfile:
-        os.remove(wav_filepath)
+class EnvelopeAnalyzer(BlockAnalyzer):
+    """
+    Computes the max and min sample of each channel over consecutive windows of **window** samples,
+    which is the finest level of an EnvelopePyramid.
+    """
+    def __init__(self, channels: int, formatMin, formatMax, window: int = ENVELOPE_WINDOW):
+        super().__init__(channels, formatMin, formatMax)
+        self.window = window
+        self.partial = None # samples of the last window, not complete yet
+        self.envelopeMax = []
+        self.envelopeMin = []
+
+    def process(self, block: np.ndarray):
+        if self.partial is not None:
+            block = np.concatenate((self.partial, block))
+        windows = block.shape[0] // self.window
+        if windows > 0:
+            full = block[:windows * self.window].reshape(windows, self.window, self.channels)
+            self.envelopeMax.append(full.max(axis=1))
+            self.envelopeMin.append(full.min(axis=1))
+        self.partial = block[windows * self.window:].copy()
+
+    def result(self, framerate: int) -> EnvelopePyramid:
+        if self.partial is not None and len(self.partial) > 0:
+            self.envelopeMax.append(self.partial.max(axis=0, keepdims=True))
+            self.envelopeMin.append(self.partial.min(axis=0, keepdims=True))
+            self.partial = None
+        if len(self.envelopeMax) == 0:
+            raise QoCException("ERROR: No audio samples to analyze.")
+
+        envelopeMax = np.concatenate(self.envelopeMax)
+        return EnvelopePyramid.fromEnvelope(envelopeMax, np.concatenate(self.envelopeMin), getFullScale(envelopeMax.dtype), self.window)
+
+
+class AudioFeatures:
+    """
+    Per-file summary of the decoded samples: per-channel extremes, run-length histogram,
+    gradient extremes (used for 24-bit FLAC), min/max envelope, mean power spectrum, integrated loudness and true peak.
+    The sample checks can be computed from it at any threshold, with the same results as the analyzers.
+    """
+    def __init__(self, framerate: int, histogram: RunHistogram, gradient: Tuple[float, float, float], envelope: EnvelopePyramid,
+                 spectrum: np.ndarray, loudness: Tuple[float, float]):
+        self.framerate = framerate
+        self.histogram = histogram
+        self.maxG, self.minG, self.gradientThreshold = gradient
+        self.envelope = envelope
+        self.spectrum = spectrum
+        self.loudness, self.truePeak = loudness
+
+    @property
+    def maxVals(self) -> np.ndarray:
+        return self.histogram.maxVals
+
+    @property
+    def minVals(self) -> np.ndarray:
+        return self.histogram.minVals
+
+    def clippingResult(self, threshold: int = DEFAULT_CLIPPING_THRESHOLD, gradientAnalysis: bool = False) -> Tuple[bool, str]:
+        """
+        Same result as checkClipping.
+        """
+        if gradientAnalysis:
+            if np.isnan(self.maxG):
+                raise QoCException("ERROR: No audio samples to analyze.")
+            DEBUG('G: Max: {}, Min: {}'.format(self.maxG, self.minG))
+            if self.maxG > self.gradientThreshold or self.minG < -self.gradientThreshold:
+                return (False, "Detected large gradient. Please verify clipping in Audacity.")
+            else:
+                return (True, "The rip is not clipping.")
+
+        histogram = self.histogram
+        counts = histogram.runCounts(threshold)
+        clipCount = counts['max'].sum() + counts['min'].sum()
+        clipRuns = np.concatenate((histogram.listedRuns('max', threshold), histogram.listedRuns('min', threshold)))
+        return clippingMessage(clipRuns, clipCount, counts['max'] > 0, counts['min'] > 0,
+                               self.framerate, histogram.maxVals, histogram.minVals, histogram.formatMin, histogram.formatMax)
 
-    return (check, msg)
+    def dlsClippingResult(self, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD) -> Tuple[bool, str]:
+        """
+        Same result as checkDLSClipping.
+        """
+        histogram = self.histogram
+        counts = histogram.runCounts(threshold)
+        maxClip = np.any((counts['max'] > 0) & (histogram.maxVals < histogram.formatMax))
+        # runs at the min of a constant channel are at its max first
+        minClip = np.any((counts['min'] > 0) & (histogram.minVals != histogram.maxVals) & (histogram.minVals < histogram.formatMin))
+        return dlsClippingMessage(histogram.listedRuns('dls', threshold), counts['dls'].sum(), np.any(counts['flat'] > 0),
+                                  maxClip, minClip, self.framerate)
+
+    def transcodeResult(self) -> Tuple[bool, str]:
+        """
+        Same result as checkTranscodeFromFile.
+        """
+        return transcodeVerdict(self.spectrum, self.framerate)
 
+    def loudnessResult(self) -> Tuple[bool, str]:
+        """
+        Same result as LoudnessAnalyzer.
+        """
+        return loudnessVerdict(self.loudness, self.truePeak)
 
-def checkClippingFromUrl(validUrl: str, threshold: int = DEFAULT_CLIPPING_THRESHOLD) -> Tuple[bool, str]:
+    def waveformSnippet(self, seconds: float, channel: int = 0, span: float = 0.5, width: int = 60, height: int = 8) -> str:
+        """
+        Draws the waveform of a channel as text, **span** seconds on each side of a timestamp (e.g. of a reported clip).
+        """
+        center = int(seconds * self.framerate)
+        radius = int(span * self.framerate)
+        _, envelopeMax, envelopeMin = self.envelope.snippet(center - radius, center + radius, width)
+        return renderEnvelope(envelopeMax[:, channel], envelopeMin[:, channel], height)
+
+    def save(self, path: Path):
+        histogram = self.histogram
+        with open(path, 'wb') as f:
+            np.savez_compressed(f,
+                version=FEATURE_VERSION,
+                framerate=self.framerate,
+                formatLimits=np.array([histogram.formatMin, histogram.formatMax]),
+                maxVals=histogram.maxVals,
+                minVals=histogram.minVals,
+                counts=histogram.counts,
+                **{'top_' + runClass: histogram.topRuns[runClass] for runClass in RunHistogram.LISTED_CLASSES},
+                gradient=np.array([self.maxG, self.minG, self.gradientThreshold], dtype=np.float64),
+                # envelope levels are stored one after another
+                envelopeMax=np.concatenate([levelMax for levelMax, _ in self.envelope.levels]),
+                envelopeMin=np.concatenate([levelMin for _, levelMin in self.envelope.levels]),
+                envelopeLevels=[len(levelMax) for levelMax, _ in self.envelope.levels],
+                envelopeWindow=self.envelope.window,
+                envelopeFactor=self.envelope.factor,
+                spectrum=self.spectrum,
+                loudness=np.array([self.loudness, self.truePeak], dtype=np.float64),
+            )
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as record:
+            if int(record['version']) != FEATURE_VERSION:
+                raise ValueError('Outdated feature record')
+            maxVals = record['maxVals']
+            formatMin, formatMax = record['formatLimits'].tolist()
+            histogram = RunHistogram(record['counts'], {runClass: record['top_' + runClass] for runClass in RunHistogram.LISTED_CLASSES},
+                                     maxVals, record['minVals'], formatMin, formatMax)
+            bounds = np.cumsum(record['envelopeLevels'])[:-1]
+            levels = list(zip(np.split(record['envelopeMax'], bounds), np.split(record['envelopeMin'], bounds)))
+            envelope = EnvelopePyramid(levels, int(record['envelopeWindow']), int(record['envelopeFactor']))
+            return cls(int(record['framerate']), histogram, tuple(record['gradient'].tolist()), envelope, record['spectrum'],
+                       tuple(record['loudness'].tolist()))
+
+
+FEATURE_ANALYZERS = [
+    RunHistogramAnalyzer,
+    lambda channels, formatMin, formatMax: GradientAnalyzer(channels, formatMin, formatMax, earlyExit=False),
+    EnvelopeAnalyzer,
+    SpectrumAnalyzer,
+    LoudnessAnalyzer,
+]
+
+def extractFeatures(file: FileType, filepath: str, blockSize: int = STREAM_BLOCK_SIZE) -> AudioFeatures:
     """
-    Checks whether a URL media is clipping.
-    Will only download locally if the URL contains WAV; otherwise convert to local WAV file directly.
+    Decodes a downloaded file once and extracts its AudioFeatures.
     """
-    contentType = getHeadFromUrl(validUrl)['Content-Type'].lower()
-    wav_filepath = DOWNLOAD_DIR / 'temp.wav'
-    if 'wav' in contentType:
-        wav_filepath = downloadAudioFromUrl(validUrl)
-    else:
-        ffmpegToWAV(validUrl, wav_filepath)
-        
-    # do gradient analysis if file is 24-bit FLAC
-    is24bitFLAC = False
-    try:
-        probeOutput = ffprobeUrl(validUrl)
-        is24bitFLAC = ('flac' in probeOutput['format']['format_name']) and (int(probeOutput['streams'][0]['bits_per_raw_sample']) == 24)
-    except (KeyError, ValueError):
-        pass
-
-    if is24bitFLAC:
-        DEBUG("Input file is detected as 24-bit FLAC. Recommend verifing clipping in Audacity.")
-        check, msg = checkClipping(wav_filepath, threshold, True)
+    if isinstance(file, wave.WAVE):
+        framerate, analyzers = analyzeWAV(filepath, FEATURE_ANALYZERS, blockSize)
     else:
-        check, msg = checkClipping(wav_filepath, threshold, False)
+        framerate, analyzers = analyzeStream(str(filepath), FEATURE_ANALYZERS, blockSize, getNativeBits(file))
+    return collectFeatures(framerate, analyzers)
 
-    os.remove(wav_filepath)
 
-    return (check, msg)
+def collectFeatures(framerate: int, analyzers: list) -> AudioFeatures:
+    """
+    Builds the AudioFeatures of a file from the FEATURE_ANALYZERS that analyzed it.
+    """
+    histogramAnalyzer, gradientAnalyzer, envelopeAnalyzer, spectrumAnalyzer, loudnessAnalyzer = analyzers
 
+    try:
+        gradientAnalyzer.result(framerate)
+        gradient = (gradientAnalyzer.maxG, gradientAnalyzer.minG, gradientAnalyzer.gradientThreshold)
+    except QoCException:
+        gradient = (np.nan, np.nan, np.nan) # single sample, only matters for the gradient analysis
+    return AudioFeatures(framerate, histogramAnalyzer.result(framerate), gradient, envelopeAnalyzer.result(framerate),
+                         spectrumAnalyzer.meanPower(), loudnessAnalyzer.loudness())
 
-#=======================================#
-#         DLS CLIPPING CHECKING         #
-#=======================================#
-"""
-Same idea behind checking clipping, but not limited to min/max values.
-We assume that DLS clipping will create non-peaking flat lines in the waveform that causes distortion.
-"""
 
-def getConsecutiveRuns(channel: np.ndarray, threshold: int) -> list:
-    # ensure array
-    if channel.ndim != 1:
-        raise ValueError('Only 1D array supported')
-    
-    consRun = np.append(np.equal(channel[:-1], channel[1:]).astype(np.int16), 0)
-    consSamples = []
-
-    runs = sameValueRuns(consRun, 1)
-    for run in runs:
-        # Each streak of 1 in consRun correspond to a streak in the channel array with 1 fewer sample
-        # since each individual sample is a consecutive run of length 1
-        if run[1] - run[0] >= threshold-1:
-            consSamples.append((channel[run[0]], run))
-    
-    return consSamples
+def hashFile(filepath: str) -> str:
+    """
+    Returns the SHA-256 of a file's contents, as hex.
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
-def checkDLSClipping(wav_filepath: Path, threshold: int) -> Tuple[bool, str]:
+def loadCachedFeatures(key: str) -> AudioFeatures:
     """
-    Checks whether a WAV file might have DLS clipping (waveform contains non-zero "flat" samples).
-    - **wav_filepath**: Path to a local WAV file.
-    - **threshold**: How many consecutive samples to look for. Recommended value: 5.
+    Returns the cached AudioFeatures of a file from its content hash, or None if they are not cached.
     """
-    wavFile = parseAudio(wav_filepath)
+    path = FEATURE_CACHE_DIR / '{}.npz'.format(key)
+    try:
+        features = AudioFeatures.load(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        DEBUG('Dropping unreadable feature record {}: {}'.format(path.name, e))
+        path.unlink(missing_ok=True)
+        return None
 
-    cons = []
-    framerate, data = wavfile.read(wav_filepath)
+    os.utime(path) # mark as recently used
+    return features
 
-    # +1 to min in order to mimic Audacity's Find Clipping algorithm,
-    # even though WAV samples can technically go lower
-    limits = {
-        16: (-2**15     +1,     2**15-1     ),
-        24: (-2**31     +1,     2147483392  ),
-        32: (-2**31     +1,     2**31-1     ),
-    }
 
-    # Apparently WAV 32-bit float can go over +-1.0
-    if data.dtype == np.float32:
-        data.clip(-1.0, 1.0, out=data)
-    else:
-        data.clip(limits[wavFile.info.bits_per_sample][0], limits[wavFile.info.bits_per_sample][1], out=data)
+def saveCachedFeatures(key: str, features: AudioFeatures):
+    FEATURE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = FEATURE_CACHE_DIR / '{}.npz'.format(key)
+    tempPath = path.with_suffix('.tmp')
+    features.save(tempPath)
+    os.replace(tempPath, path)
+    evictFeatureCache()
 
-    # If audio is mono, reshape data for consistency
-    if data.ndim == 1:
-        data = data[:,None]
 
-    # Find max and min values
-    maxVals = data.max(axis=0)
-    minVals = data.min(axis=0)
+def evictFeatureCache(maxBytes: int = None):
+    """
+    Removes the least recently used feature records until the cache is at most **maxBytes** (default FEATURE_CACHE_MAX_BYTES).
+    """
+    if maxBytes is None:
+        maxBytes = FEATURE_CACHE_MAX_BYTES
+    entries = []
+    for path in FEATURE_CACHE_DIR.glob('*.npz'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
 
-    DEBUG('Data type: {}'.format(data.dtype))
-    DEBUG('Max: {}'.format(maxVals))
-    DEBUG('Min: {}'.format(minVals))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
 
-    formatMin, formatMax = (-1.0, 1.0) if data.dtype == np.float32 else limits[wavFile.info.bits_per_sample]
-    maxClip = False
-    minClip = False
-    dlsClip = False
-
-    consSamples = []
-    for c in range(maxVals.size):
-        samples = getConsecutiveRuns(data[:, c], threshold)
-        for s in samples:
-            if s[0] == maxVals[c]:
-                if maxVals[c] < formatMax:
-                    maxClip = True
-            elif s[0] == minVals[c]:
-                if minVals[c] < formatMin:
-                    minClip = True
-            elif abs(s[0]) / formatMax > 1e-3: # this needs to be changed if unsigned WAVs will be used
-                dlsClip = True
-        
-        consSamples.extend(samples)
 
-    consSamples.sort(key = lambda x: (x[1][0], x[1][1])) # Sort by time for viewing purpose
-    for s in consSamples:
-        if s[0] == formatMax or s[0] == formatMin or s[0] in maxVals or s[0] in minVals or abs(s[0]) / formatMax < 1e-3:
-            continue
-        cons.append('{:.2f} sec ({} samples, value: {})'.format(s[1][0] / framerate, s[1][1] - s[1][0] + 1, s[0]))
-        
-    if len(cons) > 0:
-        msg = ""
+def getFeatures(file: FileType, filepath: str, key: str = None) -> AudioFeatures:
+    """
+    Returns the AudioFeatures of a downloaded file, from the feature cache if possible.
+    - **key**: Content hash of the file, computed if not given.
+    """
+    if key is None:
+        key = hashFile(filepath)
+    features = loadCachedFeatures(key)
+    if features is None:
+        features = extractFeatures(file, filepath)
+        saveCachedFeatures(key, features)
+    return features
 
-        if dlsClip:
-            msg = "DLS clipping detected"
-            if len(cons) > 10:
-                msg = msg + " at many samples."
-            else:
-                msg = msg + " at: " + ", ".join(cons) + "."
-        elif maxClip or minClip:
-            msg = "No DLS clipping detected, but post-render volume reduction clipping detected"
-        else:
-            msg = "No DLS clipping detected, but clipping detected"
-        
-        return (False, msg)
-    else:
-        return (True, "The rip has no DLS clipping.")
 
+#=======================================#
+#          PIPELINED DOWNLOADS          #
+#=======================================#
+"""
+Rips whose sample checks come from AudioFeatures are decoded while they download: each chunk of the response is written
+to the file and to the stdin of ffmpeg as it arrives, so the features are ready soon after the last byte.
+The file is still saved (and cached) whole, for the header checks and the download cache.
+"""
+
+# Files that ffmpeg decodes from a pipe exactly as from disk. MP4 files may only be indexed at their end,
+# and WAV files are checked separately since extractFeatures reads them without ffmpeg.
+PIPE_DECODED_TYPES = (flac.FLAC, aiff.AIFF, mp3.MP3, ogg.OggFileType)
 
-def checkDLSClippingFromFile(file: FileType, filepath: str, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD) -> Tuple[bool, str]:
+def canDecodeFromPipe(file: FileType, head: bytes) -> bool:
     """
-    Checks whether a mutagen File has DLS clipping.
-    Requires the file having been downloaded locally.
+    Whether the features of a file decoded from a pipe are the same as those extractFeatures gets from the saved file.
+    - **file**: The file parsed from its first bytes only, or None if mutagen could not parse it.
+    - **head**: These first bytes.
     """
-    wav_filepath = Path(filepath)
-    newfile = False
-    if not isinstance(file, wave.WAVE):
-        newfile = True
-        wav_filepath = "{}_temp.wav".format(Path.joinpath(wav_filepath.parent, wav_filepath.stem))
-    else:
-        DEBUG('Bits per sample: {}'.format(file.info.bits_per_sample))
-        
-    if not os.path.exists(wav_filepath):
-        ffmpegToWAV(filepath, wav_filepath)
+    if file is None:
+        # mutagen needs the last Ogg page for the length, but Ogg files are not decoded to integers anyway (see getNativeBits)
+        return head.startswith(b'OggS')
+    if isinstance(file, wave.WAVE):
+        # analyzeWAV reads floats as they are, but ffmpeg would be asked for integers (see getNativeBits)
+        try:
+            _, _, dtype, _, _ = readWAVHeader(io.BytesIO(head))
+        except QoCException:
+            return False
+        return not np.issubdtype(dtype, np.floating)
+    return isinstance(file, PIPE_DECODED_TYPES)
+
+
+def downloadAudioWithFeaturesFromUrl(validUrl: str, directory: Path = None) -> Tuple[Path, str, str]:
+    """
+    Downloads a file like downloadAudioFromUrl, extracting its AudioFeatures into the feature cache at the same time
+    (see saveDownloadWithFeatures). Returns its path, its content hash, or None as the hash if it was not pipelined,
+    and its validator (see downloadValidator).
+    """
+    entry = loadDownloadEntry(validUrl)
+    response = getResponseFromUrl(validUrl, headers=conditionalHeaders(entry))
+    validator = downloadValidator(response.status_code, response.headers, entry)
+    if (entry is not None and downloadIsFresh(response.status_code, response.headers, entry)) or not canPipelineResponse(response.status_code, response.headers):
+        return saveDownload(validUrl, response, entry, True, directory), None, validator
+
+    try:
+        return (*saveDownloadWithFeatures(validUrl, response.headers, iterResponseChunks(response, validUrl), directory), validator)
+    finally:
+        response.close()    # hands the connection back to the pool
 
-    check, msg = checkDLSClipping(wav_filepath, threshold)
 
-    if newfile:
-        os.remove(wav_filepath)
+async def downloadAudioWithFeaturesFromUrlAsync(validUrl: str, executor = None, directory: Path = None) -> Tuple[Path, str, str]:
+    """
+    asyncio variant of downloadAudioWithFeaturesFromUrl. The response is read from the running event loop,
+    while the file is written and decoded in **executor** (default: the loop's default executor).
+    """
+    loop = asyncio.get_running_loop()
+    session = await getAsyncSession()
+    entry = await loop.run_in_executor(executor, loadDownloadEntry, validUrl)
+    try:
+        async with getHostSemaphore(validUrl), session.get(validUrl, headers=conditionalHeaders(entry)) as response:
+            validator = downloadValidator(response.status, response.headers, entry)
+            if (entry is not None and downloadIsFresh(response.status, response.headers, entry)) or not canPipelineResponse(response.status, response.headers):
+                return await saveDownloadAsync(validUrl, response, entry, True, directory), None, validator
+            chunks = iterAsyncChunks(iterResponseChunksAsync(response, validUrl), loop)
+            return (*await loop.run_in_executor(executor, saveDownloadWithFeatures, validUrl, response.headers, chunks, directory), validator)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise asyncRequestError(e)
 
-    return (check, msg)
 
-def checkDLSClippingFromUrl(validUrl: str, threshold: int = DEFAULT_DS_CLIPPING_THRESHOLD) -> Tuple[bool, str]:
+def saveDownloadWithFeatures(validUrl: str, headers, chunks, directory: Path = None) -> Tuple[Path, str]:
     """
-    Checks whether a URL media has DLS clipping.
-    Will only download locally if the URL contains WAV; otherwise convert to local WAV file directly.
+    Saves the file sent in a response from an iterator over its body, and adds it to the download cache.
+    The first PARTIAL_HEAD_BYTES are parsed by mutagen to know how to decode it, then the body is teed into ffmpeg
+    (see teeChunks) for its AudioFeatures, which are added to the feature cache.
+    Files that cannot be decoded from a pipe (see canDecodeFromPipe) are only saved.
+
+    Returns the path of the file and its content hash.
     """
-    contentType = getHeadFromUrl(validUrl)['Content-Type'].lower()
-    wav_filepath = DOWNLOAD_DIR / 'temp.wav'
-    if 'wav' in contentType:
-        wav_filepath = downloadAudioFromUrl(validUrl)
-    else:
-        ffmpegToWAV(validUrl, wav_filepath)
+    chunks = iter(chunks)
+    filepath = (directory or DOWNLOAD_DIR) / getResponseFilename(validUrl, headers)
+    head = []
+    download = {}
 
-    check, msg = checkDLSClipping(wav_filepath, threshold)
+    def feed(stdin = None):
+        download['hash'] = teeChunks(itertools.chain(head, chunks), filepath, stdin)
+
+    try:
+        for chunk in chunks:
+            head.append(chunk)
+            if sum(map(len, head)) >= PARTIAL_HEAD_BYTES:
+                break
+        with open(filepath, 'wb') as f:
+            f.truncate(int(headers['Content-Length']))  # the rest reads as zeros until it arrives, like in downloadAudioHeadFromUrl
+            f.write(b''.join(head))
+        try:
+            file = parseAudio(filepath)
+        except MutagenError:
+            file = None
+
+        features = None
+        if canDecodeFromPipe(file, b''.join(head)):
+            try:
+                framerate, analyzers = analyzeStream(None, FEATURE_ANALYZERS, bits=None if file is None else getNativeBits(file), feed=feed)
+                features = collectFeatures(framerate, analyzers)
+            except QoCException as e:
+                if 'hash' not in download:
+                    raise
+                DEBUG('Could not decode the download as it arrived, it will be decoded again: {}'.format(e.message))
+        else:
+            feed()
+    except QoCException:
+        Path(filepath).unlink(missing_ok=True)
+        raise
 
-    os.remove(wav_filepath)
+    contentHash = download['hash']
+    if features is not None:
+        saveCachedFeatures(contentHash, features)
+    cacheDownload(validUrl, headers, filepath, contentHash)
 
-    return (check, msg)
+    DEBUG('Downloaded filepath: {}'.format(filepath))
+    return filepath, contentHash
 
 
 #=======================================#
@@ -606,7 +3459,13 @@ Verify that video files are at least 1080p
 """
 
 def checkResolution(filepath: str) -> Tuple[bool, str]:
-    probeOutput = ffprobeUrl(filepath)
+    return checkResolutionFromProbe(ffprobeUrl(filepath))
+
+
+def checkResolutionFromProbe(probeOutput: dict) -> Tuple[bool, str]:
+    """
+    Same as checkResolution, using the output of an ffprobe run that was already done.
+    """
     height = None
     for stream in probeOutput['streams']:
         try:
@@ -635,39 +3494,40 @@ def msgContainsBitrateFix(msg: str) -> bool:
 def msgContainsClippingFix(msg: str) -> bool:
     return (msg.find("The rip is clipping") != -1) or (msg.find("The rip is heavily clipping") != -1)
 
+def msgContainsTranscodeFix(msg: str) -> bool:
+    return msg.find("may be transcoded from a low-bitrate source") != -1
+
 def msgContainsPRVRClippingFix(msg: str) -> bool:
     return msg.find("Post-render volume reduction detected") != -1
 
 def msgContainsSigninErr(msg: str) -> bool:
     return msg.find("Drive link is not accessible") != -1
 
+def msgIsSampled(msg: str) -> bool:
+    return msg.find("Provisional verdict from") != -1
+
 
 def getFileMetadataMutagen(url: str) -> Tuple[int, str]:
     """
     Returns the metadata of file at given URL via mutagen's `pprint()` function.
+    Only the start and end of the file are downloaded if the server allows it.
     """
     try:
         downloadableUrl = parseUrl(url)
     except QoCException as e:
         return (-1, e.message)
     
-    if not os.path.exists(DOWNLOAD_DIR):
-        os.mkdir(DOWNLOAD_DIR)
-    
-    filepath = None
     errors = []
 
-    try:
-        filepath = downloadAudioFromUrl(downloadableUrl)
-        DEBUG("Downloaded audio: " + Path(filepath).name)
-    except QoCException as e:
-        errors.append(e.message)
-    else:
-        file = parseAudio(filepath)
-        metadata = file.pprint()
-    finally:
-        if filepath:
-            os.remove(filepath)
+    with scratchDir() as directory:
+        try:
+            filepath = downloadAudioHeadFromUrl(downloadableUrl, directory)
+            DEBUG("Downloaded audio: " + Path(filepath).name)
+        except QoCException as e:
+            errors.append(e.message)
+        else:
+            file = parseAudio(filepath)
+            metadata = file.pprint()
 
     if len(errors) > 0:
         return (-1, '\n'.join(errors))
@@ -684,51 +3544,45 @@ def getFileMetadataFfprobe(url: str) -> Tuple[int, str]:
     except QoCException as e:
         return (-1, e.message)
 
-    if not os.path.exists(DOWNLOAD_DIR):
-        os.mkdir(DOWNLOAD_DIR)
-    
-    filepath = None
     errors = []
 
-    try:
-        filepath = downloadAudioFromUrl(downloadableUrl)
-        DEBUG("Downloaded audio: " + Path(filepath).name)
-    except QoCException as e:
-        errors.append(e.message)
-    else:
-        probeOutput = ffprobeUrl(filepath)
+    with scratchDir() as directory:
         try:
-            probeOutput['format']['filename'] = "[REDACTED]"
-        except KeyError:
-            pass
-
-        # some entries in the json may be too long to be sent on Discord
-        def redactLongStrings(obj, max_length = 300):
-            if max_length < 11:
-                raise ValueError("Cannot shorten more than the [LONG TEXT] message")
-            if isinstance(obj, dict):
-                keys_to_delete = []
-                for key, value in obj.items():
-                    if isinstance(value, str) and len(value) > max_length:
-                        keys_to_delete.append(key)
-                    else:
-                        redactLongStrings(value, max_length) # Recurse for nested objects/lists
-                for key in keys_to_delete:
-                    obj[key] = "[LONG TEXT]"
-            elif isinstance(obj, list):
-                i = 0
-                while i < len(obj):
-                    if isinstance(obj[i], str) and len(obj[i]) > max_length:
-                        obj[i] = "[LONG TEXT]"
-                    else:
-                        redactLongStrings(obj[i], max_length) # Recurse for nested objects/lists
-                        i += 1
-
-        redactLongStrings(probeOutput)
-        metadata = json.dumps(probeOutput, indent=2)
-    finally:
-        if filepath:
-            os.remove(filepath)
+            filepath = downloadAudioFromUrl(downloadableUrl, directory=directory)
+            DEBUG("Downloaded audio: " + Path(filepath).name)
+        except QoCException as e:
+            errors.append(e.message)
+        else:
+            probeOutput = ffprobeUrl(filepath)
+            try:
+                probeOutput['format']['filename'] = "[REDACTED]"
+            except KeyError:
+                pass
+
+            # some entries in the json may be too long to be sent on Discord
+            def redactLongStrings(obj, max_length = 300):
+                if max_length < 11:
+                    raise ValueError("Cannot shorten more than the [LONG TEXT] message")
+                if isinstance(obj, dict):
+                    keys_to_delete = []
+                    for key, value in obj.items():
+                        if isinstance(value, str) and len(value) > max_length:
+                            keys_to_delete.append(key)
+                        else:
+                            redactLongStrings(value, max_length) # Recurse for nested objects/lists
+                    for key in keys_to_delete:
+                        obj[key] = "[LONG TEXT]"
+                elif isinstance(obj, list):
+                    i = 0
+                    while i < len(obj):
+                        if isinstance(obj[i], str) and len(obj[i]) > max_length:
+                            obj[i] = "[LONG TEXT]"
+                        else:
+                            redactLongStrings(obj[i], max_length) # Recurse for nested objects/lists
+                            i += 1
+
+            redactLongStrings(probeOutput)
+            metadata = json.dumps(probeOutput, indent=2)
 
     if len(errors) > 0:
         return (-1, '\n'.join(errors))
@@ -736,67 +3590,410 @@ def getFileMetadataFfprobe(url: str) -> Tuple[int, str]:
     return (0, metadata)
 
 
+#=======================================#
+#             QOC PIPELINE              #
+#=======================================#
+"""
+performQoC probes each downloaded file once and decodes it at most once.
+Header checks work on the probe results, and sample checks are block analyzers sharing the same decode.
+"""
+
+DEFAULT_QOC_CHECKS = ('bitrate', 'clipping', 'resolution') # 'dlsClipping', 'transcode' and 'loudness' only run when asked for, see hq_bot's qoc_checks
+
+
+class AudioProbe:
+    """
+    Header information of a downloaded file, shared by all checks.
+    ffprobe only runs the first time its output is needed.
+    - **source**: Where ffprobe and the sample checks read the file from, if not **filepath**
+    (e.g. its URL, when only its head was downloaded, see downloadSampledRip).
+    """
+    def __init__(self, filepath: str, source: str = None):
+        self.filepath = filepath
+        self.source = source or str(filepath)
+        self.file = parseAudio(filepath)
+        self._ffprobe = None
+        self._contentHash = None
+        self._features = None
+
+    @property
+    def ffprobe(self) -> dict:
+        if self._ffprobe is None:
+            self._ffprobe = ffprobeUrl(self.source)
+        return self._ffprobe
+
+    @property
+    def contentHash(self) -> str:
+        if self._contentHash is None:
+            self._contentHash = hashFile(self.filepath)
+        return self._contentHash
+
+    @property
+    def features(self) -> AudioFeatures:
+        if self._features is None:
+            self._features = getFeatures(self.file, self.filepath, self.contentHash)
+        return self._features
+
+    @property
+    def isWAV(self) -> bool:
+        return isinstance(self.file, wave.WAVE)
+
+    @property
+    def is24bitFLAC(self) -> bool:
+        return isinstance(self.file, flac.FLAC) and self.file.info.bits_per_sample == 24
+
+    @property
+    def nativeBits(self) -> int:
+        return getNativeBits(self.file)
+
+
+def clippingAnalyzerFactory(probe: AudioProbe):
+    # do gradient analysis if file is 24-bit FLAC
+    if probe.is24bitFLAC:
+        DEBUG("Input file is detected as 24-bit FLAC. Recommend verifing clipping in Audacity.")
+        return GradientAnalyzer
+    return lambda channels, formatMin, formatMax: ClippingAnalyzer(channels, formatMin, formatMax, DEFAULT_CLIPPING_THRESHOLD)
+
+
+def dlsClippingAnalyzerFactory(probe: AudioProbe):
+    return lambda channels, formatMin, formatMax: DLSClippingAnalyzer(channels, formatMin, formatMax, DEFAULT_DS_CLIPPING_THRESHOLD)
+
+
+# Checks that only need the file headers. name -> function(probe) -> (check, msg)
+HEADER_CHECKS = {
+    'bitrate': lambda probe: checkBitrateFromFile(probe.file),
+    'resolution': lambda probe: checkResolutionFromProbe(probe.ffprobe),
+}
+
+# Header checks that mutagen can run on the start and end of a file, see downloadAudioHeadFromUrl
+PARTIAL_CHECKS = ('bitrate',)
+
+# Checks that need the decoded samples. name -> function(probe) -> BlockAnalyzer factory
+SAMPLE_CHECKS = {
+    'clipping': clippingAnalyzerFactory,
+    'dlsClipping': dlsClippingAnalyzerFactory,
+    'transcode': lambda probe: SpectrumAnalyzer,
+    'loudness': lambda probe: LoudnessAnalyzer,
+}
+
+
+# Sample checks computed from AudioFeatures. name -> function(features, probe) -> (check, msg)
+FEATURE_CHECKS = {
+    'clipping': lambda features, probe: features.clippingResult(DEFAULT_CLIPPING_THRESHOLD, probe.is24bitFLAC),
+    'dlsClipping': lambda features, probe: features.dlsClippingResult(DEFAULT_DS_CLIPPING_THRESHOLD),
+    'transcode': lambda features, probe: features.transcodeResult(),
+    'loudness': lambda features, probe: features.loudnessResult(),
+}
+
+
+def usesFeatures(checks: tuple, useFeatureCache: bool) -> bool:
+    """
+    Whether runChecks computes the sample checks of a whole file from its AudioFeatures.
+    """
+    sampleChecks = [name for name in checks if name in SAMPLE_CHECKS]
+    return len(sampleChecks) > 0 and useFeatureCache and all(name in FEATURE_CHECKS for name in sampleChecks)
+
+
+def getTriageWindows(length: float, windows: int = TRIAGE_WINDOWS, seconds: float = TRIAGE_WINDOW_SECONDS) -> list:
+    """
+    Returns **windows** (start, duration) windows of **seconds** spread evenly over a rip of **length** seconds,
+    from its start to its end, for a sampled QoC.
+    Returns None if the rip is too short for sampling to save much time, so it should be analyzed whole.
+    """
+    if not length or length < 2 * windows * seconds:
+        return None
+    return [(start, seconds) for start in np.linspace(0, length - seconds, windows).round(3).tolist()]
+
+
+def runChecks(probe: AudioProbe, checks: tuple = DEFAULT_QOC_CHECKS, useFeatureCache: bool = False, windows: list = None) -> Tuple[dict, list]:
+    """
+    Runs the given checks on a downloaded file. All sample checks share a single decode of the file.
+    Returns the (check, msg) result of each check that succeeded, and the error messages of those that did not.
+    - **useFeatureCache**: Compute the sample checks from the file's AudioFeatures, which are cached on disk,
+    instead of running their analyzers. Extracting features takes longer, but files seen before are not decoded again.
+    - **windows**: Only decode these (start, duration) windows of the file for the sample checks, see getTriageWindows.
+    The feature cache is not used then, since the features would be incomplete.
+    """
+    for name in checks:
+        if name not in HEADER_CHECKS and name not in SAMPLE_CHECKS:
+            raise ValueError('Unknown QoC check: {}'.format(name))
+
+    results = {}
+    errors = []
+
+    for name in checks:
+        if name in HEADER_CHECKS:
+            try:
+                results[name] = HEADER_CHECKS[name](probe)
+            except QoCException as e:
+                errors.append(e.message)
+
+    sampleChecks = [name for name in checks if name in SAMPLE_CHECKS]
+    if usesFeatures(checks, useFeatureCache) and windows is None:
+        try:
+            features = probe.features
+        except QoCException as e:
+            errors.append(e.message)
+        else:
+            for name in sampleChecks:
+                try:
+                    results[name] = FEATURE_CHECKS[name](features, probe)
+                except QoCException as e:
+                    errors.append(e.message)
+    elif len(sampleChecks) > 0:
+        factories = [SAMPLE_CHECKS[name](probe) for name in sampleChecks]
+        try:
+            if probe.isWAV and windows is None:
+                framerate, analyzers = analyzeWAV(probe.filepath, factories)
+            else:
+                framerate, analyzers = analyzeStream(probe.source, factories, bits=probe.nativeBits, windows=windows)
+        except QoCException as e:
+            errors.append(e.message)
+        else:
+            for name, analyzer in zip(sampleChecks, analyzers):
+                try:
+                    results[name] = analyzer.result(framerate)
+                except QoCException as e:
+                    errors.append(e.message)
+
+    return results, errors
+
+
+#=======================================#
+#             VERDICT CACHE             #
+#=======================================#
+"""
+performQoC verdicts are kept in a SQLite database, so that rips are not downloaded again while they stay pinned.
+A verdict is reused if the server's validators (ETag, Last-Modified, Content-Length) for the file are unchanged,
+which costs a HEAD request, and it was given with the same checks, analysis version and thresholds.
+Verdicts are saved under the validators of the download that was checked, not those of the HEAD request,
+so that a file replaced in between is not cached under its old validators.
+"""
+
+def verdictSettings(checks: tuple, fullFeedback: bool) -> str:
+    """
+    Everything besides the file itself that a verdict depends on.
+    """
+    return json.dumps([VERDICT_VERSION, FEATURE_VERSION, list(checks), fullFeedback,
+                       DEFAULT_CLIPPING_THRESHOLD, DEFAULT_DS_CLIPPING_THRESHOLD,
+                       SPECTRUM_FLOOR_DB, SPECTRUM_SHELF_DB, TRANSCODE_CUTOFF_HZ])
+
+
+def getUrlValidator(validUrl: str) -> str:
+    """
+    Returns the validators of the file at a URL from a HEAD request, or None if the server sends none.
+    """
+    try:
+        response = getResponseFromUrl(validUrl, True)
+    except QoCException:
+        return None
+    return responseValidator(response.status_code, response.headers)
+
+
+def responseValidator(status: int, headers) -> str:
+    if status != 200:
+        return None
+    validators = [headers.get(header) for header in VALIDATOR_HEADERS.values()]
+    if all(value is None for value in validators):
+        return None
+    return json.dumps(validators)
+
+
+def openVerdictCache() -> sqlite3.Connection:
+    VERDICT_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(VERDICT_CACHE_PATH, timeout=30)
+    db.execute('CREATE TABLE IF NOT EXISTS verdicts (url TEXT, settings TEXT, validator TEXT, code INTEGER, message TEXT, checked REAL, '
+               'PRIMARY KEY (url, settings))')
+    return db
+
+
+def loadVerdict(validUrl: str, settings: str, validator: str) -> Tuple[int, str]:
+    """
+    Returns the cached (code, msg) verdict of a URL, or None if the file or settings changed since.
+    """
+    with closing(openVerdictCache()) as db:
+        row = db.execute('SELECT code, message FROM verdicts WHERE url = ? AND settings = ? AND validator = ?',
+                         (validUrl, settings, validator)).fetchone()
+    return None if row is None else tuple(row)
+
+
+def lookupVerdict(validUrl: str, settings: str, validator: str, refresh: bool) -> Tuple[int, str]:
+    if validator is None or refresh:
+        return None
+    verdict = loadVerdict(validUrl, settings, validator)
+    if verdict is not None:
+        DEBUG("Reused cached verdict")
+    return verdict
+
+
+def saveVerdict(validUrl: str, settings: str, validator: str, code: int, msg: str):
+    now = time.time()
+    with closing(openVerdictCache()) as db, db:
+        db.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)', (validUrl, settings, validator, code, msg, now))
+        db.execute('DELETE FROM verdicts WHERE checked < ?', (now - VERDICT_MAX_DAYS * 86400,))
+
+
 #=======================================#
 #            Main Function              #
 #=======================================#
 
-def performQoC(url: str, fullFeedback: bool = True) -> Tuple[int, str]:
+def performQoC(url: str, fullFeedback: bool = True, checks: tuple = DEFAULT_QOC_CHECKS, useFeatureCache: bool = False, sampled: bool = False,
+               useVerdictCache: bool = True, refresh: bool = False) -> Tuple[int, str]:
     """
     Performs QoC on the given URL.
     
     - fullFeedback: Default True. If False, do not return "is OK" messages
+    - checks: Names of the checks to run, see HEADER_CHECKS and SAMPLE_CHECKS
+    - useFeatureCache: Default False. Reuse the analysis of files that were already checked, see runChecks.
+    Extracting the features of a new rip costs more than the checks themselves, which can stop early, so only
+    use it when the same files are checked again with other checks or thresholds
+    - sampled: Default False. If True, only analyze a few short windows of long rips for a quick provisional verdict,
+    which is marked as such (see msgIsSampled). Only the windows are transferred when the server supports it, see downloadSampledRip.
+    Rips already in the feature cache are still fully checked.
+    - useVerdictCache: Default True. Return the previous verdict of the rip if it did not change, see loadVerdict
+    - refresh: Default False. If True, check the rip again even if it did not change (the new verdict is still cached)
+
+    When useFeatureCache is set, the features of fully checked rips are extracted while they download, see downloadAudioWithFeaturesFromUrl.
     """
     try:
         downloadableUrl = parseUrl(url)
     except QoCException as e:
         return (-1, e.message)
+
+    # the HEAD request is only for the lookup, verdicts are cached under the validator of the file that was checked
+    settings = verdictSettings(checks, fullFeedback)
+    verdict = lookupVerdict(downloadableUrl, settings, getUrlValidator(downloadableUrl) if useVerdictCache and not refresh else None, refresh)
+    if verdict is not None:
+        return verdict
     
-    if not os.path.exists(DOWNLOAD_DIR):
-        os.mkdir(DOWNLOAD_DIR)
-    
-    filepath = None
-    errors = []
+    with scratchDir() as directory:
+        contentHash = None
+        source = None
+        try:
+            if all(name in PARTIAL_CHECKS for name in checks):
+                filepath, _, validator = downloadAudioHead(downloadableUrl, directory)
+            elif usesFeatures(checks, useFeatureCache) and not sampled:
+                filepath, contentHash, validator = downloadAudioWithFeaturesFromUrl(downloadableUrl, directory)
+            elif sampled and not useFeatureCache:
+                filepath, source, validator = downloadSampledRip(downloadableUrl, directory)
+            else:
+                filepath, validator = downloadAudio(downloadableUrl, directory=directory)
+        except QoCException as e:
+            return downloadErrorVerdict(url, e)
+
+        verdict = checkDownloadedRip(url, filepath, fullFeedback, checks, useFeatureCache, sampled,
+                                     (downloadableUrl, settings, validator if useVerdictCache else None), contentHash, source)
+        if verdict[0] == -1 and source is not None:
+            DEBUG('Could not decode the windows from the URL, downloading all of the rip')
+            try:
+                filepath, validator = downloadAudio(downloadableUrl, directory=directory)
+            except QoCException as e:
+                return downloadErrorVerdict(url, e)
+            verdict = checkDownloadedRip(url, filepath, fullFeedback, checks, useFeatureCache, sampled,
+                                         (downloadableUrl, settings, validator if useVerdictCache else None))
+        return verdict
+
+
+async def performQoCAsync(url: str, fullFeedback: bool = True, checks: tuple = DEFAULT_QOC_CHECKS, useFeatureCache: bool = False, sampled: bool = False,
+                          useVerdictCache: bool = True, refresh: bool = False, executor = None) -> Tuple[int, str]:
+    """
+    asyncio variant of performQoC: the requests are made from the running event loop with downloadAudioFromUrlAsync,
+    and only the checks run in **executor** (default: the loop's default executor).
+    Without aiohttp, all of performQoC runs in the executor instead.
+    """
+    loop = asyncio.get_running_loop()
+    if aiohttp is None:
+        return await loop.run_in_executor(executor, functools.partial(performQoC, url, fullFeedback, checks, useFeatureCache, sampled, useVerdictCache, refresh))
 
     try:
-        filepath = downloadAudioFromUrl(downloadableUrl)
-        DEBUG("Downloaded audio: " + Path(filepath).name)
-    
+        downloadableUrl = parseUrl(url)
     except QoCException as e:
-        if 'drive' in url and 'Sign-in' in e.message:
-            # custom return value for sign-in issues, return 1 so it doesn't get filtered
-            return (1, "Drive link is not accessible. Ask Mailroom to reupload if this is an email sub.")
-        errors.append(e.message)
-    
-    else:
-        file = parseAudio(filepath)
-        DEBUG("File metadata: " + file.pprint())
+        return (-1, e.message)
 
-        try:
-            bitrateCheck, bitrateMsg = checkBitrateFromFile(file)
-        except QoCException as e:
-            errors.append(e.message)
+    settings = verdictSettings(checks, fullFeedback)
+    verdict = lookupVerdict(downloadableUrl, settings, await getUrlValidatorAsync(downloadableUrl) if useVerdictCache and not refresh else None, refresh)
+    if verdict is not None:
+        return verdict
 
+    with scratchDir() as directory:
+        contentHash = None
+        source = None
         try:
-            clippingCheck, clippingMsg = checkClippingFromFile(file, filepath)
+            if all(name in PARTIAL_CHECKS for name in checks):
+                filepath, _, validator = await loop.run_in_executor(executor, downloadAudioHead, downloadableUrl, directory)
+            elif usesFeatures(checks, useFeatureCache) and not sampled:
+                filepath, contentHash, validator = await downloadAudioWithFeaturesFromUrlAsync(downloadableUrl, executor, directory)
+            elif sampled and not useFeatureCache:
+                filepath, source, validator = await loop.run_in_executor(executor, downloadSampledRip, downloadableUrl, directory)
+            else:
+                filepath, validator = await downloadAudioAsync(downloadableUrl, directory=directory)
         except QoCException as e:
-            errors.append(e.message)
+            return downloadErrorVerdict(url, e)
+
+        verdict = await loop.run_in_executor(executor, functools.partial(checkDownloadedRip, url, filepath, fullFeedback, checks, useFeatureCache, sampled,
+                                                                         (downloadableUrl, settings, validator if useVerdictCache else None), contentHash, source))
+        if verdict[0] == -1 and source is not None:
+            DEBUG('Could not decode the windows from the URL, downloading all of the rip')
+            try:
+                filepath, validator = await downloadAudioAsync(downloadableUrl, directory=directory)
+            except QoCException as e:
+                return downloadErrorVerdict(url, e)
+            verdict = await loop.run_in_executor(executor, functools.partial(checkDownloadedRip, url, filepath, fullFeedback, checks, useFeatureCache, sampled,
+                                                                             (downloadableUrl, settings, validator if useVerdictCache else None)))
+        return verdict
+
+
+def downloadErrorVerdict(url: str, e: QoCException) -> Tuple[int, str]:
+    if 'drive' in url and 'Sign-in' in e.message:
+        # custom return value for sign-in issues, return 1 so it doesn't get filtered
+        return (1, "Drive link is not accessible. Ask Mailroom to reupload if this is an email sub.")
+    return (-1, e.message)
+
+
+def checkDownloadedRip(url: str, filepath: str, fullFeedback: bool, checks: tuple, useFeatureCache: bool, sampled: bool,
+                       verdictKey: Tuple[str, str, str], contentHash: str = None, source: str = None) -> Tuple[int, str]:
+    """
+    Second half of performQoC, once the rip is downloaded: runs the checks, removes the file and caches the verdict.
+    - **verdictKey**: (downloadable URL, settings, validator) to cache the verdict under, if the validator is not None.
+    - **contentHash**: Content hash of the file if it was computed during the download.
+    - **source**: URL to decode the rip from, if only its head was downloaded (see downloadSampledRip).
+    """
+    DEBUG("Downloaded audio: " + Path(filepath).name)
+    errors = []
+    windows = None
+
+    try:
+        probe = AudioProbe(filepath, source)
+        probe._contentHash = contentHash
+        DEBUG("File metadata: " + probe.file.pprint())
+
+        sampleChecks = any(name in SAMPLE_CHECKS for name in checks)
+        if sampled and sampleChecks and not (useFeatureCache and loadCachedFeatures(probe.contentHash) is not None):
+            windows = getTriageWindows(getattr(probe.file.info, 'length', 0))
 
-        resolutionCheck, resolutionMsg = checkResolution(filepath)
+        results, checkErrors = runChecks(probe, checks, useFeatureCache, windows)
+        errors.extend(checkErrors)
     
     finally:
-        if filepath:
-            os.remove(filepath)
+        os.remove(filepath)
 
     if len(errors) > 0:
         return (-1, '\n'.join(errors))
     
     msgs = []
-    if fullFeedback or not bitrateCheck: msgs.append(bitrateMsg)
-    if fullFeedback or not clippingCheck: msgs.append(clippingMsg)
-    if fullFeedback or not resolutionCheck: msgs.append(resolutionMsg)
+    for name in checks:
+        check, msg = results[name]
+        if fullFeedback or not check: msgs.append(msg)
+    if windows is not None:
+        msgs.append("Provisional verdict from {} sampled windows of {}s, the whole rip was not checked yet.".format(len(windows), TRIAGE_WINDOW_SECONDS))
     message = "\n".join("- " + msg for msg in msgs)
+    code = 0 if all(results[name][0] for name in checks) else 1
+
+    downloadableUrl, settings, validator = verdictKey
+    if validator is not None and windows is None:
+        saveVerdict(downloadableUrl, settings, validator, code, message)
 
-    return (0 if (bitrateCheck and clippingCheck and resolutionCheck) else 1, message)
+    return (code, message)
 
 """
 Commented this out to work on it later
@@ -2,10 +2,34 @@ import unittest
 import os
 from pathlib import Path
 from inspect import getsourcefile
+from unittest.mock import patch
 from mutagen import File
+from scipy.io import wavfile
+import numpy as np
+import tempfile
+import threading
+import http.server
+import asyncio
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from simpleQoC.qoc import parseUrl, downloadAudioFromUrl, checkBitrateFromFile, checkClippingFromFile, \
-                    checkBitrateFromUrl, checkClippingFromUrl, QoCException, DOWNLOAD_DIR
+from simpleQoC.qoc import parseUrl, downloadAudioFromUrl, downloadAudio, checkBitrateFromFile, checkClippingFromFile, \
+                    checkBitrateFromUrl, checkClippingFromUrl, QoCException, DOWNLOAD_DIR, \
+                    checkClippingFromStream, checkDLSClippingFromStream, checkDLSClippingFromFile, \
+                    checkClippingFromWAV, checkDLSClippingFromWAV, openWAVMemmap, iterWAVBlocks, \
+                    AudioProbe, runChecks, checkResolutionFromProbe, ffmpegToWAVStream, findRuns, RunTracker, \
+                    ClippingAnalyzer, DLSClippingAnalyzer, dlsClippingVerdict, getNativeBits, setAnalysisThreads, ANALYSIS_THREADS, \
+                    GradientAnalyzer, getRunHistogramFromFile, evictFeatureCache, \
+                    EnvelopeAnalyzer, renderEnvelope, scanRuns, packRuns, findChannelRuns, jitScanRuns, getTriageWindows, \
+                    SpectrumAnalyzer, checkTranscodeFromFile, LoudnessAnalyzer, FingerprintAnalyzer, FingerprintIndex, \
+                    fingerprintErrorRate, findAudioDupes, analyzeStream, FINGERPRINT_MAX_BER, \
+                    getSession, setHTTPPoolSize, getHeadFromUrl, HTTP_POOL_SIZE, evictDownloadCache, \
+                    aiohttp, downloadAudioFromUrlAsync, closeAsyncSession, getAsyncSession, getHostKey, getHostSemaphore, \
+                    downloadAudioHeadFromUrl, downloadAudioWithFeaturesFromUrl, downloadAudioWithFeaturesFromUrlAsync, \
+                    saveDownloadWithFeatures, hashFile, scratchDir, clearScratchDirs, setCacheDir, SCRATCH_DIR_PREFIX, CACHE_DIR, \
+                    hostFailures, hostBackoff, hostRecovered, resumeDelay, DEFAULT_QOC_CHECKS, msgIsSampled, loadVerdict, verdictSettings
 
 TEST_DIR = Path(os.path.abspath(getsourcefile(lambda:0))).parent
 
@@ -36,11 +60,32 @@ TEST_URLS = {
     'lowBitrate.ogg': "https://drive.google.com/file/d/18IC3fwYRIH8Iwf_lFmTp_lKIx7vpGcHK/view?usp=drive_link",
 }
 
+class CacheTestCase(unittest.TestCase):
+    """
+    Base of test suites running checks that fill the caches of qoc, with every cache in a temporary directory
+    """
+    def setUp(self):
+        self.cacheDir = tempfile.TemporaryDirectory()
+        cacheDir = Path(self.cacheDir.name)
+        self.patches = [
+            patch('simpleQoC.qoc.VERDICT_CACHE_PATH', cacheDir / 'verdicts.sqlite3'),
+            patch('simpleQoC.qoc.DOWNLOAD_CACHE_DIR', cacheDir / 'downloads'),
+            patch('simpleQoC.qoc.FEATURE_CACHE_DIR', cacheDir / 'features'),
+            patch('simpleQoC.qoc.FINGERPRINT_DIR', cacheDir / 'fingerprints'),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.cacheDir.cleanup()
+
 #=======================================#
 #           URL DOWNLOADING             #
 #=======================================#
 
-class TestDownload(unittest.TestCase):
+class TestDownload(CacheTestCase):
     """
     Test suites for the downloadAudioFromUrl function
     """
@@ -129,6 +174,228 @@ class TestDownload(unittest.TestCase):
             if filepath:
                 os.remove(filepath)
 
+class LocalFileServer(http.server.ThreadingHTTPServer):
+    """
+    Serves a directory (by default the test files) over keep-alive HTTP on localhost,
+    counting the connections made to it and the status codes it answered with.
+    - **ranges**: Answer single-range Range requests.
+    - **drops**: Close the connection after sending **dropAfter** bytes of the body of this many responses.
+    """
+    daemon_threads = True
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def __init__(self, request, clientAddress, server):
+            super().__init__(request, clientAddress, server, directory=str(server.directory))
+
+        def log_request(self, code='-', size='-'):
+            self.server.statuses.append(int(code))
+
+        def do_GET(self):
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            path = Path(self.translate_path(self.path))
+            if not ((self.server.ranges and match or self.server.drops > 0) and path.is_file()):
+                return super().do_GET()
+
+            data = path.read_bytes()
+            start, stop = 0, len(data)
+            if self.server.ranges and match:
+                start = int(match.group(1))
+                stop = min(len(data), int(match.group(2)) + 1) if match.group(2) else len(data)
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, stop - 1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', self.guess_type(str(path)))
+            self.send_header('Content-Length', str(stop - start))
+            self.send_header('Last-Modified', self.date_time_string(int(path.stat().st_mtime)))
+            self.end_headers()
+
+            if self.server.drops > 0:
+                self.server.drops -= 1
+                stop = min(stop, start + self.server.dropAfter)
+                self.close_connection = True
+            self.wfile.write(data[start:stop])
+
+    def __init__(self, directory: Path = TEST_DIR, ranges: bool = False, drops: int = 0, dropAfter: int = 100000):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.directory = directory
+        self.ranges = ranges
+        self.drops = drops
+        self.dropAfter = dropAfter
+        self.connections = 0
+        self.statuses = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def get_request(self):
+        self.connections += 1
+        return super().get_request()
+
+    def url(self, filename: str) -> str:
+        return 'http://127.0.0.1:{}/{}'.format(self.server_port, filename)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestSession(unittest.TestCase):
+    """
+    Test suites for the HTTP sessions shared by downloads
+    """
+    def setUp(self):
+        self.server = LocalFileServer()
+        DOWNLOAD_DIR.mkdir(exist_ok=True)
+
+    def tearDown(self):
+        self.server.close()
+        setHTTPPoolSize(HTTP_POOL_SIZE)
+
+    def testKeepAlive(self):
+        for _ in range(3):
+            self.assertIn('audio', getHeadFromUrl(self.server.url('goodQuality.flac'))['Content-Type'])
+            filepath = downloadAudioFromUrl(self.server.url('goodQuality.flac'), useCache=False)
+            self.assertEqual(Path(filepath).read_bytes(), (TEST_DIR / 'goodQuality.flac').read_bytes())
+            os.remove(filepath)
+        self.assertEqual(self.server.connections, 1)
+
+    def testThreads(self):
+        sessions = [getSession()]
+        thread = threading.Thread(target=lambda: sessions.append(getSession()))
+        thread.start()
+        thread.join()
+        self.assertIs(getSession(), sessions[0])
+        self.assertIsNot(sessions[1], sessions[0])
+        self.assertIs(sessions[1].get_adapter('https://'), sessions[0].get_adapter('https://'))
+
+        setHTTPPoolSize(2)
+        self.assertIsNot(getSession(), sessions[0])
+        self.assertEqual(getSession().get_adapter('https://')._pool_maxsize, 2)
+
+class TestDownloadCache(unittest.TestCase):
+    """
+    Test suites for the download cache, with files served from a temporary directory
+    """
+    def setUp(self):
+        self.servedDir = tempfile.TemporaryDirectory()
+        self.cacheDir = tempfile.TemporaryDirectory()
+        self.cachePatch = patch('simpleQoC.qoc.DOWNLOAD_CACHE_DIR', Path(self.cacheDir.name))
+        self.cachePatch.start()
+        self.server = LocalFileServer(Path(self.servedDir.name))
+        DOWNLOAD_DIR.mkdir(exist_ok=True)
+
+    def tearDown(self):
+        self.server.close()
+        self.cachePatch.stop()
+        self.servedDir.cleanup()
+        self.cacheDir.cleanup()
+
+    def serve(self, filename: str, contents: bytes, mtime: float = 1e9):
+        path = Path(self.servedDir.name) / filename
+        path.write_bytes(contents)
+        os.utime(path, (mtime, mtime))
+
+    def download(self, filename: str) -> bytes:
+        filepath = downloadAudioFromUrl(self.server.url(filename))
+        self.assertEqual(filepath, DOWNLOAD_DIR / filename)
+        contents = Path(filepath).read_bytes()
+        os.remove(filepath)
+        return contents
+
+    def cachedFiles(self) -> list:
+        return list((Path(self.cacheDir.name) / 'files').glob('*'))
+
+    def testReuse(self):
+        self.serve('a.wav', b'first')
+        self.assertEqual(self.download('a.wav'), b'first')
+        self.assertEqual(self.download('a.wav'), b'first')
+        self.assertEqual(self.server.statuses, [200, 304])
+
+        # changed on the server
+        self.serve('a.wav', b'second', 2e9)
+        self.assertEqual(self.download('a.wav'), b'second')
+        self.assertEqual(self.server.statuses[-1], 200)
+
+    def testSameContents(self):
+        self.serve('a.wav', b'same')
+        self.serve('b.wav', b'same')
+        self.download('a.wav')
+        self.download('b.wav')
+        self.assertEqual(len(self.cachedFiles()), 1)
+        self.assertEqual(self.download('b.wav'), b'same')
+        self.assertEqual(self.server.statuses, [200, 200, 304])
+
+    def testEviction(self):
+        self.serve('a.wav', b'first')
+        self.download('a.wav')
+        evictDownloadCache(0)
+        self.assertEqual(self.cachedFiles(), [])
+        self.assertEqual(self.download('a.wav'), b'first')
+        self.assertEqual(self.server.statuses, [200, 200])
+
+class TestPartialDownload(unittest.TestCase):
+    """
+    Test suites for downloadAudioHeadFromUrl
+    """
+    FILES = ['goodQuality.flac', 'goodQuality.mp3', 'goodQuality.mp4', 'goodQuality.ogg', 'goodQuality.wav', 'lowBitrate.m4a']
+
+    def setUp(self):
+        self.cacheDir = tempfile.TemporaryDirectory()
+        self.cachePatch = patch('simpleQoC.qoc.DOWNLOAD_CACHE_DIR', Path(self.cacheDir.name))
+        self.cachePatch.start()
+        DOWNLOAD_DIR.mkdir(exist_ok=True)
+
+    def tearDown(self):
+        self.cachePatch.stop()
+        self.cacheDir.cleanup()
+
+    def download(self, server: LocalFileServer, filename: str) -> File:
+        filepath = downloadAudioHeadFromUrl(server.url(filename))
+        self.assertEqual(filepath, DOWNLOAD_DIR / filename)
+        try:
+            self.assertEqual(os.path.getsize(filepath), os.path.getsize(TEST_DIR / filename))
+            return File(filepath)
+        finally:
+            os.remove(filepath)
+
+    def testRanges(self):
+        server = LocalFileServer(ranges=True)
+        try:
+            for filename in self.FILES:
+                with self.subTest(filename=filename):
+                    file = self.download(server, filename)
+                    self.assertEqual(file.pprint(), File(TEST_DIR / filename).pprint())
+                    self.assertEqual(checkBitrateFromFile(file), checkBitrateFromFile(File(TEST_DIR / filename)))
+            # lowBitrate.m4a is smaller than PARTIAL_HEAD_BYTES, so it has no tail to fetch
+            self.assertEqual(server.statuses, [206] * (2 * len(self.FILES) - 1))
+
+            # header-only QoC
+            server.statuses.clear()
+            self.assertEqual(performQoC(server.url('lowBitrate.mp3'), checks=('bitrate',), useVerdictCache=False),
+                             (1, "- " + checkBitrateFromFile(File(TEST_DIR / 'lowBitrate.mp3'))[1]))
+            self.assertEqual(set(server.statuses), {206})
+        finally:
+            server.close()
+
+    def testFallbacks(self):
+        server = LocalFileServer()
+        try:
+            # Range is ignored, the whole file is sent at once
+            self.assertEqual(self.download(server, 'goodQuality.mp3').pprint(), File(TEST_DIR / 'goodQuality.mp3').pprint())
+            self.assertEqual(server.statuses, [200])
+        finally:
+            server.close()
+
+        server = LocalFileServer(ranges=True)
+        try:
+            # the headers do not fit in the partial download
+            with patch('simpleQoC.qoc.PARTIAL_HEAD_BYTES', 16), patch('simpleQoC.qoc.PARTIAL_TAIL_BYTES', 16):
+                self.assertEqual(self.download(server, 'goodQuality.mp4').pprint(), File(TEST_DIR / 'goodQuality.mp4').pprint())
+            self.assertEqual(server.statuses, [206, 206, 200])
+        finally:
+            server.close()
+
 #=======================================#
 #           BITRATE CHECKING            #
 #=======================================#
@@ -208,7 +475,7 @@ class TestBitrateFromFile(unittest.TestCase, BaseTestBitrate):
     def checkBitrate(self, filename: str):
         return checkBitrateFromFile(File(TEST_DIR / filename))
 
-class TestBitrateFromUrl(unittest.TestCase, BaseTestBitrate):
+class TestBitrateFromUrl(CacheTestCase, BaseTestBitrate):
     def checkBitrate(self, filename: str):
         return checkBitrateFromUrl(parseUrl(TEST_URLS[filename]))
 
@@ -336,24 +603,442 @@ class TestClippingFromFile(unittest.TestCase, BaseTestClipping):
     def checkClipping(self, filename: str):
         return checkClippingFromFile(File(TEST_DIR / filename), TEST_DIR / filename)
 
-class TestClippingFromUrl(unittest.TestCase, BaseTestClipping):
+class TestClippingFromFileBatch(unittest.TestCase, BaseTestClipping):
+    def checkClipping(self, filename: str):
+        return checkClippingFromFile(File(TEST_DIR / filename), TEST_DIR / filename, streaming=False)
+
+class TestClippingFromUrl(CacheTestCase, BaseTestClipping):
     def checkClipping(self, filename: str):
         return checkClippingFromUrl(parseUrl(TEST_URLS[filename]))
 
+
+class TestClippingStream(unittest.TestCase):
+    """
+    Test suites for the streaming clipping checks: small blocks must give the same result as the batch path
+    """
+    FILES = ['clipping1.mp3', 'clipping2.mp3', 'clipping5.ogg', 'goodQuality.flac', 'goodQuality.aiff', 'goodQuality.mp2']
+    BLOCK_SIZE = 1021
+
+    def testClippingSmallBlocks(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                batch = checkClippingFromFile(File(TEST_DIR / filename), TEST_DIR / filename, streaming=False)
+                bits = getNativeBits(File(TEST_DIR / filename))
+                self.assertEqual(checkClippingFromStream(str(TEST_DIR / filename), blockSize=self.BLOCK_SIZE, bits=bits), batch)
+
+    def testDLSClippingSmallBlocks(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                batch = checkDLSClippingFromFile(File(TEST_DIR / filename), TEST_DIR / filename, streaming=False)
+                bits = getNativeBits(File(TEST_DIR / filename))
+                self.assertEqual(checkDLSClippingFromStream(str(TEST_DIR / filename), blockSize=self.BLOCK_SIZE, bits=bits), batch)
+
+    def testEarlyExit(self):
+        # Square wave hitting the format limits: the verdict is known after the first block
+        block = np.repeat(np.array([[32767, -32767], [1000, 2000], [-32767, 32767], [-1000, -2000]], dtype=np.int16), 6, axis=0)
+        block = np.tile(block, (8, 1))
+        for earlyExit in (True, False):
+            with self.subTest(earlyExit=earlyExit):
+                clipping = ClippingAnalyzer(2, -32767, 32767, 3, earlyExit)
+                dls = DLSClippingAnalyzer(2, -32767, 32767, 5, earlyExit)
+                for analyzer in (clipping, dls):
+                    analyzer.process(block.copy())
+                    self.assertEqual(analyzer.done, earlyExit)
+                self.assertEqual(clipping.result(100), (False, "The rip is heavily clipping."))
+                self.assertEqual(dls.result(100), (False, "DLS clipping detected at many samples."))
+
+    def testDLSBoundedMemory(self):
+        # Limited square wave: its runs are at the max/min of their channel, so they cannot be settled while streaming
+        square = np.repeat(np.tile(np.array([[20000, -20000], [-20000, 20000]], dtype=np.int16), (2000, 1)), 6, axis=0)
+        plateaus = np.repeat(np.array([[12345, 500]], dtype=np.int16), 6, axis=0)
+        for name, data in [('listed', np.concatenate((square, plateaus, square))), ('many', np.concatenate((square // 2, plateaus, square)))]:
+            with self.subTest(data=name):
+                expected = dlsClippingVerdict(findRuns(data, 5), 100, data.max(axis=0), data.min(axis=0), -32767, 32767)
+                analyzer = DLSClippingAnalyzer(2, -32767, 32767, 5, earlyExit=False)
+                for i in range(0, len(data), 1021):
+                    analyzer.process(data[i:i+1021])
+                    # at most MAX_LISTED_CLIPS runs for each of the 4 extreme values
+                    self.assertLessEqual(0 if analyzer.pending is None else len(analyzer.pending), 40)
+                self.assertEqual(analyzer.result(100), expected)
+
+    def testRunHistogram(self):
+        for filename in self.FILES + ['clipping3.wav', 'clipping4.wav', 'goodQuality.wav']:
+            with self.subTest(filename=filename):
+                file = File(TEST_DIR / filename)
+                histogram = getRunHistogramFromFile(file, TEST_DIR / filename, blockSize=self.BLOCK_SIZE)
+                for threshold in (2, 3, 5):
+                    check, msg = checkClippingFromFile(file, TEST_DIR / filename, threshold)
+                    self.assertEqual(histogram.isClipping(threshold), not check)
+                    self.assertEqual(histogram.hasVolumeReduction(threshold), 'Post-render volume reduction' in msg)
+                    self.assertEqual(histogram.hasDLSClipping(threshold), not checkDLSClippingFromFile(file, TEST_DIR / filename, threshold)[0])
+
+    def testGradientSmallBlocks(self):
+        data = (np.random.default_rng(0).integers(-2**23, 2**23, size=(1000, 2)) * 256).astype(np.int32)
+        gradient = np.gradient(data, axis=0)
+        for blockSize in (1, 2, 3, 1021):
+            with self.subTest(blockSize=blockSize):
+                analyzer = GradientAnalyzer(2, -2**31 + 1, 2**31 - 1, earlyExit=False)
+                for i in range(0, len(data), blockSize):
+                    analyzer.process(data[i:i+blockSize])
+                analyzer.result(100)
+                self.assertEqual((analyzer.maxG, analyzer.minG), (gradient.max(), gradient.min()))
+
+    def testEnvelopePyramid(self):
+        data = np.random.default_rng(0).integers(-32767, 32768, size=(10000, 2)).astype(np.int16)
+        analyzer = EnvelopeAnalyzer(2, -32767, 32767, window=16)
+        for i in range(0, len(data), 1021):
+            analyzer.process(data[i:i+1021])
+        pyramid = analyzer.result(100)
+        self.assertEqual([len(levelMax) for levelMax, _ in pyramid.levels], [625, 157, 40])
+        for level, (levelMax, levelMin) in enumerate(pyramid.levels):
+            window = 16 * 4**level
+            np.testing.assert_array_equal(levelMax[3], data[3*window:4*window].max(axis=0))
+            np.testing.assert_array_equal(levelMin[-1], data[(len(levelMin)-1)*window:].min(axis=0))
+
+        window, snippetMax, snippetMin = pyramid.snippet(1000, 2000, 20)
+        self.assertEqual((window, len(snippetMax)), (64, 17))
+        self.assertEqual(len(renderEnvelope(snippetMax[:, 0], snippetMin[:, 0], 4).split('\n')), 4)
+
+    def testTriage(self):
+        # Peaks occur fewer times than the threshold: no run detection needed
+        data = np.array([[5, 1], [5, 2], [-3, 3], [0, 3], [0, 3], [0, -2]], dtype=np.int16)
+        analyzer = ClippingAnalyzer(2, -32767, 32767, 3)
+        analyzer.useExtremes(data.max(axis=0), data.min(axis=0), np.array([2, 3]), np.array([1, 1]))
+        np.testing.assert_array_equal(analyzer.candidates, [1])
+        analyzer.process(data)
+        self.assertEqual(analyzer.result(100), (False, "The rip is clipping at: 0.02 sec (3 samples). Post-render volume reduction detected, please lower the volume before rendering."))
+
+        analyzer = ClippingAnalyzer(2, -32767, 32767, 4)
+        analyzer.useExtremes(data.max(axis=0), data.min(axis=0), np.array([2, 3]), np.array([1, 1]))
+        self.assertTrue(analyzer.done)
+        self.assertEqual(analyzer.result(100), (True, "The rip is not clipping."))
+
+
+class TestClippingWAV(unittest.TestCase):
+    """
+    Test suites for the memory-mapped WAV clipping checks
+    """
+    FILES = ['clipping2inverted.wav', 'clipping3.wav', 'clipping4.wav', 'clipping24bit.wav', 'goodQuality.wav', 'goodQualityMono.wav']
+    BLOCK_SIZE = 1021
+
+    def testReadBlocks(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                framerate, data = wavfile.read(TEST_DIR / filename)
+                if data.ndim == 1:
+                    data = data[:,None]
+                mmFramerate, bits, mm = openWAVMemmap(TEST_DIR / filename)
+                blocks = np.concatenate([block.copy() for block in iterWAVBlocks(mm, bits, self.BLOCK_SIZE)])
+                self.assertEqual(mmFramerate, framerate)
+                np.testing.assert_array_equal(blocks, data)
+
+    def testClippingSmallBlocks(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                batch = checkClippingFromFile(File(TEST_DIR / filename), TEST_DIR / filename, streaming=False)
+                self.assertEqual(checkClippingFromWAV(TEST_DIR / filename, blockSize=self.BLOCK_SIZE), batch)
+
+    def testDLSClippingSmallBlocks(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                batch = checkDLSClippingFromFile(File(TEST_DIR / filename), TEST_DIR / filename, streaming=False)
+                self.assertEqual(checkDLSClippingFromWAV(TEST_DIR / filename, blockSize=self.BLOCK_SIZE), batch)
+
+class TestRuns(unittest.TestCase):
+    """
+    Test suites for the run-length kernel shared by the clipping checks
+    """
+    DATA = np.array([[1, 5], [1, 5], [1, 5], [2, 5], [3, 0], [3, 0], [4, 0], [4, 7]], dtype=np.int16)
+
+    def testFindRuns(self):
+        runs = findRuns(self.DATA, 2)
+        self.assertEqual([tuple(r) for r in runs], [(0, 0, 3, 1), (0, 4, 2, 3), (0, 6, 2, 4), (1, 0, 4, 5), (1, 4, 3, 0)])
+        self.assertEqual([tuple(r) for r in findRuns(self.DATA, 4)], [(1, 0, 4, 5)])
+
+    def testRunTracker(self):
+        for blockSize in range(1, len(self.DATA) + 1):
+            with self.subTest(blockSize=blockSize):
+                tracker = RunTracker(self.DATA.shape[1], 2)
+                runs = [tracker.process(self.DATA[i:i+blockSize]) for i in range(0, len(self.DATA), blockSize)]
+                runs = np.concatenate(runs + [tracker.finish()])
+                self.assertEqual(sorted(tuple(r) for r in runs), [tuple(r) for r in findRuns(self.DATA, 2)])
+
+    def testRunTrackerSeek(self):
+        # Runs open before a gap are closed there, and the next window is counted from its own start
+        tracker = RunTracker(self.DATA.shape[1], 2)
+        runs = [tracker.process(self.DATA[:4]), tracker.seek(10), tracker.process(self.DATA[4:]), tracker.finish()]
+        self.assertEqual(sorted(tuple(r) for r in np.concatenate(runs)), [(0, 0, 3, 1), (0, 10, 2, 3), (0, 12, 2, 4), (1, 0, 4, 5), (1, 10, 3, 0)])
+
+    def testParallelRuns(self):
+        data = np.random.default_rng(0).integers(-2, 3, size=(1000, 6)).astype(np.int16)
+        serial = findRuns(data, 3, data[0], keepEdges=True)
+        try:
+            setAnalysisThreads(4)
+            with patch('simpleQoC.qoc.PARALLEL_MIN_SAMPLES', 1):
+                parallel = findRuns(data, 3, data[0], keepEdges=True)
+        finally:
+            setAnalysisThreads(ANALYSIS_THREADS)
+        np.testing.assert_array_equal(parallel, serial)
+
+    def testScanRuns(self):
+        rng = np.random.default_rng(1)
+        for dtype in (np.int16, np.int32, np.float32):
+            data = rng.integers(-2, 3, size=(500, 3)).astype(dtype)
+            for minLength, previous, keepEdges in ((2, None, False), (3, data[0], True), (5, data[-1], False), (1, None, True)):
+                with self.subTest(dtype=dtype, minLength=minLength, previous=previous is not None, keepEdges=keepEdges), \
+                     patch('simpleQoC.qoc.jitScanRuns', None):
+                    scanned = packRuns(data, *scanRuns(data, minLength, data[0] if previous is None else previous, previous is not None, keepEdges))
+                    np.testing.assert_array_equal(scanned, findChannelRuns(data, minLength, previous, keepEdges))
+
+    @unittest.skipIf(jitScanRuns is None, 'numba is not installed')
+    def testJITRuns(self):
+        for filename in ('clipping2inverted.wav', 'clipping3.wav', 'clipping4.wav', 'goodQualityMono.wav'):
+            with self.subTest(filename=filename):
+                _, data = wavfile.read(TEST_DIR / filename)
+                data = data.reshape(len(data), -1)
+                with patch('simpleQoC.qoc.jitScanRuns', None):
+                    expected = findChannelRuns(data, 2, data[0], True)
+                np.testing.assert_array_equal(findChannelRuns(data, 2, data[0], True), expected)
+
+#=======================================#
+#          TRANSCODE DETECTION          #
+#=======================================#
+
+class TestTranscode(unittest.TestCase):
+    """
+    Test suites for the spectral transcode detector, on white noise with and without a lowpass
+    """
+    FRAMERATE = 44100
+
+    def noise(self, cutoff: float = None) -> np.ndarray:
+        data = np.random.default_rng(2).normal(0, 3000, size=(self.FRAMERATE * 4, 2))
+        if cutoff is not None:
+            # brickwall lowpass, like lossy encoders
+            spectrum = np.fft.rfft(data, axis=0)
+            spectrum[np.fft.rfftfreq(len(data), 1 / self.FRAMERATE) > cutoff] = 0
+            data = np.fft.irfft(spectrum, len(data), axis=0)
+        return data.astype(np.int16)
+
+    def analyze(self, data: np.ndarray, blockSize: int) -> SpectrumAnalyzer:
+        analyzer = SpectrumAnalyzer(data.shape[1], -32767, 32767)
+        for i in range(0, len(data), blockSize):
+            analyzer.process(data[i:i+blockSize])
+        return analyzer
+
+    def testLowpass(self):
+        check, msg = self.analyze(self.noise(16000), 65536).result(self.FRAMERATE)
+        self.assertFalse(check)
+        self.assertIn("Detected a hard lowpass at 16.", msg)
+        self.assertEqual(self.analyze(self.noise(), 65536).result(self.FRAMERATE), (True, "No low-bitrate lowpass detected."))
+
+    def testSmallBlocks(self):
+        data = self.noise(16000)
+        expected = self.analyze(data, 65536)
+        analyzer = self.analyze(data, 1021)
+        self.assertEqual(analyzer.windows, expected.windows)
+        np.testing.assert_allclose(analyzer.meanPower(), expected.meanPower(), rtol=1e-4)
+
+    def testFiles(self):
+        self.assertEqual(checkTranscodeFromFile(File(TEST_DIR / 'goodQuality.flac'), TEST_DIR / 'goodQuality.flac')[0], True)
+        self.assertEqual(checkTranscodeFromFile(File(TEST_DIR / 'lowBitrate.m4a'), TEST_DIR / 'lowBitrate.m4a')[0], False)
+
+#=======================================#
+#               LOUDNESS                #
+#=======================================#
+
+class TestLoudness(unittest.TestCase):
+    """
+    Test suites for the loudness analyzer, on sines of known loudness and true peak
+    """
+    def analyze(self, data: np.ndarray, framerate: int, blockSize: int) -> LoudnessAnalyzer:
+        analyzer = LoudnessAnalyzer(data.shape[1], -1.0, 1.0)
+        analyzer.framerate = framerate
+        for i in range(0, len(data), blockSize):
+            analyzer.process(data[i:i+blockSize])
+        return analyzer
+
+    def testReferenceSine(self):
+        # EBU Tech 3341: a 1kHz stereo sine at -23dBFS measures -23 LUFS
+        for framerate in (44100, 48000):
+            with self.subTest(framerate=framerate):
+                sine = 10**(-23 / 20) * np.sin(2 * np.pi * 1000 * np.arange(framerate * 10) / framerate)
+                data = np.stack((sine, sine), axis=1).astype(np.float32)
+                loudness, _ = self.analyze(data, framerate, 65536).loudness()
+                self.assertAlmostEqual(loudness, -23, delta=0.1)
+                np.testing.assert_allclose(self.analyze(data, framerate, 1021).loudness(), self.analyze(data, framerate, 65536).loudness())
+
+    def testTruePeak(self):
+        # A sine at a quarter of the framerate sampled 45 degrees off its peaks: sample peak -3dB, true peak 0dB
+        sine = np.sin(np.pi / 2 * np.arange(48000) + np.pi / 4)[:, None].astype(np.float32)
+        _, truePeak = self.analyze(sine, 48000, 65536).loudness()
+        self.assertAlmostEqual(truePeak, 0, delta=0.5)
+        self.assertLess(20 * np.log10(np.abs(sine).max()), -2.9)
+
+    def testSilence(self):
+        data = np.zeros((48000, 2), dtype=np.int16)
+        self.assertEqual(self.analyze(data, 48000, 65536).result(48000), (True, "The rip is too short or quiet to measure its loudness."))
+
+#=======================================#
+#             FINGERPRINTS              #
+#=======================================#
+
+class TestFingerprint(unittest.TestCase):
+    """
+    Test suites for audio fingerprints and their index. All good quality fixtures are encodes of the same audio
+    """
+    def fingerprint(self, filename: str) -> np.ndarray:
+        file = File(TEST_DIR / filename)
+        _, (analyzer,) = analyzeStream(str(TEST_DIR / filename), [FingerprintAnalyzer], bits=getNativeBits(file))
+        return analyzer.fingerprint()
+
+    def noise(self) -> np.ndarray:
+        analyzer = FingerprintAnalyzer(2, -32767, 32767)
+        analyzer.framerate = 44100
+        analyzer.process(np.random.default_rng(3).normal(0, 3000, size=(44100 * 15, 2)).astype(np.int16))
+        return analyzer.fingerprint()
+
+    def testSmallBlocks(self):
+        data = np.random.default_rng(4).normal(0, 3000, size=(44100 * 3, 2)).astype(np.int16)
+        fingerprints = []
+        for blockSize in (65536, 1021):
+            analyzer = FingerprintAnalyzer(2, -32767, 32767)
+            analyzer.framerate = 44100
+            for i in range(0, len(data), blockSize):
+                analyzer.process(data[i:i+blockSize])
+            fingerprints.append(analyzer.fingerprint())
+        self.assertEqual(len(fingerprints[0]), 116)
+        np.testing.assert_array_equal(fingerprints[0], fingerprints[1])
+
+    def testSameAudio(self):
+        fingerprint = self.fingerprint('goodQuality.flac')
+        self.assertEqual(fingerprintErrorRate(fingerprint, fingerprint, 0), (0.0, len(fingerprint)))
+        for filename in ['goodQuality.mp3', 'goodQuality.ogg', 'goodQualityMono.wav']:
+            with self.subTest(filename=filename):
+                other = self.fingerprint(filename)
+                self.assertLess(min(fingerprintErrorRate(fingerprint, other, offset)[0] for offset in (-1, 0, 1)), FINGERPRINT_MAX_BER)
+        self.assertGreater(fingerprintErrorRate(fingerprint, self.noise(), 0)[0], 0.4)
+
+    def testIndex(self):
+        with tempfile.TemporaryDirectory() as indexDir:
+            index = FingerprintIndex(indexDir)
+            index.add('flac', 'flacKey', self.fingerprint('goodQuality.flac'))
+            index.add('noise', 'noiseKey', self.noise())
+            index = FingerprintIndex(indexDir)
+
+            mp3 = self.fingerprint('goodQuality.mp3')
+            self.assertEqual([url for url, _ in index.query(mp3)], ['flac'])
+            self.assertEqual([url for url, _ in index.query(mp3[123:])], ['flac'])
+            self.assertEqual([url for url, _ in index.query(self.noise())], ['noise'])
+
+            # a new file at the same URL replaces the old one
+            index.add('flac', 'mp3Key', mp3)
+            self.assertEqual(sorted(Path(indexDir).glob('*Key.npy')), [Path(indexDir) / 'mp3Key.npy', Path(indexDir) / 'noiseKey.npy'])
+            np.testing.assert_array_equal(index.fingerprintOf('flac'), mp3)
+            self.assertIsNone(index.fingerprintOf('mp3'))
+
+            with patch('simpleQoC.qoc.FINGERPRINT_MAX_RIPS', 2):
+                index.add('ogg', 'oggKey', self.fingerprint('goodQuality.ogg'))
+            self.assertEqual(sorted(url for url, _ in index.rips.values()), ['flac', 'ogg'])
+            self.assertEqual([url for url, _ in index.query(self.noise())], [])
+
+    def testFindAudioDupes(self):
+        with tempfile.TemporaryDirectory() as indexDir, patch('simpleQoC.qoc.FINGERPRINT_DIR', Path(indexDir)):
+            index = FingerprintIndex()
+            index.add('flac', 'flacKey', self.fingerprint('goodQuality.flac'))
+            index.add('mp3', 'mp3Key', self.fingerprint('goodQuality.mp3'))
+            index.add('noise', 'noiseKey', self.noise())
+            with patch('simpleQoC.qoc.downloadAudioFromUrl') as download:
+                self.assertEqual(findAudioDupes('flac', ['mp3', 'noise', 'unknown']), (['mp3'], 2))
+                self.assertEqual(findAudioDupes('mp3'), (['flac'], 2))
+                download.assert_not_called()
+
+#=======================================#
+#             QOC PIPELINE              #
+#=======================================#
+
+class TestPipeline(unittest.TestCase):
+    """
+    Test suites for runChecks: each check should give the same result as when run on its own
+    """
+    FILES = ['clipping2.mp3', 'clipping3.wav', 'clipping24bit.flac', 'goodQuality.flac', 'goodQualityMono.wav', 'lowBitrate.ogg']
+
+    def testSameResults(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                file = File(TEST_DIR / filename)
+                results, errors = runChecks(AudioProbe(TEST_DIR / filename), ('bitrate', 'clipping', 'dlsClipping', 'transcode'))
+                self.assertEqual(errors, [])
+                self.assertEqual(results['bitrate'], checkBitrateFromFile(file))
+                self.assertEqual(results['clipping'], checkClippingFromFile(file, TEST_DIR / filename, streaming=False))
+                self.assertEqual(results['dlsClipping'], checkDLSClippingFromFile(file, TEST_DIR / filename, streaming=False))
+                self.assertEqual(results['transcode'], checkTranscodeFromFile(file, TEST_DIR / filename))
+
+    def testDecodeOnce(self):
+        with patch('simpleQoC.qoc.ffmpegToWAVStream', wraps=ffmpegToWAVStream) as decode:
+            runChecks(AudioProbe(TEST_DIR / 'clipping5.ogg'), ('bitrate', 'clipping', 'dlsClipping'))
+            decode.assert_called_once()
+
+    def testFeatureCache(self):
+        with tempfile.TemporaryDirectory() as cacheDir, patch('simpleQoC.qoc.FEATURE_CACHE_DIR', Path(cacheDir)):
+            for filename in self.FILES:
+                with self.subTest(filename=filename):
+                    expected, _ = runChecks(AudioProbe(TEST_DIR / filename), ('clipping', 'dlsClipping', 'transcode'))
+                    self.assertEqual(runChecks(AudioProbe(TEST_DIR / filename), ('clipping', 'dlsClipping', 'transcode'), True), (expected, []))
+                    with patch('simpleQoC.qoc.analyzeStream') as stream, patch('simpleQoC.qoc.analyzeWAV') as wav:
+                        self.assertEqual(runChecks(AudioProbe(TEST_DIR / filename), ('clipping', 'dlsClipping', 'transcode'), True), (expected, []))
+                        stream.assert_not_called()
+                        wav.assert_not_called()
+
+            self.assertEqual(len(list(Path(cacheDir).glob('*.npz'))), len(self.FILES))
+            evictFeatureCache(0)
+            self.assertEqual(list(Path(cacheDir).glob('*.npz')), [])
+
+    def testOptInCheck(self):
+        # the informational checks are not part of the default verdict
+        self.assertEqual(DEFAULT_QOC_CHECKS, ('bitrate', 'clipping', 'resolution'))
+        # loudness is in the features, so the same cached record serves it
+        with tempfile.TemporaryDirectory() as cacheDir, patch('simpleQoC.qoc.FEATURE_CACHE_DIR', Path(cacheDir)):
+            expected, _ = runChecks(AudioProbe(TEST_DIR / 'goodQuality.flac'), ('clipping', 'loudness'))
+            self.assertEqual(runChecks(AudioProbe(TEST_DIR / 'goodQuality.flac'), ('clipping', 'loudness'), True), (expected, []))
+            self.assertEqual(len(list(Path(cacheDir).glob('*.npz'))), 1)
+
+    def testWindows(self):
+        # Windows covering the whole file in order give the same results as decoding it in one go
+        windows = [(0, 5), (5, 5), (10, 10)]
+        for filename in ['clipping2inverted.wav', 'clipping3.wav', 'goodQuality.flac', 'clipping24bit.flac']:
+            with self.subTest(filename=filename):
+                expected, _ = runChecks(AudioProbe(TEST_DIR / filename), ('clipping', 'dlsClipping'))
+                self.assertEqual(runChecks(AudioProbe(TEST_DIR / filename), ('clipping', 'dlsClipping'), windows=windows), (expected, []))
+
+    def testTriageWindows(self):
+        self.assertIsNone(getTriageWindows(30))
+        windows = getTriageWindows(180, 4, 3)
+        self.assertEqual(windows, [(0, 3), (59, 3), (118, 3), (177, 3)])
+
+    def testUnknownCheck(self):
+        with self.assertRaises(ValueError):
+            runChecks(AudioProbe(TEST_DIR / 'goodQuality.mp3'), ('bitrate', 'loudness?'))
+
+    def testResolutionFromProbe(self):
+        self.assertEqual(checkResolutionFromProbe({'streams': [{'codec_type': 'audio'}]}), (True, "No video streams detected"))
+        self.assertEqual(checkResolutionFromProbe({'streams': [{'height': 720}]})[0], False)
+        self.assertEqual(checkResolutionFromProbe({'streams': [{'height': 1080}]})[0], True)
+
+
 #=======================================#
 #            Main Function              #
 #=======================================#
 
-from simpleQoC.qoc import performQoC
+from simpleQoC.qoc import performQoC, performQoCAsync
 
-class TestOverall(unittest.TestCase):
+class TestOverall(CacheTestCase):
     """
     A few test cases to make sure all functions work together fine
     """
     def testOverall(self):
         check, msg = performQoC("https://siiva-gunner.com/?id=vnrufKKnxu")
         self.assertEqual(check, 0)
-        self.assertEqual(msg, "- Bitrate is OK.\n- The rip is not clipping.\n-No video streams detected")
+        self.assertEqual(msg, "- Bitrate is OK.\n- The rip is not clipping.\n- No video streams detected")
 
     def testOverallV2(self):
         check, msg = performQoC(TEST_URLS['clipping5.ogg'])
@@ -378,6 +1063,407 @@ class TestOverall(unittest.TestCase):
         self.assertEqual(check, -1)
 
 
+class LocalRipTestCase(CacheTestCase):
+    """
+    Base of test suites running performQoC on rips served from localhost, with every cache in a temporary directory
+    """
+    def setUp(self):
+        super().setUp()
+        self.server = LocalFileServer()
+
+    def tearDown(self):
+        self.server.close()
+        super().tearDown()
+
+
+class TestVerdictCache(LocalRipTestCase):
+    """
+    Test suites for the verdict cache of performQoC
+    """
+    def testReuse(self):
+        url = self.server.url('clipping2.mp3')
+        checks = ('bitrate', 'clipping')
+        expected = performQoC(url, checks=checks)
+        self.assertEqual(expected[0], 1)
+        with patch('simpleQoC.qoc.downloadAudio', wraps=downloadAudio) as download, \
+             patch('simpleQoC.qoc.downloadAudioWithFeaturesFromUrl', wraps=downloadAudioWithFeaturesFromUrl) as pipelinedDownload:
+            self.assertEqual(performQoC(url, checks=checks), expected)
+            self.assertEqual(performQoC(url, checks=checks, sampled=True), expected)
+            download.assert_not_called()
+            pipelinedDownload.assert_not_called()
+
+            self.assertEqual(performQoC(url, checks=checks, refresh=True), expected)
+            self.assertEqual(performQoC(url, checks=('bitrate',)), (0, "- Bitrate is OK."))
+            self.assertEqual(performQoC(url, checks=checks, useVerdictCache=False), expected)
+            self.assertEqual(download.call_count + pipelinedDownload.call_count, 3)
+
+    def testReplacedFile(self):
+        # the file changes between the HEAD request and the download: the verdict is not cached under the old validators
+        url = self.server.url('clipping2.mp3')
+        checks = ('bitrate', 'clipping')
+        with patch('simpleQoC.qoc.getUrlValidator', return_value='["old", null, "1"]'):
+            expected = performQoC(url, checks=checks)
+        self.assertIsNone(loadVerdict(url, verdictSettings(checks, True), '["old", null, "1"]'))
+        with patch('simpleQoC.qoc.downloadAudio') as download:
+            self.assertEqual(performQoC(url, checks=checks), expected)
+            download.assert_not_called()
+
+    def testErrors(self):
+        url = self.server.url('missing.mp3')
+        self.assertEqual(performQoC(url)[0], -1)
+        self.assertEqual(self.server.statuses, [404, 404])
+
+
+
+class TestAsyncQoC(LocalRipTestCase):
+    """
+    Test suites for performQoCAsync and the asyncio download engine
+    """
+    def testSameResults(self):
+        async def run():
+            try:
+                return await asyncio.gather(*[performQoCAsync(self.server.url(filename), checks=('bitrate', 'clipping')) for filename in filenames])
+            finally:
+                await closeAsyncSession()
+        filenames = ['clipping2.mp3', 'goodQuality.flac', 'missing.flac']
+        results = asyncio.run(run())
+        for filename, result in zip(filenames, results):
+            with self.subTest(filename=filename):
+                self.assertEqual(result, performQoC(self.server.url(filename), checks=('bitrate', 'clipping'), useVerdictCache=False))
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+    def testDownload(self):
+        async def run():
+            try:
+                return await asyncio.gather(downloadAudioFromUrlAsync(self.server.url('goodQuality.flac')),
+                                            downloadAudioFromUrlAsync(self.server.url('goodQuality.flac')))
+            finally:
+                await closeAsyncSession()
+        for filepath in asyncio.run(run()):
+            self.assertEqual(Path(filepath).read_bytes(), (TEST_DIR / 'goodQuality.flac').read_bytes())
+        os.remove(filepath)
+        # the second download was a cache hit, if it started after the first one was cached
+        self.assertIn(self.server.statuses, ([200, 200], [200, 304]))
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+    def testHostSemaphores(self):
+        self.assertEqual(getHostKey('https://drive.usercontent.google.com/download?id=1'), 'drive.usercontent.google.com')
+        self.assertEqual(getHostKey('https://www.dropbox.com/scl/fi/1/a.mp3?dl=1'), 'dropbox.com')
+        self.assertEqual(getHostKey('https://files.catbox.moe/a.mp3'), 'files.catbox.moe')
+
+        async def run():
+            try:
+                with patch('simpleQoC.qoc.DEFAULT_HOST_CONCURRENCY', 1):
+                    await downloadAudioFromUrlAsync(self.server.url('goodQuality.flac'), useCache=False)
+                    semaphore = getHostSemaphore(self.server.url('goodQuality.flac'))
+                    self.assertIs(getHostSemaphore(self.server.url('clipping2.mp3')), semaphore)
+                    async with semaphore:
+                        download = asyncio.ensure_future(downloadAudioFromUrlAsync(self.server.url('clipping2.mp3'), useCache=False))
+                        await asyncio.sleep(0.2)
+                        self.assertEqual(self.server.statuses, [200])
+                    os.remove(await download)
+            finally:
+                await closeAsyncSession()
+        asyncio.run(run())
+        os.remove(DOWNLOAD_DIR / 'goodQuality.flac')
+        self.assertEqual(self.server.statuses, [200, 200])
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+    def testLoopChange(self):
+        async def download():
+            os.remove(await downloadAudioFromUrlAsync(self.server.url('goodQuality.flac'), useCache=False))
+            return await getAsyncSession()
+        first = asyncio.run(download())
+        self.assertFalse(first.closed)
+
+        async def run():
+            try:
+                return await download()
+            finally:
+                await closeAsyncSession()
+        self.assertIsNot(asyncio.run(run()), first)
+        self.assertTrue(first.closed)
+
+
+class TestPipelinedDownload(LocalRipTestCase):
+    """
+    Test suites for downloadAudioWithFeaturesFromUrl: rips decoded while they download should get the same features
+    """
+    FILES = ['clipping2.mp3', 'clipping3.wav', 'clipping24bit.flac', 'clipping24bit.wav', 'goodQuality.aiff', 'lowBitrate.ogg', 'lowBitrate.m4a']
+    CHECKS = ('bitrate', 'clipping', 'dlsClipping', 'transcode')
+
+    def setUp(self):
+        super().setUp()
+        DOWNLOAD_DIR.mkdir(exist_ok=True)
+
+    def testSameFeatures(self):
+        for filename in self.FILES:
+            with self.subTest(filename=filename):
+                with patch('simpleQoC.qoc.analyzeWAV') as wav:
+                    filepath, contentHash, _ = downloadAudioWithFeaturesFromUrl(self.server.url(filename))
+                    wav.assert_not_called()
+                try:
+                    self.assertEqual(Path(filepath).read_bytes(), (TEST_DIR / filename).read_bytes())
+                    self.assertEqual(contentHash, hashFile(TEST_DIR / filename))
+                finally:
+                    os.remove(filepath)
+
+                # the features are already cached, unless the file could not be decoded from a pipe
+                expected, _ = runChecks(AudioProbe(TEST_DIR / filename), self.CHECKS)
+                with patch('simpleQoC.qoc.analyzeStream', wraps=analyzeStream) as stream:
+                    self.assertEqual(runChecks(AudioProbe(TEST_DIR / filename), self.CHECKS, True), (expected, []))
+                    self.assertEqual(stream.called, filename.endswith('.m4a'))
+
+    def testSameResults(self):
+        for filename in ['clipping2.mp3', 'goodQuality.flac', 'missing.flac']:
+            with self.subTest(filename=filename):
+                with patch('simpleQoC.qoc.downloadAudioWithFeaturesFromUrl', side_effect=lambda url, directory: (downloadAudioFromUrl(url, directory=directory), None, None)):
+                    expected = performQoC(self.server.url(filename), checks=('bitrate', 'clipping'), useVerdictCache=False, useFeatureCache=True)
+                self.assertEqual(performQoC(self.server.url(filename), checks=('bitrate', 'clipping'), useVerdictCache=False, useFeatureCache=True, refresh=True), expected)
+                # the default path runs the analyzers of the checks instead
+                self.assertEqual(performQoC(self.server.url(filename), checks=('bitrate', 'clipping'), useVerdictCache=False), expected)
+
+    def testDefaultPath(self):
+        # without the feature cache, rips are not pipelined and no features are extracted
+        with patch('simpleQoC.qoc.downloadAudioWithFeaturesFromUrl') as pipelinedDownload:
+            self.assertEqual(performQoC(self.server.url('clipping2.mp3'), checks=('bitrate', 'clipping'))[0], 1)
+            pipelinedDownload.assert_not_called()
+        self.assertFalse((Path(self.cacheDir.name) / 'features').exists())
+
+    def testConnectionError(self):
+        def chunks():
+            yield (TEST_DIR / 'goodQuality.flac').read_bytes()[:500000]
+            raise QoCException('Connection error. Connection reset by peer')
+        headers = {'Content-Type': 'audio/flac', 'Content-Length': str(os.path.getsize(TEST_DIR / 'goodQuality.flac'))}
+        with self.assertRaises(QoCException) as e:
+            saveDownloadWithFeatures(self.server.url('goodQuality.flac'), headers, chunks())
+        self.assertIn('Connection error', e.exception.message)
+        self.assertFalse((DOWNLOAD_DIR / 'goodQuality.flac').exists())
+
+    def testCacheHit(self):
+        url = self.server.url('goodQuality.flac')
+        os.remove(downloadAudioWithFeaturesFromUrl(url)[0])
+        filepath, contentHash, _ = downloadAudioWithFeaturesFromUrl(url)
+        os.remove(filepath)
+        self.assertIsNone(contentHash)
+        self.assertEqual(self.server.statuses, [200, 304])
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+    def testAsync(self):
+        async def run():
+            try:
+                return await downloadAudioWithFeaturesFromUrlAsync(self.server.url('clipping24bit.flac'))
+            finally:
+                await closeAsyncSession()
+        filepath, contentHash, _ = asyncio.run(run())
+        os.remove(filepath)
+        self.assertEqual(contentHash, hashFile(TEST_DIR / 'clipping24bit.flac'))
+        expected, _ = runChecks(AudioProbe(TEST_DIR / 'clipping24bit.flac'), self.CHECKS)
+        with patch('simpleQoC.qoc.analyzeStream') as stream:
+            self.assertEqual(runChecks(AudioProbe(TEST_DIR / 'clipping24bit.flac'), self.CHECKS, True), (expected, []))
+            stream.assert_not_called()
+
+
+class TestScratchDirs(LocalRipTestCase):
+    """
+    Test suites for the scratch directories of QoC jobs
+    """
+    def jobDirs(self) -> list:
+        return list(DOWNLOAD_DIR.glob(SCRATCH_DIR_PREFIX + '*'))
+
+    def testCleanup(self):
+        with scratchDir() as first, scratchDir() as second:
+            self.assertNotEqual(first, second)
+            self.assertEqual(first.parent, DOWNLOAD_DIR)
+        with self.assertRaises(QoCException):
+            with scratchDir() as directory:
+                (directory / 'temp.wav').touch()
+                raise QoCException('ERROR: ffmpeg failed')
+        self.assertFalse(directory.exists())
+
+        performQoC(self.server.url('clipping2.mp3'), checks=('bitrate', 'clipping'))
+        performQoC(self.server.url('missing.mp3'))
+        self.assertEqual(self.jobDirs(), [])
+
+        # left behind by a job that was killed
+        leftover = Path(tempfile.mkdtemp(prefix=SCRATCH_DIR_PREFIX, dir=DOWNLOAD_DIR))
+        (leftover / 'video0.mp4').touch()
+        kept = Path(tempfile.mkdtemp(dir=DOWNLOAD_DIR)) # e.g. the caches
+        try:
+            clearScratchDirs()
+            self.assertFalse(leftover.exists())
+            self.assertTrue(kept.exists())
+        finally:
+            shutil.rmtree(kept)
+
+    def testSetCacheDir(self):
+        with tempfile.TemporaryDirectory() as directory, patch('simpleQoC.qoc.CACHE_DIR', CACHE_DIR):
+            setCacheDir(directory)
+            performQoC(self.server.url('clipping2.mp3'), checks=('bitrate', 'clipping'))
+            self.assertTrue((Path(directory) / 'verdicts.sqlite3').exists())
+            self.assertTrue(any((Path(directory) / 'downloads').rglob('*')))
+
+    def testSameFilenames(self):
+        # two different rips sent under the same name, checked at once
+        with tempfile.TemporaryDirectory() as directory:
+            for subdirectory, filename in [('a', 'clipping16bit.flac'), ('b', 'goodQuality.flac')]:
+                (Path(directory) / subdirectory).mkdir()
+                shutil.copyfile(TEST_DIR / filename, Path(directory) / subdirectory / 'video0.flac')
+            server = LocalFileServer(Path(directory))
+            try:
+                urls = [server.url('a/video0.flac'), server.url('b/video0.flac')]
+                with ThreadPoolExecutor(2) as executor:
+                    results = list(executor.map(lambda url: performQoC(url, checks=('bitrate', 'clipping'), useVerdictCache=False, useFeatureCache=False), urls))
+            finally:
+                server.close()
+        for filename, result in zip(['clipping16bit.flac', 'goodQuality.flac'], results):
+            with self.subTest(filename=filename):
+                self.assertEqual(result, performQoC(self.server.url(filename), checks=('bitrate', 'clipping'), useVerdictCache=False, useFeatureCache=False))
+
+
+class TestSampledQoC(LocalRipTestCase):
+    """
+    Test suites for sampled QoC of rips on servers supporting Range, whose windows are decoded from the URL
+    """
+    CHECKS = ('bitrate', 'clipping', 'dlsClipping')
+
+    def testSameResults(self):
+        server = LocalFileServer(ranges=True)
+        windows = lambda length, *args: [(0, 2), (5, 2), (10, 2)] if length > 12 else None
+        try:
+            with patch('simpleQoC.qoc.getTriageWindows', side_effect=windows):
+                for filename in ['clipping2.mp3', 'clipping3.wav', 'goodQuality.flac', 'lowBitrate.ogg']:
+                    with self.subTest(filename=filename):
+                        # the server of LocalRipTestCase ignores Range, so the whole rip is downloaded
+                        expected = performQoC(self.server.url(filename), checks=self.CHECKS, sampled=True, useVerdictCache=False)
+                        self.assertTrue(msgIsSampled(expected[1]))
+                        self.assertEqual(performQoC(server.url(filename), checks=self.CHECKS, sampled=True, useVerdictCache=False), expected)
+                        self.assertNotIn(200, server.statuses)
+        finally:
+            server.close()
+
+    def testShortRip(self):
+        server = LocalFileServer(ranges=True)
+        try:
+            expected = performQoC(self.server.url('clipping2.mp3'), checks=self.CHECKS, useVerdictCache=False)
+            self.assertEqual(performQoC(server.url('clipping2.mp3'), checks=self.CHECKS, sampled=True, useVerdictCache=False), expected)
+            self.assertIn(200, server.statuses)
+        finally:
+            server.close()
+
+
+class TestAudioDupes(LocalRipTestCase):
+    """
+    Test suites for findAudioDupes on rips that were not compared before
+    """
+    def testFingerprintOnDemand(self):
+        flac, mp3 = self.server.url('goodQuality.flac'), self.server.url('goodQuality.mp3')
+        performQoC(flac)
+        self.assertEqual(FingerprintIndex().rips, {})
+
+        self.assertEqual(findAudioDupes(flac, [mp3]), ([], 0))
+        self.assertEqual(findAudioDupes(mp3, [flac]), ([flac], 1))
+        with patch('simpleQoC.qoc.downloadAudioFromUrl') as download:
+            self.assertEqual(findAudioDupes(flac, [mp3]), ([mp3], 1))
+            download.assert_not_called()
+
+
+class TestResumableDownload(unittest.TestCase):
+    """
+    Test suites for downloads resumed after the connection drops
+    """
+    def setUp(self):
+        self.patches = [
+            patch('simpleQoC.qoc.DOWNLOAD_BACKOFF_SECONDS', 0.01),
+            patch.dict('simpleQoC.qoc.hostFailures', clear=True),
+        ]
+        for p in self.patches:
+            p.start()
+        DOWNLOAD_DIR.mkdir(exist_ok=True)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def download(self, server: LocalFileServer, filename: str):
+        filepath = downloadAudioFromUrl(server.url(filename), useCache=False)
+        try:
+            self.assertEqual(Path(filepath).read_bytes(), (TEST_DIR / filename).read_bytes())
+        finally:
+            os.remove(filepath)
+
+    def testResume(self):
+        server = LocalFileServer(ranges=True, drops=3)
+        try:
+            self.download(server, 'goodQuality.flac')
+            self.assertEqual(server.statuses, [200, 206, 206, 206])
+            self.assertEqual(hostFailures, {})
+        finally:
+            server.close()
+
+    def testGiveUp(self):
+        server = LocalFileServer(ranges=True, drops=10)
+        try:
+            with patch('simpleQoC.qoc.DOWNLOAD_RETRIES', 2), self.assertRaises(QoCException) as e:
+                self.download(server, 'goodQuality.flac')
+            self.assertIn('Connection error', e.exception.message)
+            self.assertEqual(server.statuses, [200, 206, 206])
+        finally:
+            server.close()
+
+        # the server cannot resume, and sends the whole file again
+        server = LocalFileServer(drops=1)
+        try:
+            with self.assertRaises(QoCException):
+                self.download(server, 'goodQuality.flac')
+            self.assertEqual(server.statuses, [200, 200])
+        finally:
+            server.close()
+
+    def testBackoff(self):
+        url = 'https://drive.usercontent.google.com/download?id=1'
+        self.assertEqual([hostBackoff(url) for _ in range(4)], [0.01, 0.02, 0.04, 0.08])
+        with patch('simpleQoC.qoc.DOWNLOAD_MAX_BACKOFF_SECONDS', 0.05):
+            self.assertEqual(hostBackoff(url), 0.05)
+        hostRecovered(url)
+        self.assertEqual(resumeDelay(url, 0, time.monotonic() + 1), 0.01)
+        self.assertIsNone(resumeDelay(url, 0, time.monotonic()))
+        with patch('simpleQoC.qoc.DOWNLOAD_RETRIES', 2):
+            self.assertIsNone(resumeDelay(url, 2, time.monotonic() + 1))
+
+    def testPipelined(self):
+        server = LocalFileServer(ranges=True, drops=2, dropAfter=300000)
+        try:
+            with tempfile.TemporaryDirectory() as cacheDir, patch('simpleQoC.qoc.FEATURE_CACHE_DIR', Path(cacheDir) / 'features'), \
+                 patch('simpleQoC.qoc.DOWNLOAD_CACHE_DIR', Path(cacheDir) / 'downloads'):
+                filepath, contentHash, _ = downloadAudioWithFeaturesFromUrl(server.url('clipping16bit.flac'))
+                os.remove(filepath)
+                self.assertEqual(contentHash, hashFile(TEST_DIR / 'clipping16bit.flac'))
+                expected, _ = runChecks(AudioProbe(TEST_DIR / 'clipping16bit.flac'), ('clipping', 'transcode'))
+                with patch('simpleQoC.qoc.analyzeStream') as stream:
+                    self.assertEqual(runChecks(AudioProbe(TEST_DIR / 'clipping16bit.flac'), ('clipping', 'transcode'), True), (expected, []))
+                    stream.assert_not_called()
+            self.assertEqual(server.statuses, [200, 206, 206])
+        finally:
+            server.close()
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+    def testAsync(self):
+        async def run():
+            try:
+                return await downloadAudioFromUrlAsync(server.url('goodQuality.flac'), useCache=False)
+            finally:
+                await closeAsyncSession()
+        server = LocalFileServer(ranges=True, drops=2)
+        try:
+            filepath = asyncio.run(run())
+            self.assertEqual(Path(filepath).read_bytes(), (TEST_DIR / 'goodQuality.flac').read_bytes())
+            os.remove(filepath)
+            self.assertEqual(server.statuses, [200, 206, 206])
+        finally:
+            server.close()
+
+
 import simpleQoC
 import sys
 
@@ -386,4 +1472,4 @@ if __name__ == '__main__':
         print('DEBUG MODE ENABLED')
         simpleQoC.DEBUG_MODE = True
     
-    unittest.main()
\ No newline at end of file
+    unittest.main()